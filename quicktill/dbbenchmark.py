@@ -0,0 +1,649 @@
+"""Database benchmarks
+
+These create a scratch PostgreSQL database in the same way as
+test_models, fill it with generated data and time some of the queries
+used by the till and the web interface.  They are not part of the
+test suite.  Run them with:
+
+python3 -m quicktill.dbbenchmark [--days N] [benchmark ...]
+"""
+
+from . import models
+from sqlalchemy import create_engine, text, or_, func
+from sqlalchemy.orm import sessionmaker, object_session
+from sqlalchemy.orm import joinedload, contains_eager
+from contextlib import contextmanager
+import argparse
+from decimal import Decimal
+import datetime
+import os
+import pickle
+import resource
+import time
+
+BENCHMARK_DATABASE_NAME = "quicktill-benchmark"
+
+
+@contextmanager
+def benchmark_database():
+    """Create a scratch database and return an engine for it
+
+    The database is dropped again on exit.
+    """
+    engine = create_engine("postgresql+psycopg2:///postgres")
+    conn = engine.connect()
+    conn.execute('commit')
+    conn.execute(f'create database "{BENCHMARK_DATABASE_NAME}"')
+    conn.close()
+    engine = create_engine(
+        f"postgresql+psycopg2:///{BENCHMARK_DATABASE_NAME}")
+    try:
+        models.metadata.create_all(engine)
+        yield engine
+    finally:
+        engine.dispose()
+        engine = create_engine("postgresql+psycopg2:///postgres")
+        conn = engine.connect()
+        conn.execute('commit')
+        conn.execute(f'drop database "{BENCHMARK_DATABASE_NAME}"')
+        conn.close()
+
+
+def _time(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+# Words used to generate transaction line text and log descriptions
+_words = [
+    "Pint", "Half", "Bottle", "Glass", "Crisps", "Nuts", "Cider", "Stout",
+    "Porter", "Mild", "Bitter", "Lager", "Wine", "Red", "White", "Rose",
+    "Gin", "Rum", "Vodka", "Whisky", "Coffee", "Tea", "Cola", "Lemonade",
+    "Pie", "Chips", "Burger", "Sandwich", "Cake", "Soup",
+]
+
+
+def populate_sales(s, days=365, transactions_per_day=300,
+                   lines_per_transaction=3):
+    """Generate sessions, transactions, transaction lines and logs
+
+    One session per day ending yesterday.
+    """
+    s.add(models.Business(id=1, name="Benchmark", abbrev="BENCH",
+                          address="Nowhere"))
+    s.add(models.VatBand(band="A", rate=20, businessid=1))
+    s.add_all(models.Department(id=d, description=f"Dept {d}",
+                                vatband="A") for d in range(1, 11))
+    s.add(models.TransCode(code="S", description="Sale"))
+    s.add_all(models.User(fullname=f"User {u}", shortname=f"U{u}",
+                          enabled=True) for u in range(1, 21))
+    s.flush()
+    params = {
+        "days": days,
+        "first": datetime.date.today() - datetime.timedelta(days=days),
+        "transactions": transactions_per_day,
+        "lines": lines_per_transaction,
+        "words": _words,
+    }
+    s.execute(text("""
+    INSERT INTO sessions (sessionid, starttime, endtime, sessiondate)
+    SELECT nextval('sessions_seq'),
+           CAST(:first AS timestamp) + (n * interval '1 day')
+             + interval '11 hours',
+           CAST(:first AS timestamp) + (n * interval '1 day')
+             + interval '23 hours',
+           CAST(:first AS date) + n
+    FROM generate_series(0, :days - 1) AS n
+    """), params)
+    s.execute(text("""
+    INSERT INTO transactions (transid, sessionid, notes, closed)
+    SELECT nextval('transactions_seq'), sessionid,
+           CASE WHEN random() < 0.05
+                THEN 'Table ' || (random() * 30)::int ELSE '' END,
+           false
+    FROM sessions, generate_series(1, :transactions)
+    """), params)
+    s.execute(text("""
+    INSERT INTO translines (translineid, transid, items, amount, dept,
+                            "user", transcode, time, text, source)
+    SELECT nextval('translines_seq'), t.transid,
+           1 + (random() * 2)::int, (random() * 10)::numeric(10, 2),
+           1 + (random() * 9)::int, 1 + (random() * 19)::int, 'S',
+           s.starttime + random() * (s.endtime - s.starttime),
+           (CAST(:words AS text[]))[1 + (random() * 29)::int] || ' of '
+             || (CAST(:words AS text[]))[1 + (random() * 29)::int] || ' '
+             || (random() * 1000)::int,
+           'till' || (1 + (random() * 3)::int)
+    FROM transactions t
+    JOIN sessions s ON s.sessionid = t.sessionid,
+    generate_series(1, :lines)
+    """), params)
+    s.execute(text("""
+    INSERT INTO log (id, time, source, "user", description)
+    SELECT nextval('log_seq'),
+           s.starttime + random() * (s.endtime - s.starttime),
+           'till' || (1 + (random() * 3)::int), 1 + (random() * 19)::int,
+           'Changed ' || (CAST(:words AS text[]))[1 + (random() * 29)::int]
+             || ' to ' || (CAST(:words AS text[]))[1 + (random() * 29)::int]
+    FROM sessions s, generate_series(1, :transactions / 10)
+    """), params)
+    s.commit()
+    s.execute("ANALYZE")
+
+
+def populate_stock(s, days=365, stocktypes=200):
+    """Generate sales as populate_sales(), with the stock they used
+
+    Each stock type has a new stock item every week, used by the
+    transaction lines for that stock type in that week and finished
+    at the end of it, with a little waste recorded every day.  Each
+    session has a session total so that it appears in reports.
+    """
+    populate_sales(s, days=days)
+    s.add(models.PayType(paytype="CASH", description="Cash"))
+    s.add(models.Unit(description="Pint", name="pint",
+                      sale_unit_name="pint", sale_unit_name_plural="pints",
+                      stock_unit_name="pint", stock_unit_name_plural="pints"))
+    s.add(models.Supplier(name="Benchmark Brewery"))
+    s.add(models.FinishCode(id="empty", description="All gone"))
+    s.add_all([models.RemoveCode(id="sold", reason="Sold"),
+               models.RemoveCode(id="pullthru", reason="Pulled through")])
+    s.flush()
+    params = {
+        "first": datetime.date.today() - datetime.timedelta(days=days),
+        "weeks": days // 7 + 1,
+        "stocktypes": stocktypes,
+        "words": _words,
+    }
+    s.execute(text("""
+    INSERT INTO sessiontotals (sessionid, paytype, amount)
+    SELECT s.sessionid, 'CASH', COALESCE(sum(tl.items * tl.amount), 0)
+    FROM sessions s
+    LEFT JOIN transactions t ON t.sessionid = s.sessionid
+    LEFT JOIN translines tl ON tl.transid = t.transid
+    GROUP BY s.sessionid
+    """), params)
+    s.execute(text("""
+    INSERT INTO deliveries (deliveryid, supplierid, date, checked)
+    SELECT nextval('deliveries_seq'), min(supplierid), CAST(:first AS date),
+           true
+    FROM suppliers
+    """), params)
+    # Stock type n has ID n, and its item for week w has ID
+    # w * stocktypes + n, so that sales can be matched to stock
+    # without a lookup
+    s.execute(text("""
+    INSERT INTO stocktypes (stocktype, dept, manufacturer, name, abv,
+                            unit_id, saleprice)
+    SELECT n, 1 + n % 10,
+           (CAST(:words AS text[]))[1 + n % 30],
+           (CAST(:words AS text[]))[1 + (n / 30) % 30] || ' ' || n,
+           4.0, (SELECT min(id) FROM unittypes), 4.00
+    FROM generate_series(1, :stocktypes) AS n;
+    SELECT setval('stocktypes_seq', :stocktypes);
+    """), params)
+    s.execute(text("""
+    INSERT INTO stock (stockid, deliveryid, stocktype, description, size,
+                       costprice, onsale, finished, finishcode)
+    SELECT w * :stocktypes + n, (SELECT min(deliveryid) FROM deliveries),
+           n, 'Cask', 5000.0, 100.00,
+           CAST(:first AS timestamp) + (w * interval '7 days'),
+           CAST(:first AS timestamp) + ((w + 1) * interval '7 days'), 'empty'
+    FROM generate_series(0, :weeks - 1) AS w,
+         generate_series(1, :stocktypes) AS n;
+    SELECT setval('stock_seq', :weeks * :stocktypes);
+    """), params)
+    s.execute(text("""
+    INSERT INTO stockout (stockoutid, stockid, qty, removecode, translineid,
+                          time)
+    SELECT nextval('stockout_seq'),
+           ((tl.time::date - CAST(:first AS date)) / 7) * :stocktypes
+             + 1 + tl.translineid % :stocktypes,
+           tl.items, 'sold', tl.translineid, tl.time
+    FROM translines tl
+    """), params)
+    s.execute(text("""
+    INSERT INTO stockout (stockoutid, stockid, qty, removecode, time)
+    SELECT nextval('stockout_seq'),
+           ((s.sessiondate - CAST(:first AS date)) / 7) * :stocktypes + n,
+           1.0, 'pullthru', s.endtime
+    FROM sessions s, generate_series(1, :stocktypes, 10) AS n
+    """), params)
+    s.commit()
+    s.execute("ANALYZE")
+
+
+def populate_stocktake(s, days=365, items=10000, items_per_stocktype=10):
+    """Generate a stock take in progress
+
+    The stock take covers every stock type, and has a snapshot of
+    each of the unfinished stock items.  A tenth of the snapshots have
+    an adjustment, and a twentieth of the items are found to be
+    finished.  The days argument is not used.
+    """
+    s.add(models.Business(id=1, name="Benchmark", abbrev="BENCH",
+                          address="Nowhere"))
+    s.add(models.VatBand(band="A", rate=20, businessid=1))
+    s.add_all(models.Department(id=d, description=f"Dept {d}",
+                                vatband="A") for d in range(1, 11))
+    s.add(models.Unit(description="Pint", name="pint",
+                      sale_unit_name="pint", sale_unit_name_plural="pints",
+                      stock_unit_name="pint", stock_unit_name_plural="pints"))
+    s.add(models.Supplier(name="Benchmark Brewery"))
+    s.add(models.FinishCode(id="empty", description="All gone"))
+    s.add_all([models.RemoveCode(id="missing", reason="Missing"),
+               models.RemoveCode(id="pullthru", reason="Pulled through")])
+    user = models.User(fullname="Benchmark", shortname="B", enabled=True)
+    stocktake = models.StockTake(description="Benchmark", create_user=user)
+    s.add(stocktake)
+    s.flush()
+    params = {
+        "stocktypes": items // items_per_stocktype,
+        "per_stocktype": items_per_stocktype,
+        "stocktake": stocktake.id,
+        "words": _words,
+    }
+    s.execute(text("""
+    INSERT INTO deliveries (deliveryid, supplierid, date, checked)
+    SELECT nextval('deliveries_seq'), min(supplierid), CURRENT_DATE, true
+    FROM suppliers
+    """), params)
+    s.execute(text("""
+    INSERT INTO stocktypes (stocktype, dept, manufacturer, name, abv,
+                            unit_id, saleprice, stocktake_id)
+    SELECT nextval('stocktypes_seq'), 1 + n % 10,
+           (CAST(:words AS text[]))[1 + n % 30],
+           (CAST(:words AS text[]))[1 + (n / 30) % 30] || ' ' || n,
+           4.0, (SELECT min(id) FROM unittypes), 4.00, :stocktake
+    FROM generate_series(1, :stocktypes) AS n
+    """), params)
+    s.execute(text("""
+    INSERT INTO stock (stockid, deliveryid, stocktype, description, size,
+                       costprice, onsale)
+    SELECT nextval('stock_seq'), (SELECT min(deliveryid) FROM deliveries),
+           stocktype, 'Cask', 72.0, 100.00, CURRENT_TIMESTAMP
+    FROM stocktypes, generate_series(1, :per_stocktype)
+    """), params)
+    stocktake.take_snapshot()
+    s.execute(text("""
+    INSERT INTO stocktake_adjustments (stocktake_id, stock_id,
+                                       removecode_id, qty)
+    SELECT stocktake_id, stock_id, 'missing', 1.0
+    FROM stocktake_snapshots
+    WHERE stock_id % 10 = 0
+    """), params)
+    s.execute(text("""
+    UPDATE stocktake_snapshots SET finishcode = 'empty'
+    WHERE stock_id % 20 = 1
+    """), params)
+    s.commit()
+    s.execute("ANALYZE")
+
+
+def _commit_snapshot_by_object(stocktake, user):
+    """StockTake.commit_snapshot() as it was before it used set-based
+    statements, for comparison
+    """
+    s = object_session(stocktake)
+    stocktake.commit_time = func.current_timestamp()
+    stocktake.commit_user = user
+    for ss in stocktake.snapshots:
+        if ss.finishcode:
+            ss.stockitem.finishcode = ss.finishcode
+            ss.stockitem.stockline = None
+            ss.stockitem.displayqty = None
+            if not ss.stockitem.finished:
+                ss.stockitem.finished = func.current_timestamp()
+        if not ss.finishcode:
+            ss.stockitem.finishcode = None
+            ss.stockitem.finished = None
+        for a in ss.adjustments:
+            s.add(models.StockOut(
+                stockitem=ss.stockitem,
+                time=func.current_timestamp(),
+                removecode=a.removecode,
+                stocktake=stocktake,
+                qty=a.qty))
+    s.query(models.StockType)\
+     .filter(models.StockType.stocktake == stocktake)\
+     .update({models.StockType.stocktake_id: None})
+
+
+def benchmark_stocktake(engine, days):
+    """Committing a stock take, by object and set-based
+
+    Each commit is rolled back so that the next one starts from the
+    same stock take.
+    """
+    sm = sessionmaker(bind=engine)
+    s = sm()
+    snapshots = s.query(models.StockTakeSnapshot).count()
+    s.close()
+
+    def run(commit):
+        s = sm()
+        try:
+            stocktake = s.query(models.StockTake).one()
+            user = s.query(models.User).one()
+            commit(stocktake, user)
+            s.flush()
+        finally:
+            s.rollback()
+            s.close()
+
+    by_object = _time(lambda: run(_commit_snapshot_by_object), repeat=3)
+    set_based = _time(lambda: run(models.StockTake.commit_snapshot), repeat=3)
+    print(f"commit {snapshots} snapshots: by object {by_object:.2f}s, "
+          f"set-based {set_based:.2f}s")
+
+
+def populate_purge(s, days=365, items=10000, items_per_stocktype=10):
+    """Generate stock items on display and continuous stock lines
+
+    Even-numbered stock types have a display stock line with all their
+    stock items on it, and every fifth stock type has a continuous
+    stock line.  Half of the stock items are used up.  The days
+    argument is not used.
+    """
+    s.add(models.Business(id=1, name="Benchmark", abbrev="BENCH",
+                          address="Nowhere"))
+    s.add(models.VatBand(band="A", rate=20, businessid=1))
+    s.add_all(models.Department(id=d, description=f"Dept {d}",
+                                vatband="A") for d in range(1, 11))
+    s.add(models.Unit(description="Pint", name="pint",
+                      sale_unit_name="pint", sale_unit_name_plural="pints",
+                      stock_unit_name="pint", stock_unit_name_plural="pints"))
+    s.add(models.Supplier(name="Benchmark Brewery"))
+    s.add(models.FinishCode(id="empty", description="All gone"))
+    s.add(models.RemoveCode(id="sold", reason="Sold"))
+    s.flush()
+    params = {
+        "stocktypes": items // items_per_stocktype,
+        "per_stocktype": items_per_stocktype,
+        "words": _words,
+    }
+    s.execute(text("""
+    INSERT INTO deliveries (deliveryid, supplierid, date, checked)
+    SELECT nextval('deliveries_seq'), min(supplierid), CURRENT_DATE, true
+    FROM suppliers
+    """), params)
+    s.execute(text("""
+    INSERT INTO stocktypes (stocktype, dept, manufacturer, name, abv,
+                            unit_id, saleprice)
+    SELECT n, 1 + n % 10,
+           (CAST(:words AS text[]))[1 + n % 30],
+           (CAST(:words AS text[]))[1 + (n / 30) % 30] || ' ' || n,
+           4.0, (SELECT min(id) FROM unittypes), 4.00
+    FROM generate_series(1, :stocktypes) AS n;
+    SELECT setval('stocktypes_seq', :stocktypes);
+    """), params)
+    s.execute(text("""
+    INSERT INTO stocklines (stocklineid, name, location, linetype,
+                            capacity, stocktype)
+    SELECT nextval('stocklines_seq'), 'Display ' || n, 'Bar', 'display',
+           10, n
+    FROM generate_series(2, :stocktypes, 2) AS n
+    """), params)
+    s.execute(text("""
+    INSERT INTO stocklines (stocklineid, name, location, linetype,
+                            stocktype)
+    SELECT nextval('stocklines_seq'), 'Continuous ' || n, 'Bar',
+           'continuous', n
+    FROM generate_series(5, :stocktypes, 5) AS n
+    """), params)
+    s.execute(text("""
+    INSERT INTO stock (stockid, deliveryid, stocktype, description, size,
+                       costprice, onsale, stocklineid, displayqty)
+    SELECT nextval('stock_seq'), (SELECT min(deliveryid) FROM deliveries),
+           st.stocktype, 'Case', 72.0, 100.00, CURRENT_TIMESTAMP,
+           sl.stocklineid, CASE WHEN sl.stocklineid IS NULL
+                                THEN NULL ELSE 72.0 END
+    FROM stocktypes st
+    LEFT JOIN stocklines sl ON sl.stocktype = st.stocktype
+                           AND sl.linetype = 'display',
+         generate_series(1, :per_stocktype)
+    """), params)
+    s.execute(text("""
+    INSERT INTO stockout (stockoutid, stockid, qty, removecode, time)
+    SELECT nextval('stockout_seq'), stockid,
+           CASE WHEN stockid % 2 = 0 THEN 72.0 ELSE 36.0 END, 'sold',
+           CURRENT_TIMESTAMP
+    FROM stock
+    """), params)
+    s.commit()
+    s.execute("ANALYZE")
+
+
+def _stock_purge_by_object(s, source, user=None):
+    """managestock.stock_purge_internal() as it was before it used
+    set-based statements, for comparison
+    """
+    StockItem = models.StockItem
+    StockLine = models.StockLine
+    finished = s.query(StockItem)\
+                .join(StockItem.stockline)\
+                .options(contains_eager(StockItem.stockline))\
+                .options(joinedload('stocktype'))\
+                .filter(StockItem.finished == None)\
+                .filter(StockLine.linetype == "display")\
+                .filter(StockItem.remaining == Decimal("0.0"))\
+                .all()
+    cfinished = s.query(StockItem)\
+                 .join(StockLine,
+                       StockItem.stocktype_id == StockLine.stocktype_id)\
+                 .options(joinedload('stocktype'))\
+                 .options(contains_eager('stocktype.stocklines'))\
+                 .filter(StockItem.finished == None)\
+                 .filter(StockLine.linetype == "continuous")\
+                 .filter(StockItem.remaining <= Decimal("0.0"))\
+                 .all()
+    finished = finished + cfinished
+    for item in finished:
+        if item.stockline:
+            s.add(models.StockAnnotation(
+                stockitem=item, atype="stop", user=user,
+                text=f"{item.stockline.name} (display stockline, {source})"))
+        else:
+            for sl in item.stocktype.stocklines:
+                s.add(models.StockAnnotation(
+                    stockitem=item, atype="stop", user=user,
+                    text=f"{sl.name} (continuous stockline, {source})"))
+        item.finished = datetime.datetime.now()
+        item.finishcode_id = 'empty'
+        item.displayqty = None
+        item.stockline = None
+    s.flush()
+    return finished
+
+
+def benchmark_purge(engine, days):
+    """Purging finished stock at session end, by object and set-based
+
+    Each purge is rolled back so that the next one starts with the
+    same stock.
+    """
+    sm = sessionmaker(bind=engine)
+
+    def run(purge):
+        s = sm()
+        try:
+            return len(purge(s, "benchmark"))
+        finally:
+            s.rollback()
+            s.close()
+
+    purged = run(models.StockItem.purge_finished)
+    by_object = _time(lambda: run(_stock_purge_by_object), repeat=3)
+    set_based = _time(lambda: run(models.StockItem.purge_finished), repeat=3)
+    print(f"purge {purged} stock items: by object {by_object:.2f}s, "
+          f"set-based {set_based:.2f}s")
+
+
+def _search_queries(s, term):
+    """The translines search from tillweb, as a plain OR and as a union
+    """
+    Transline = models.Transline
+    User = models.User
+    conditions = [
+        Transline.text.ilike(f"%{term}%"),
+        Transline.source.ilike(f"{term}%"),
+        Transline.user_id.in_(
+            s.query(User.id).filter(User.fullname.ilike(f"%{term}%"))),
+        Transline.discount_name.ilike(f"%{term}%"),
+    ]
+    q = s.query(Transline.id)
+    plain = q.filter(or_(*conditions))
+    matches = [s.query(Transline.id).filter(c) for c in conditions]
+    union = q.filter(Transline.id.in_(matches[0].union(*matches[1:])))
+    return plain, union
+
+
+def benchmark_search(engine, days):
+    """Free-text search with and without trigram indexes
+    """
+    s = sessionmaker(bind=engine)()
+    trigram = s.execute("SELECT EXISTS (SELECT 1 FROM pg_extension "
+                        "WHERE extname = 'pg_trgm')").scalar()
+    if not trigram:
+        print("pg_trgm extension is not available; skipping")
+        return
+    for term in ("Cider of Gin", "stout", "zzz"):
+        plain, union = _search_queries(s, term)
+        with_indexes = (_time(lambda: plain.all()),
+                        _time(lambda: union.all()))
+        for name, _, _ in models.trigram_indexes:
+            s.execute(f"DROP INDEX {name}")
+        without_indexes = (_time(lambda: plain.all()),
+                           _time(lambda: union.all()))
+        s.rollback()
+        print(f"{term!r} ({len(plain.all())} rows): "
+              f"without indexes OR {without_indexes[0]:.3f}s, "
+              f"union {without_indexes[1]:.3f}s; "
+              f"with indexes OR {with_indexes[0]:.3f}s, "
+              f"union {with_indexes[1]:.3f}s")
+    s.close()
+
+
+class _CountingFile:
+    """A binary file that discards everything written to it"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _measure_report(url, report):
+    """Generate a report in a child process
+
+    Returns the time taken and the increase in the child's peak
+    resident set size in kilobytes, which includes memory used by
+    the database driver as well as by Python objects.
+    """
+    from .tillweb.db import td
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            engine = create_engine(url)
+            td.s = sessionmaker(bind=engine)()
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            f = _CountingFile()
+            report().write(f)
+            size = f.size
+            t = time.perf_counter() - start
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            td.s.close()
+            result = (t, after - before, size)
+        except Exception as e:
+            result = e
+        with os.fdopen(w, "wb") as f:
+            pickle.dump(result, f)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r, "rb") as f:
+        result = pickle.load(f)
+    os.waitpid(pid, 0)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def benchmark_reports(engine, days):
+    """Time and peak memory for the tillweb spreadsheet reports
+
+    Ranges of one and five years are used, where there is enough
+    data for them; use --days 1830 to include the five year range.
+    Needs django and odfpy.
+    """
+    from .tillweb import spreadsheets
+    url = str(engine.url)
+    engine.dispose()
+    reports = {
+        "sessionrange": lambda start, end: spreadsheets.sessionrange(
+            start=start, end=end),
+        "sessionrange (weeks)": lambda start, end: spreadsheets.sessionrange(
+            start=start, end=end, rows="Weeks"),
+        "waste": lambda start, end: spreadsheets.waste(
+            start=start, end=end),
+        "stocksold": lambda start, end: spreadsheets.stocksold(
+            start=start, end=end),
+        "translinesummary": lambda start, end: spreadsheets.translinesummary(
+            start=start, end=end),
+    }
+    end = datetime.date.today() - datetime.timedelta(days=1)
+    for years in (1, 5):
+        if years * 365 > days:
+            print(f"{years} year range: not enough data; skipping")
+            continue
+        start = end - datetime.timedelta(days=years * 365 - 1)
+        for name, report in reports.items():
+            t, rss, size = _measure_report(
+                url, lambda: report(start, end))
+            print(f"{name}, {years} year: {t:.2f}s, "
+                  f"peak memory +{rss / 1024:.1f}MiB, "
+                  f"{size / 1024:.0f}KiB spreadsheet")
+
+
+benchmarks = {
+    "search": (populate_sales, benchmark_search),
+    "reports": (populate_stock, benchmark_reports),
+    "stocktake": (populate_stocktake, benchmark_stocktake),
+    "purge": (populate_purge, benchmark_purge),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database benchmarks")
+    parser.add_argument("--days", type=int, default=365,
+                        help="Days of sales to generate")
+    parser.add_argument("benchmark", nargs="*",
+                        help="Benchmarks to run (default all): "
+                        + ", ".join(benchmarks.keys()))
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark {name}")
+    for name in args.benchmark or benchmarks.keys():
+        populate, benchmark = benchmarks[name]
+        print(f"{name}: generating {args.days} days of data")
+        with benchmark_database() as engine:
+            s = sessionmaker(bind=engine)()
+            populate(s, days=args.days)
+            s.close()
+            benchmark(engine, args.days)
+
+
+if __name__ == '__main__':
+    main()
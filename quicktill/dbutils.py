@@ -1,6 +1,7 @@
 """Various command-line utilities for dealing with the database
 """
 
+import datetime
 import os
 from . import cmdline
 from . import td
@@ -191,6 +192,33 @@ class anonymise(cmdline.command):
         print("Finished.")
 
 
+class rebuild_stockout_daily(cmdline.command):
+    """
+    Recalculate the daily totals of stock removed, used by the buying
+    list and the stock sold and waste reports, from the stock usage
+    records.  This should be run once after upgrading to fill in the
+    totals for earlier dates, and may be run again at any time.  The
+    tills can't record stock usage while this is running.
+
+    """
+    command = "rebuild-stockout-daily"
+    help = "recalculate daily stock usage totals"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "--from", type=datetime.date.fromisoformat, dest="start",
+            metavar="YYYY-MM-DD",
+            help="only recalculate totals from this date onwards")
+
+    @staticmethod
+    def run(args):
+        with td.orm_session():
+            models.StockOutDaily.rebuild(td.s, start=args.start)
+            rows = td.s.query(models.StockOutDaily).count()
+        print(f"Finished: {rows} daily totals.")
+
+
 class checkdb(cmdline.command):
     """
     Check that the database schema matches the schema defined in the
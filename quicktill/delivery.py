@@ -8,7 +8,7 @@ from .models import penny
 from .plugins import InstancePluginMount
 import datetime
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, contains_eager
 
 import logging
 log = logging.getLogger(__name__)
@@ -259,6 +259,7 @@ class delivery(ui.basicpopup):
         q = td.s.query(StockItem)\
                 .join(StockType)\
                 .join(Unit)\
+                .options(contains_eager(StockItem.stocktype))\
                 .filter(StockItem.deliveryid == self.dn)\
                 .order_by(StockItem.id)
         if not label_everything():
@@ -266,10 +267,11 @@ class delivery(ui.basicpopup):
         return q
 
     def _print_labels(self, label_printer):
-        labels = self._label_query().all()
-        with label_printer as f:
-            for l in labels:
-                printer.stock_label(f, l)
+        labels = self._label_query()\
+                     .options(joinedload(StockItem.delivery)
+                              .joinedload(Delivery.supplier))\
+                     .all()
+        printer.print_stock_labels(label_printer, labels)
 
     def printout(self):
         if self.dn is None:
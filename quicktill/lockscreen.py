@@ -30,13 +30,21 @@ class CheckPrinter(LockScreenPlugin):
     def __init__(self, description, printer):
         self._description = description
         self._printer = printer
+        self._problem = None
 
     def add_note(self):
         problem = self._printer.offline()
+        self._problem = problem
         if problem:
             log.info("%s problem: %s", self._description, problem)
             return f"{self._description} problem: {problem}"
 
+    def refresh(self):
+        # Keep checking while there is a problem, so that the note
+        # goes away once the printer (or its spool) recovers
+        if self._problem:
+            return 10
+
 
 class lockpage(ui.basicpage):
     def __init__(self):
@@ -3,12 +3,11 @@
 from . import ui, td, keyboard, user, usestock
 from . import stock, delivery, department, stocklines, stocktype
 from . import tillconfig
-from .models import Department, FinishCode, StockLine
+from .models import Department, FinishCode
 from .models import StockType, StockAnnotation
-from .models import StockItem, Delivery, StockOut
+from .models import StockItem, Delivery, StockOutDaily
 from sqlalchemy.orm import lazyload, joinedload, undefer, contains_eager
 from sqlalchemy.sql import func
-from decimal import Decimal
 import datetime
 
 import logging
@@ -170,16 +169,17 @@ class stocklevelcheck(user.permission_checked, ui.dismisspopup):
         behind = datetime.timedelta(days=months_behind * 30.4)
         dept = self.deptfield.read()
         self.dismiss()
-        q = td.s.query(StockType, func.sum(StockOut.qty) / behind.days)\
+        since = datetime.date.today() - behind
+        sold = func.sum(StockOutDaily.qty) / behind.days
+        q = td.s.query(StockType, sold)\
                 .select_from(StockType)\
-                .join(StockItem)\
-                .join(StockOut)\
+                .join(StockOutDaily)\
                 .options(lazyload(StockType.department))\
                 .options(lazyload(StockType.unit))\
                 .options(undefer(StockType.all_instock))\
-                .filter(StockOut.removecode_id == 'sold')\
-                .filter((func.now() - StockOut.time) < behind)\
-                .having(func.sum(StockOut.qty) / behind.days > min_sale)\
+                .filter(StockOutDaily.removecode_id == 'sold')\
+                .filter(StockOutDaily.date > since)\
+                .having(sold > min_sale)\
                 .group_by(StockType)
         if dept:
             q = q.filter(StockType.dept_id == dept.id)
@@ -213,59 +213,9 @@ def stock_purge_internal(source):
     mechanism during the session, but is also available as an option
     on the stock management menu.
     """
-    # Find stock that is ready for purging: remaining==0.0 on a
-    # display stockline
-
-    # NB the contains_eager() is necessary in this query to avoid
-    # multiple joins to StockLine which would negate the effect of the
-    # filter on linetype.
-    log.debug("Finding display stockline items to purge...")
-    finished = td.s.query(StockItem)\
-                   .join(StockItem.stockline)\
-                   .options(contains_eager(StockItem.stockline))\
-                   .options(joinedload('stocktype'))\
-                   .filter(StockItem.finished == None)\
-                   .filter(StockLine.linetype == "display")\
-                   .filter(StockItem.remaining == Decimal("0.0"))\
-                   .all()
-
-    # Find more stock that is ready for purging: remaining <= 0.0 if
-    # mentioned by a continuous stockline
-    log.debug("Finding continuous stockline items to purge...")
-    cfinished = td.s.query(StockItem)\
-                    .join(StockLine,
-                          StockItem.stocktype_id == StockLine.stocktype_id)\
-                    .options(joinedload('stocktype'))\
-                    .options(contains_eager('stocktype.stocklines'))\
-                    .filter(StockItem.finished == None)\
-                    .filter(StockLine.linetype == "continuous")\
-                    .filter(StockItem.remaining <= Decimal("0.0"))\
-                    .all()
-
-    finished = finished + cfinished
-
-    # Mark all these stockitems as finished, removing them from being
-    # on sale as we go
     user = ui.current_user()
     user = user.dbuser if user and hasattr(user, 'dbuser') else None
-    for item in finished:
-        if item.stockline:
-            # Directly connected to a stockline
-            td.s.add(StockAnnotation(
-                stockitem=item, atype="stop", user=user,
-                text=f"{item.stockline.name} (display stockline, {source})"))
-        else:
-            # Indirectly connected via a continuous stockline
-            for sl in item.stocktype.stocklines:
-                td.s.add(StockAnnotation(
-                    stockitem=item, atype="stop", user=user,
-                    text=f"{sl.name} (continuous stockline, {source})"))
-        item.finished = datetime.datetime.now()
-        item.finishcode_id = 'empty'  # guaranteed to exist
-        item.displayqty = None
-        item.stockline = None
-    td.s.flush()
-    return finished
+    return StockItem.purge_finished(td.s, source, user=user)
 
 
 @user.permission_required(
@@ -7,8 +7,9 @@ from sqlalchemy.schema import Sequence, Index, MetaData, DDL
 from sqlalchemy.schema import CheckConstraint, Table
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.schema import ForeignKeyConstraint
-from sqlalchemy.sql.expression import text, case, literal
+from sqlalchemy.sql.expression import text, case, literal, null
 from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm import Session as ORMSession
 from sqlalchemy.orm import joinedload, lazyload
 from sqlalchemy.orm import contains_eager, column_property
 from sqlalchemy.orm import undefer_group
@@ -16,13 +17,18 @@ from sqlalchemy.orm import aliased
 from sqlalchemy.orm import deferred
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql import select, func, desc, and_
+from sqlalchemy.sql import select, func, desc, and_, or_
 from sqlalchemy import event
 from sqlalchemy import distinct
 from sqlalchemy import inspect
+from sqlalchemy import type_coerce
 
 import datetime
 import hashlib
+import itertools
+import json
+import time
+import weakref
 from decimal import Decimal
 from inspect import isclass
 import re
@@ -161,6 +167,23 @@ class Business(Base, Logged):
         return self.abbrev
 
 
+add_ddl(Business.__table__, """
+CREATE OR REPLACE FUNCTION notify_vat_change() RETURNS trigger AS $$
+DECLARE
+BEGIN
+  PERFORM pg_notify('vat_changed', '');
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER vat_changed
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON businesses
+  EXECUTE PROCEDURE notify_vat_change();
+""", """
+DROP TRIGGER vat_changed ON businesses;
+DROP FUNCTION notify_vat_change();
+""")
+
+
 # This is intended to be a mixin for both VatBand and VatRate.  It's
 # not intended to be instantiated.
 class Vat:
@@ -221,10 +244,15 @@ class VatBand(Base, Vat, Logged):
     description = Column(String(), nullable=False, server_default="None")
 
 
-# Note that the tillweb index page code ignores the 'business' field
-# in VatRate and only uses VatBand.  Until this is fixed you should
-# not use a VatRate entry to change the business for a VatBand -
-# create a new department instead.
+add_ddl(VatBand.__table__, """
+CREATE TRIGGER vat_changed
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON vat
+  EXECUTE PROCEDURE notify_vat_change();
+""", """
+DROP TRIGGER vat_changed ON vat;
+""")
+
+
 class VatRate(Base, Vat, Logged):
     __tablename__ = 'vatrates'
     band = Column(CHAR(1), ForeignKey('vat.band'), primary_key=True)
@@ -232,6 +260,150 @@ class VatRate(Base, Vat, Logged):
     business = relationship(Business, backref='vatrates')
 
 
+add_ddl(VatRate.__table__, """
+CREATE TRIGGER vat_changed
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON vatrates
+  EXECUTE PROCEDURE notify_vat_change();
+""", """
+DROP TRIGGER vat_changed ON vatrates;
+""")
+
+
+class VatCache:
+    """Process-wide cache of VAT bands, VAT rates and businesses
+
+    Everything is loaded in a single query the first time it's needed
+    for a database, and kept detached from any ORM session until the
+    cache is invalidated.  The cached objects must be treated as
+    read-only.
+
+    The cache for a database is invalidated when a VAT band, VAT rate
+    or business is changed through the ORM in this process, when a
+    "vat_changed" notification is received if listen_for_changes()
+    has been called, and in any case after "ttl" seconds so that
+    processes that don't listen for notifications will eventually
+    see changes made elsewhere.  Looking up a band or business that
+    isn't in the cache reloads it first, so ones added elsewhere can
+    be used straight away; KeyError is only raised if it still isn't
+    found.
+    """
+    ttl = 300
+    _caches = weakref.WeakKeyDictionary()  # keys are Engines
+    _listener = None
+
+    def __init__(self, session):
+        self._bind = session.get_bind()
+        self._load()
+
+    def _load(self):
+        # Keys are band codes, values are (VatBand, [VatRate]) with the
+        # VatRates in descending order of date
+        bands = {}
+        businesses = {}
+        s = ORMSession(bind=self._bind)
+        try:
+            for band, rate in s.query(VatBand, VatRate)\
+                               .outerjoin(VatRate)\
+                               .options(joinedload(VatBand.business),
+                                        joinedload(VatRate.business))\
+                               .order_by(VatBand.band, desc(VatRate.active)):
+                rates = bands.setdefault(band.band, (band, []))[1]
+                businesses[band.businessid] = band.business
+                if rate:
+                    rates.append(rate)
+                    businesses[rate.businessid] = rate.business
+        finally:
+            s.close()
+        self._bands = bands
+        self._businesses = businesses
+        self._loaded = time.monotonic()
+
+    def _lookup(self, table, key):
+        # A key that isn't in the cache may have been added by another
+        # process since the cache was loaded; reload once before
+        # giving up
+        try:
+            return getattr(self, table)[key]
+        except KeyError:
+            self._load()
+            return getattr(self, table)[key]
+
+    @classmethod
+    def get(cls, session):
+        """Return the VatCache for the database used by an ORM session
+        """
+        engine = session.get_bind().engine
+        cache = cls._caches.get(engine)
+        if cache is None or time.monotonic() - cache._loaded > cls.ttl:
+            cache = cls(session)
+            cls._caches[engine] = cache
+        return cache
+
+    @classmethod
+    def invalidate(cls, engine=None):
+        """Invalidate the cache for an Engine, or for all Engines
+        """
+        if engine is None:
+            cls._caches.clear()
+        else:
+            cls._caches.pop(engine, None)
+
+    @classmethod
+    def _vat_changed(cls, payload):
+        cls.invalidate()
+
+    @classmethod
+    def listen_for_changes(cls, listener):
+        if not cls._listener:
+            cls._listener = listener.listen_for('vat_changed', cls._vat_changed)
+
+    def band(self, band):
+        """The VatBand for a band code
+        """
+        return self._lookup('_bands', band)[0]
+
+    def business(self, businessid):
+        """The Business for a business ID
+
+        Only businesses referred to by a VAT band or VAT rate are
+        available.
+        """
+        return self._lookup('_businesses', businessid)
+
+    def at(self, band, date):
+        """VatRate for a band code at specified date
+
+        Equivalent to VatBand.at(): returns the VatBand itself if
+        there is no suitable VatRate.
+        """
+        vatband, rates = self._lookup('_bands', band)
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        for rate in rates:
+            if rate.active <= date:
+                return rate
+        return vatband
+
+
+@event.listens_for(ORMSession, "after_flush")
+def _vat_cache_check_flush(session, flush_context):
+    for i in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(i, (Business, VatBand, VatRate)):
+            session.info["vat_changed"] = True
+            break
+
+
+@event.listens_for(ORMSession, "after_commit")
+def _vat_cache_check_commit(session):
+    if session.info.pop("vat_changed", False):
+        VatCache.invalidate(session.get_bind().engine)
+
+
+@event.listens_for(ORMSession, "after_soft_rollback")
+def _vat_cache_check_rollback(session, previous_transaction):
+    session.info.pop("vat_changed", None)
+
+
 class PayType(Base):
     """A payment method
     """
@@ -472,15 +644,17 @@ class Session(Base, Logged):
 
         Returns (VatRate, amount, ex-vat amount, vat)
         """
-        vt = object_session(self)\
-            .query(VatBand, func.sum(Transline.items * Transline.amount))\
-            .select_from(Session)\
-            .filter(Session.id == self.id)\
-            .join(Transaction, Transline, Department, VatBand)\
-            .order_by(VatBand.band)\
-            .group_by(VatBand)\
-            .all()
-        vt = [(a.at(self.date), b) for a, b in vt]
+        s = object_session(self)
+        vt = s.query(Department.vatband,
+                     func.sum(Transline.items * Transline.amount))\
+              .select_from(Session)\
+              .filter(Session.id == self.id)\
+              .join(Transaction, Transline, Department)\
+              .order_by(Department.vatband)\
+              .group_by(Department.vatband)\
+              .all()
+        vatcache = VatCache.get(s)
+        vt = [(vatcache.at(a, self.date), b) for a, b in vt]
         return [(a, b, a.inc_to_exc(b), a.inc_to_vat(b)) for a, b in vt]
 
     # It may become necessary to add a further query here that returns
@@ -505,6 +679,18 @@ class Session(Base, Logged):
             order_by(StockType.dept_id, desc(func.sum(StockOut.qty))).\
             all()
 
+    @property
+    def tillweb_immutable(self):
+        """Will the web pages for this session never change?
+
+        Once a session has ended, its totals have been recorded and
+        the next session has started, any further change to it is
+        made with a log entry that refers to it.
+        """
+        return self.endtime is not None \
+            and self.actual_total is not None \
+            and self.next is not None
+
     @classmethod
     def current(cls, session):
         """Current session
@@ -668,6 +854,15 @@ class Transaction(Base, Logged):
 
     # payments_total is a column property defined below
 
+    @property
+    def tillweb_immutable(self):
+        """Will the web pages for this transaction never change?
+
+        Closed transactions can't be altered apart from their notes,
+        and changes to notes are logged.
+        """
+        return self.closed
+
     def payments_summary(self):
         """List of (paytype, amount) tuples.
 
@@ -1709,6 +1904,112 @@ class StockLine(Base, Logged):
                 sm.append((i, move, newdisplayqty, instock_after_move))
         return sm
 
+    @classmethod
+    def plan_restock(cls, session, stocklines, target=None):
+        """Prepare lists of stock movements for several stocklines
+
+        Works out the same stock movements as calculate_restock() for
+        each of the "Display" stocklines in the list, using a single
+        query: running totals over the stock on sale on each line, in
+        the order of the stockonsale relationship, say how much of
+        the shortfall or excess on the line is left for each item.
+        Stock items with a negative amount on display or in stock are
+        treated as having none.  Other types of stockline are ignored.
+
+        Returns a list of (stockline, [(stockitem, fetchqty,
+        newdisplayqty, qtyremain)]) tuples, in the order of the
+        stocklines argument, for the stocklines that need stock
+        movements.  This function DOES NOT commit the movements to
+        the database.
+        """
+        stocklines = [sl for sl in stocklines if sl.linetype == "display"]
+        if not stocklines:
+            return []
+        stock = StockItem.__table__
+        lines = cls.__table__
+        displayqty = func.coalesce(stock.c.displayqty, 0)
+        used = select([func.coalesce(func.sum(StockOut.qty), text("0.0"))])\
+            .where(StockOut.stockid == stock.c.stockid)\
+            .as_scalar()
+        items = select([
+            stock.c.stockid,
+            stock.c.stocklineid,
+            stock.c.size,
+            displayqty.label('displayqty'),
+            (lines.c.capacity if target is None else literal(target))
+            .label('target'),
+            (displayqty - used).label('ondisplay'),
+            (stock.c.size - displayqty).label('instock'),
+        ]).select_from(stock.join(lines))\
+          .where(lines.c.stocklineid.in_([sl.id for sl in stocklines]))\
+          .where(lines.c.linetype == "display")\
+          .alias('items')
+        ondisplay = func.greatest(items.c.ondisplay, 0)
+        instock = func.greatest(items.c.instock, 0)
+        # Stock is fetched in stockonsale order, and returned in the
+        # opposite order
+        fetched_before = func.sum(instock).over(
+            partition_by=items.c.stocklineid,
+            order_by=(desc(items.c.displayqty), items.c.stockid),
+            rows=(None, -1))
+        returned_before = func.sum(ondisplay).over(
+            partition_by=items.c.stocklineid,
+            order_by=(items.c.displayqty, desc(items.c.stockid)),
+            rows=(None, -1))
+        needed = items.c.target - func.sum(items.c.ondisplay).over(
+            partition_by=items.c.stocklineid)
+        totals = select([
+            items,
+            needed.label('needed'),
+            func.coalesce(fetched_before, 0).label('fetched_before'),
+            func.coalesce(returned_before, 0).label('returned_before'),
+        ]).alias('totals')
+        move = case([
+            (totals.c.needed > 0,
+             func.least(func.greatest(totals.c.instock, 0),
+                        func.greatest(totals.c.needed
+                                      - totals.c.fetched_before, 0))),
+            (totals.c.needed < 0,
+             -func.least(func.greatest(totals.c.ondisplay, 0),
+                         func.greatest(-totals.c.needed
+                                       - totals.c.returned_before, 0))),
+        ], else_=0)
+        moves = select([
+            totals.c.stockid,
+            totals.c.stocklineid,
+            totals.c.needed,
+            type_coerce(move, quantity).label('move'),
+        ]).alias('moves')
+        rows = session.execute(
+            select([moves]).where(moves.c.move != 0)).fetchall()
+        if not rows:
+            return []
+        stockitems = {
+            item.id: item for item in session.query(StockItem)
+            .filter(StockItem.id.in_([row.stockid for row in rows]))
+            .all()}
+        movements = {}
+        for row in rows:
+            movements.setdefault(row.stocklineid, []).append(row)
+        plan = []
+        for sl in stocklines:
+            sm = []
+            rows = movements.get(sl.id, [])
+            # Keep the order calculate_restock() would use
+            for row in sorted(
+                    rows,
+                    key=lambda row: (-stockitems[row.stockid]
+                                     .displayqty_or_zero,
+                                     row.stockid),
+                    reverse=bool(rows) and rows[0].needed < 0):
+                i = stockitems[row.stockid]
+                newdisplayqty = i.displayqty_or_zero + row.move
+                sm.append((i, row.move, newdisplayqty,
+                           int(i.size) - newdisplayqty))
+            if sm:
+                plan.append((sl, sm))
+        return plan
+
     def calculate_sale(self, qty):
         """Work out a plan to remove a quantity of stock from the stock line.
 
@@ -2057,27 +2358,52 @@ class StockTake(Base, Logged):
         if self.commit_time:
             return
         s = object_session(self)
+        # The statements below work on the database directly, so any
+        # pending changes to snapshots and adjustments must be
+        # written first
+        s.flush()
         self.commit_time = func.current_timestamp()
         self.commit_user = user
-        for ss in self.snapshots:
-            if ss.finishcode:
-                ss.stockitem.finishcode = ss.finishcode
-                ss.stockitem.stockline = None
-                ss.stockitem.displayqty = None
-                if not ss.stockitem.finished:
-                    ss.stockitem.finished = func.current_timestamp()
-            if not ss.finishcode:
-                ss.stockitem.finishcode = None
-                ss.stockitem.finished = None
-            for a in ss.adjustments:
-                s.add(StockOut(
-                    stockitem=ss.stockitem,
-                    time=func.current_timestamp(),
-                    removecode=a.removecode,
-                    stocktake=self,
-                    qty=a.qty))
+        stock = StockItem.__table__
+        snapshots = StockTakeSnapshot.__table__
+        in_stocktake = and_(snapshots.c.stocktake_id == self.id,
+                            snapshots.c.stock_id == stock.c.stockid)
+        # Items found to be finished
+        s.execute(
+            stock.update()
+            .where(in_stocktake)
+            .where(snapshots.c.finishcode != None)
+            .values(finishcode=snapshots.c.finishcode,
+                    stocklineid=None,
+                    displayqty=None,
+                    finished=func.coalesce(stock.c.finished,
+                                           func.current_timestamp())))
+        # Items found to be still in stock
+        s.execute(
+            stock.update()
+            .where(in_stocktake)
+            .where(snapshots.c.finishcode == None)
+            .where(or_(stock.c.finishcode != None,
+                       stock.c.finished != None))
+            .values(finishcode=None, finished=None))
+        adjustments = StockTakeAdjustment.__table__
+        s.execute(
+            StockOut.__table__.insert()
+            .from_select(
+                ['stockid', 'time', 'removecode', 'stocktake_id', 'qty'],
+                select([adjustments.c.stock_id,
+                        func.current_timestamp(),
+                        adjustments.c.removecode_id,
+                        adjustments.c.stocktake_id,
+                        adjustments.c.qty])
+                .where(adjustments.c.stocktake_id == self.id)))
         s.query(StockType).filter(StockType.stocktake == self).update({
             StockType.stocktake_id: None})
+        # Stock items and their usage in the session may now be out
+        # of date
+        for i in s.identity_map.values():
+            if isinstance(i, (StockItem, StockLine)):
+                s.expire(i)
 
 # XXX add rules to ensure that stocktakes cannot be deleted once committed
 
@@ -2381,6 +2707,67 @@ class StockType(Base, Logged):
         Stock that is connected to a stock line (excluding
         "continuous" stock lines) isn't available for sale through
         this method.
+
+        The allocation is done by the database, which returns only
+        the stock items that are needed; _calculate_sale_by_item()
+        does the same thing with all the stock items loaded.
+        """
+        # Reject negative quantities
+        if qty < Decimal("0.0"):
+            return ([], qty, None)
+        session = object_session(self)
+        qtyparam = literal(qty, quantity)
+        items = session.query(StockItem.id.label('stockid'),
+                              StockItem.remaining.label('remaining'))\
+                       .filter(StockItem.checked == True)\
+                       .filter(StockItem.stocktype == self)\
+                       .filter(StockItem.finished == None)\
+                       .filter(StockItem.stockline == None)\
+                       .subquery()
+        available = func.greatest(items.c.remaining, 0)
+        before = func.coalesce(func.sum(available).over(
+            order_by=items.c.stockid, rows=(None, -1)), 0)
+        allocation = select([
+            items.c.stockid,
+            type_coerce(func.least(available,
+                                   func.greatest(qtyparam - before, 0)),
+                        quantity).label('sellqty'),
+            # If there isn't enough, the last item is sold anyway
+            # putting it into negative "remaining"
+            type_coerce(func.greatest(
+                qtyparam - func.sum(available).over(), 0),
+                quantity).label('overflow'),
+            type_coerce(func.sum(items.c.remaining).over(), quantity)
+            .label('remaining'),
+            (func.row_number().over(order_by=desc(items.c.stockid)) == 1)
+            .label('last'),
+        ]).alias('allocation')
+        session.flush()
+        rows = session.execute(
+            select([allocation])
+            .where(or_(allocation.c.sellqty > 0, allocation.c.last))
+            .order_by(allocation.c.stockid)).fetchall()
+        if not rows:
+            # There's no unfinished stock of this type at all that
+            # isn't connected to a stock line - we can't do anything.
+            return ([], qty, Decimal("0.0"))
+        stockitems = {
+            item.id: item for item in session.query(StockItem)
+            .filter(StockItem.id.in_([row.stockid for row in rows]))
+            .all()}
+        sell = [(stockitems[row.stockid], row.sellqty)
+                for row in rows if row.sellqty > Decimal("0.0")]
+        last = rows[-1]
+        if last.overflow > Decimal("0.0"):
+            sell.append((stockitems[last.stockid], last.overflow))
+        return (sell, Decimal("0.0"), last.remaining - qty)
+
+    def _calculate_sale_by_item(self, qty):
+        """Work out a plan to remove a quantity of stock from the stock type.
+
+        This is the same as calculate_sale() but loads all the stock
+        items that are available and allocates the quantity in
+        Python.  It is kept as a reference for testing.
         """
         # Reject negative quantities
         if qty < Decimal("0.0"):
@@ -2696,6 +3083,187 @@ class StockItem(Base, Logged):
         """
         return self.stocktype.unit.format_stock_qty(self.remaining)
 
+    @classmethod
+    def purge_finished(cls, session, source, user=None):
+        """Mark empty stock items on stock lines as finished
+
+        Stock items on "Display" stock lines are finished when they
+        have nothing remaining.  Stock items of a type that is sold
+        through a "Continuous" stock line are finished when they have
+        nothing or less than nothing remaining.
+
+        A "stop" annotation naming the stock line and the source is
+        added for each item, and each item is removed from its stock
+        line.  This is done with two statements however many items
+        there are.
+
+        Returns a list of the stock items that were finished.
+        """
+        session.flush()
+        stock = cls.__table__
+        lines = StockLine.__table__
+        display = lines.alias('display')
+        continuous = lines.alias('continuous')
+        on_display_line = stock.c.stocklineid.in_(
+            select([display.c.stocklineid])
+            .where(display.c.linetype == "display"))
+        on_continuous_line = stock.c.stocktype.in_(
+            select([continuous.c.stocktype])
+            .where(continuous.c.linetype == "continuous"))
+        purge = and_(
+            stock.c.finished == None,
+            or_(and_(on_display_line, cls.remaining == Decimal("0.0")),
+                and_(on_continuous_line, cls.remaining <= Decimal("0.0"))))
+        annotations = select([
+            stock.c.stockid,
+            (lines.c.name + f" (display stockline, {source})").label('text'),
+        ]).select_from(stock.join(lines))\
+          .where(purge)\
+          .union_all(
+              select([
+                  stock.c.stockid,
+                  lines.c.name + f" (continuous stockline, {source})",
+              ]).select_from(stock.join(
+                  lines, and_(lines.c.stocktype == stock.c.stocktype,
+                              lines.c.linetype == "continuous")))
+              .where(stock.c.stocklineid == None)
+              .where(purge))\
+          .alias('annotations')
+        annotation = StockAnnotation.__table__
+        annotated = session.execute(
+            annotation.insert().from_select(
+                ['stockid', 'atype', 'text', 'user'],
+                select([annotations.c.stockid,
+                        literal("stop"),
+                        annotations.c.text,
+                        literal(user.id if user else None, Integer)]))
+            .returning(annotation.c.stockid)).fetchall()
+        if not annotated:
+            return []
+        purged = session.execute(
+            stock.update()
+            .where(stock.c.stockid.in_({stockid for stockid, in annotated}))
+            .values(finished=datetime.datetime.now(),
+                    finishcode='empty',  # guaranteed to exist
+                    displayqty=None,
+                    stocklineid=None)
+            .returning(stock.c.stockid)).fetchall()
+        return session.query(cls)\
+                      .filter(cls.id.in_([stockid for stockid, in purged]))\
+                      .options(joinedload('stocktype'))\
+                      .order_by(cls.id)\
+                      .populate_existing()\
+                      .all()
+
+    @classmethod
+    def allocate_display_stock(cls, session, deliveryid=None, user=None):
+        """Allocate stock to display stock lines where there is no choice
+
+        Stock items from checked deliveries that are not on a stock
+        line, whose stock type is on exactly one display stock line,
+        are put on that line with a "start" annotation.  The work is
+        done by a single UPDATE followed by a single INSERT of the
+        annotations, without loading the stock items.
+
+        If deliveryid is specified, only stock items from that
+        delivery are considered.
+
+        Returns a list of the stock items that were allocated, and a
+        list of (StockItem, [StockLine]) for stock items that could go
+        on more than one display stock line.
+        """
+        stock = cls.__table__
+        lines = StockLine.__table__
+        deliveries = Delivery.__table__
+        display = lines.c.linetype == "display"
+        line_count = select([lines.c.stocktype,
+                             func.count().label('lines')])\
+            .where(display)\
+            .group_by(lines.c.stocktype)\
+            .alias()
+        allocate = and_(stock.c.finished == None,
+                        stock.c.stocklineid == None,
+                        deliveries.c.deliveryid == stock.c.deliveryid,
+                        deliveries.c.checked == True,
+                        display,
+                        lines.c.stocktype == stock.c.stocktype,
+                        line_count.c.stocktype == stock.c.stocktype,
+                        line_count.c.lines == 1)
+        if deliveryid:
+            allocate = and_(allocate, deliveries.c.deliveryid == deliveryid)
+        used = select([func.coalesce(func.sum(StockOut.qty), text("0.0"))])\
+            .where(StockOut.stockid == stock.c.stockid)\
+            .as_scalar()
+
+        session.flush()
+        # The log_stocktype rule on the stock table inserts a row into
+        # stockline_stocktype_log for every row the UPDATE changes.
+        # The ignore_duplicate_stockline_types rule only skips rows
+        # that were already in the table before the statement, so
+        # several items of a new stock type going on to the same line
+        # would insert the same row more than once.  Log each new
+        # (stockline, stocktype) pair first so the UPDATE doesn't
+        # need to.  INSERT ... ON CONFLICT can't be used on a table
+        # with INSERT rules; the rule drops pairs that are already
+        # logged.
+        session.execute(
+            StockLineTypeLog.__table__.insert().from_select(
+                ['stocklineid', 'stocktype'],
+                select([lines.c.stocklineid, stock.c.stocktype])
+                .distinct()
+                .where(allocate)))
+        allocated = session.execute(
+            stock.update()
+            .where(allocate)
+            .values(stocklineid=lines.c.stocklineid,
+                    displayqty=used,
+                    onsale=datetime.datetime.now())
+            .returning(stock.c.stockid)).fetchall()
+        allocated = [stockid for stockid, in allocated]
+
+        done = []
+        if allocated:
+            session.execute(
+                StockAnnotation.__table__.insert().from_select(
+                    ['stockid', 'atype', 'text', 'user'],
+                    select([stock.c.stockid,
+                            literal("start"),
+                            lines.c.name + " (auto-allocate)",
+                            literal(user.id if user else None, Integer)])
+                    .where(lines.c.stocklineid == stock.c.stocklineid)
+                    .where(stock.c.stockid.in_(allocated))))
+            done = session.query(cls)\
+                          .filter(cls.id.in_(allocated))\
+                          .options(joinedload('stocktype'),
+                                   joinedload('stockline'))\
+                          .order_by(cls.id)\
+                          .populate_existing()\
+                          .all()
+
+        manual = session.query(cls)\
+                        .join(Delivery)\
+                        .filter(cls.finished == None)\
+                        .filter(cls.stockline == None)\
+                        .filter(Delivery.checked == True)\
+                        .filter(cls.stocktype_id.in_(
+                            select([line_count.c.stocktype])
+                            .where(line_count.c.lines > 1)))\
+                        .options(joinedload('stocktype'))\
+                        .order_by(cls.id)
+        if deliveryid:
+            manual = manual.filter(Delivery.id == deliveryid)
+        manual = manual.all()
+        if manual:
+            choices = {}
+            for line in session.query(StockLine)\
+                               .filter(StockLine.linetype == "display")\
+                               .filter(StockLine.stocktype_id.in_(
+                                   {item.stocktype_id for item in manual}))\
+                               .order_by(StockLine.name):
+                choices.setdefault(line.stocktype_id, []).append(line)
+            manual = [(item, choices[item.stocktype_id]) for item in manual]
+        return done, manual
+
     tillweb_viewname = "tillweb-stock"
     tillweb_argname = "stockid"
 
@@ -2801,6 +3369,98 @@ class StockAnnotation(Base, Logged):
     type = relationship(AnnotationType)
     user = relationship(User, backref=backref("annotations", order_by=time))
 
+    @classmethod
+    def stillage(cls, session):
+        """Query for what is on the stillage
+
+        For each location, the most recent "location" annotation, as
+        long as the stock item it refers to is not finished.  Items
+        that are not on a stock line come first, then items in order
+        of when they were put in their location.
+        """
+        return session.query(cls)\
+                      .join(StockLocation,
+                            StockLocation.annotation_id == cls.id)\
+                      .join(StockItem, StockItem.id == StockLocation.stockid)\
+                      .outerjoin(StockLine)\
+                      .filter(StockItem.finished == None)\
+                      .order_by(StockLine.name != null(), cls.time)
+
+
+class StockLocation(Base):
+    """The most recent "location" annotation for each location
+
+    Maintained by a trigger on stock_annotations, so that finding what
+    is on the stillage doesn't need to look at every location
+    annotation there has ever been.
+    """
+    __tablename__ = 'stock_locations'
+    text = Column(String(), nullable=False, primary_key=True)
+    annotation_id = Column(
+        'annotation', Integer,
+        ForeignKey('stock_annotations.id', ondelete='CASCADE'),
+        nullable=False)
+    stockid = Column(Integer, ForeignKey('stock.stockid', ondelete='CASCADE'),
+                     nullable=False)
+    time = Column(DateTime, nullable=False)
+    annotation = relationship(StockAnnotation)
+    stockitem = relationship(StockItem)
+
+
+# This DDL refers to stock_annotations as well as stock_locations, so
+# it is run after all the tables are created.  That happens every
+# time create_all() is called, so it must be safe to run again.
+add_ddl(metadata, """
+CREATE OR REPLACE FUNCTION update_stock_location(loc text) RETURNS void AS $$
+DECLARE
+  latest record;
+BEGIN
+  SELECT id, stockid, time INTO latest FROM stock_annotations
+    WHERE atype = 'location' AND text = loc
+    ORDER BY time DESC, id DESC
+    LIMIT 1;
+  IF NOT FOUND THEN
+    DELETE FROM stock_locations WHERE text = loc;
+  ELSE
+    -- An upsert rather than DELETE then INSERT, so that two
+    -- transactions annotating the same location at once don't fail
+    -- on the primary key
+    INSERT INTO stock_locations (text, annotation, stockid, time)
+      VALUES (loc, latest.id, latest.stockid, latest.time)
+      ON CONFLICT (text) DO UPDATE
+      SET annotation = EXCLUDED.annotation,
+          stockid = EXCLUDED.stockid,
+          time = EXCLUDED.time;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION stock_annotation_location() RETURNS trigger AS $$
+BEGIN
+  IF (TG_OP = 'UPDATE' OR TG_OP = 'DELETE') AND OLD.atype = 'location' THEN
+    PERFORM update_stock_location(OLD.text);
+  END IF;
+  IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') AND NEW.atype = 'location' THEN
+    PERFORM update_stock_location(NEW.text);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS stock_annotation_location ON stock_annotations;
+CREATE TRIGGER stock_annotation_location
+  AFTER INSERT OR UPDATE OR DELETE ON stock_annotations
+  FOR EACH ROW EXECUTE PROCEDURE stock_annotation_location();
+INSERT INTO stock_locations (text, annotation, stockid, time)
+  SELECT DISTINCT ON (text) text, id, stockid, time
+  FROM stock_annotations
+  WHERE atype = 'location'
+  ORDER BY text, time DESC, id DESC
+  ON CONFLICT (text) DO NOTHING;
+""", """
+DROP TRIGGER IF EXISTS stock_annotation_location ON stock_annotations;
+DROP FUNCTION IF EXISTS stock_annotation_location();
+DROP FUNCTION IF EXISTS update_stock_location(text);
+""")
+
 
 class RemoveCode(Base, Logged):
     __tablename__ = 'stockremove'
@@ -2866,6 +3526,116 @@ DROP FUNCTION notify_stockout_change();
 """)
 
 
+class StockOutDaily(Base):
+    """Total quantity of stock removed each day
+
+    One row per date, stock type and remove code, maintained by
+    triggers on the stockout and stock tables.  Reports that only
+    need daily totals can use this instead of grouping every stockout
+    row in their date range.
+
+    The triggers update one row per stock type and day, so concurrent
+    transactions that use the same stock type on the same day are
+    serialised on that row until they commit.
+
+    The "rebuild-stockout-daily" command recalculates it from the
+    stockout table.
+    """
+    __tablename__ = 'stockout_daily'
+    date = Column(Date, nullable=False, primary_key=True)
+    stocktype_id = Column(
+        'stocktype', Integer,
+        ForeignKey('stocktypes.stocktype', ondelete='CASCADE'),
+        nullable=False, primary_key=True)
+    removecode_id = Column(
+        'removecode', String(8), ForeignKey('stockremove.removecode'),
+        nullable=False, primary_key=True)
+    qty = Column(quantity, nullable=False)
+    stocktype = relationship(StockType)
+    removecode = relationship(RemoveCode)
+
+    @classmethod
+    def rebuild(cls, session, start=None):
+        """Recalculate from the stockout table
+
+        If start is specified, only dates on or after start are
+        recalculated.  Changes to the stockout table are blocked until
+        the session's transaction ends.
+        """
+        session.execute("LOCK TABLE stockout IN SHARE MODE")
+        date = func.date(StockOut.time)
+        q = session.query(cls)
+        sq = select([date, StockItem.stocktype_id, StockOut.removecode_id,
+                     func.sum(StockOut.qty)])\
+            .select_from(StockOut.__table__.join(StockItem.__table__))\
+            .group_by(date, StockItem.stocktype_id, StockOut.removecode_id)
+        if start:
+            q = q.filter(cls.date >= start)
+            sq = sq.where(date >= start)
+        q.delete(synchronize_session=False)
+        session.execute(cls.__table__.insert().from_select(
+            ['date', 'stocktype', 'removecode', 'qty'], sq))
+
+
+# The triggers are on the stockout and stock tables, so this is run
+# after all the tables are created; it must be safe to run again
+# because that happens every time create_all() is called.
+add_ddl(metadata, """
+CREATE OR REPLACE FUNCTION stockout_daily_add(
+  d date, st integer, rc varchar, q numeric) RETURNS void AS $$
+BEGIN
+  INSERT INTO stockout_daily (date, stocktype, removecode, qty)
+    VALUES (d, st, rc, q)
+    ON CONFLICT (date, stocktype, removecode)
+    DO UPDATE SET qty = stockout_daily.qty + EXCLUDED.qty;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION stockout_daily_stockout() RETURNS trigger AS $$
+BEGIN
+  IF (TG_OP = 'UPDATE' OR TG_OP = 'DELETE') THEN
+    PERFORM stockout_daily_add(
+      OLD.time::date, (SELECT stocktype FROM stock WHERE stockid = OLD.stockid),
+      OLD.removecode, -OLD.qty);
+  END IF;
+  IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') THEN
+    PERFORM stockout_daily_add(
+      NEW.time::date, (SELECT stocktype FROM stock WHERE stockid = NEW.stockid),
+      NEW.removecode, NEW.qty);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS stockout_daily ON stockout;
+CREATE TRIGGER stockout_daily
+  AFTER INSERT OR UPDATE OF stockid, qty, removecode, time OR DELETE
+  ON stockout
+  FOR EACH ROW EXECUTE PROCEDURE stockout_daily_stockout();
+CREATE OR REPLACE FUNCTION stockout_daily_stock() RETURNS trigger AS $$
+BEGIN
+  IF NEW.stocktype <> OLD.stocktype THEN
+    PERFORM stockout_daily_add(d, OLD.stocktype, removecode, -q),
+            stockout_daily_add(d, NEW.stocktype, removecode, q)
+      FROM (SELECT time::date AS d, removecode, sum(qty) AS q
+            FROM stockout
+            WHERE stockid = NEW.stockid
+            GROUP BY d, removecode) AS so;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS stockout_daily ON stock;
+CREATE TRIGGER stockout_daily
+  AFTER UPDATE OF stocktype ON stock
+  FOR EACH ROW EXECUTE PROCEDURE stockout_daily_stock();
+""", """
+DROP TRIGGER IF EXISTS stockout_daily ON stock;
+DROP FUNCTION IF EXISTS stockout_daily_stock();
+DROP TRIGGER IF EXISTS stockout_daily ON stockout;
+DROP FUNCTION IF EXISTS stockout_daily_stockout();
+DROP FUNCTION IF EXISTS stockout_daily_add(date, integer, varchar, numeric);
+""")
+
+
 # These are added to the StockItem class here because they refer
 # directly to the StockOut class, defined just above.
 StockItem.used = column_property(
@@ -3486,14 +4256,178 @@ Index('translines_transid_key', Transline.transid)
 Index('payments_transid_key', Payment.transid)
 Index('transactions_sessionid_key', Transaction.sessionid)
 Index('stock_annotations_stockid_key', StockAnnotation.stockid)
+Index('stock_locations_stockid_key', StockLocation.stockid)
 Index('stockout_stockid_key', StockOut.stockid)
 Index('stockout_translineid_key', StockOut.translineid)
 Index('translines_time_key', Transline.time)
 
+Index('translines_user_key', Transline.user_id)
+Index('log_user_key', LogEntry.user_id)
+
+# Used by the trigger that maintains stock_locations
+Index('stock_annotations_location_key',
+      StockAnnotation.text, StockAnnotation.time,
+      postgresql_where=StockAnnotation.atype == 'location')
+
 # The "find free drinks on this day" function is speeded up
 # considerably by an index on stockout.time::date.
 Index('stockout_date_key', func.cast(StockOut.time, Date))
 
+# Searches in the web interface use ILIKE '%term%', which can only use
+# an index if it is a trigram index.  These need the pg_trgm
+# extension, which may not be available or may need a superuser to
+# install it; if it isn't available the indexes are skipped and
+# searches fall back to sequential scans.
+trigram_indexes = [
+    # (index name, table, column)
+    ("transactions_notes_trgm_key", "transactions", "notes"),
+    ("translines_text_trgm_key", "translines", "text"),
+    ("translines_source_trgm_key", "translines", "source"),
+    ("translines_discount_name_trgm_key", "translines", "discount_name"),
+    ("stocktypes_manufacturer_trgm_key", "stocktypes", "manufacturer"),
+    ("stocktypes_name_trgm_key", "stocktypes", "name"),
+    ("suppliers_name_trgm_key", "suppliers", "name"),
+    ("log_source_trgm_key", "log", "source"),
+    ("log_description_trgm_key", "log", "description"),
+]
+
+# The indexes are only created along with their tables, when the
+# tables are empty.  Building one on an existing table blocks writes
+# to it for as long as the build takes, so syncdb doesn't do it; the
+# release notes describe how to add them to an existing database
+# with CREATE INDEX CONCURRENTLY.
+for _table in sorted({table for _, table, _ in trigram_indexes}):
+    add_ddl(metadata.tables[_table], """
+DO $$
+BEGIN
+  CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+  RAISE NOTICE 'pg_trgm extension not available';
+END;
+$$;
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+""" + "".join(f"""    CREATE INDEX {name} ON {table}
+      USING gin ({column} gin_trgm_ops);
+""" for name, table, column in trigram_indexes
+            if table == _table) + """  END IF;
+END;
+$$;
+""", None)
+del _table
+
+
+report_jobs_seq = Sequence('report_jobs_seq')
+
+
+class ReportJob(Base):
+    """A spreadsheet report to be generated by a report worker
+
+    The web interface adds jobs, and "runtill report-worker" processes
+    generate them and store the result.  Jobs with the same report
+    and parameters share a key; a finished job may be used again for
+    a later request with the same key as long as the sessions it
+    covers, and the stock usage and log recorded, are unchanged, as
+    recorded in sessions_version.
+    """
+    __tablename__ = 'report_jobs'
+    id = Column(Integer, report_jobs_seq, nullable=False, primary_key=True)
+    report = Column(String(), nullable=False)
+    params = Column(Text(), nullable=False,
+                    doc="Report parameters, JSON encoded")
+    key = Column(String(), nullable=False,
+                 doc="Hash of report and parameters")
+    sessions_version = Column(
+        String(), nullable=True,
+        doc="Fingerprint of the sessions covered by the report and the "
+        "latest stock usage and log entry; NULL if the result must not "
+        "be reused")
+    state = Column(String(), nullable=False, server_default='pending')
+    created = Column(DateTime, nullable=False,
+                     server_default=func.current_timestamp())
+    started = Column(DateTime, nullable=True)
+    finished = Column(DateTime, nullable=True)
+    worker = Column(String(), nullable=True,
+                    doc="Worker that is generating or generated the report")
+    error = Column(Text(), nullable=True)
+    filename = Column(String(), nullable=True)
+    mimetype = Column(String(), nullable=True)
+    result = deferred(Column(LargeBinary(), nullable=True))
+
+    __table_args__ = (
+        CheckConstraint(
+            "state='pending' OR state='running' OR state='done' "
+            "OR state='failed'",
+            name="report_job_state_constraint"),
+        CheckConstraint(
+            "NOT(state='done') OR result IS NOT NULL",
+            name="report_job_done_has_result"),
+    )
+
+    tillweb_viewname = "tillweb-report-job"
+    tillweb_argname = "jobid"
+
+    @staticmethod
+    def make_key(report, params):
+        return hashlib.sha1(json.dumps(
+            [report, params], sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def fingerprint_sessions(session, start, end):
+        """Fingerprint of the sessions between two dates
+
+        start and end may be None to cover the first or last session.
+        Returns None if any of the sessions (or any session at all
+        when end is None) is still in progress or has no totals
+        recorded, because the data it covers may still change.
+
+        Stock usage and waste can still be recorded or changed after
+        a session has closed, so the latest stock usage record and
+        log entry are included as well.
+        """
+        q = session.query(Session.id, Session.endtime, Session.actual_total)\
+                   .order_by(Session.id)
+        if start:
+            q = q.filter(Session.date >= start)
+        if end:
+            q = q.filter(Session.date <= end)
+        h = hashlib.sha1()
+        for sessionid, endtime, actual_total in q:
+            if endtime is None or actual_total is None:
+                return None
+            h.update(f"{sessionid} {endtime} {actual_total}\n"
+                     .encode("utf-8"))
+        if not end and session.query(Session).filter(
+                Session.endtime == None).count() > 0:
+            return None
+        stockout, log = session.query(
+            select([func.max(StockOut.id)]).as_scalar(),
+            select([func.max(LogEntry.id)]).as_scalar()).one()
+        h.update(f"stockout {stockout} log {log}\n".encode("utf-8"))
+        return h.hexdigest()
+
+
+Index('report_jobs_key', ReportJob.key)
+Index('report_jobs_pending', ReportJob.id,
+      postgresql_where=(ReportJob.state == 'pending'))
+
+add_ddl(ReportJob.__table__, """
+CREATE OR REPLACE FUNCTION notify_report_job() RETURNS trigger AS $$
+DECLARE
+BEGIN
+  PERFORM pg_notify('report_job', CAST(NEW.id AS text));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER report_job_added
+  AFTER INSERT ON report_jobs
+  FOR EACH ROW EXECUTE PROCEDURE notify_report_job();
+""", """
+DROP TRIGGER report_job_added ON report_jobs;
+DROP FUNCTION notify_report_job();
+""")
+
 
 foodorder_seq = Sequence('foodorder_seq', metadata=metadata)
 
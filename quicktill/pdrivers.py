@@ -1,6 +1,15 @@
 import socket
+import select
+import contextlib
 import tempfile
 import io
+import os
+import json
+import base64
+import hashlib
+import itertools
+import threading
+import time
 import textwrap
 import subprocess
 import fcntl
@@ -46,15 +55,77 @@ class PrinterError(Exception):
         return f"PrinterError({self.printer}, '{self.desc}')"
 
 
-def test_ping(host):
-    """Check whether a host is alive using ping; returns True if it is alive.
+def test_connect(connection, family=socket.AF_INET, timeout=2):
+    """Check whether a TCP port is accepting connections.
+
+    Returns None if it is, or a description of the problem if not.
     """
-    with open('/dev/null', 'w') as null:
-        r = subprocess.call("ping -q -w 2 -c 1 %s" % host,
-                            shell=True, stdout=null, stderr=null)
-    if r == 0:
-        return True
-    return False
+    try:
+        with socket.socket(family) as s:
+            s.settimeout(timeout)
+            s.connect(connection)
+    except OSError as e:
+        return f"Could not connect to {connection[0]} port {connection[1]}: " \
+            f"{e.strerror or e}"
+
+
+class _reachability:
+    """Cached reachability of network printers
+
+    A background thread probes each watched (connection, family) pair
+    every "interval" seconds using test_connect().  Results older than
+    "ttl" seconds are treated as unknown, so that a stalled poller
+    doesn't cause a printer to be reported offline forever.
+    """
+    interval = 10
+    ttl = 30
+    timeout = 2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._targets = set()
+        # key is (connection, family), value is (time, problem)
+        self._status = {}
+        self._thread = None
+
+    def watch(self, connection, family):
+        key = (connection, family)
+        if key in self._targets:
+            return
+        with self._lock:
+            self._targets.add(key)
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="printer status poller",
+                    daemon=True)
+                self._thread.start()
+
+    def unwatch(self, connection, family):
+        with self._lock:
+            self._targets.discard((connection, family))
+
+    def get(self, connection, family):
+        """Return the cached problem for a connection, or None
+        """
+        checked, problem = self._status.get(
+            (connection, family), (None, None))
+        if checked and time.monotonic() - checked < self.ttl:
+            return problem
+
+    def set(self, connection, family, problem):
+        self._status[(connection, family)] = (time.monotonic(), problem)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                targets = list(self._targets)
+            for connection, family in targets:
+                self.set(connection, family, test_connect(
+                    connection, family, timeout=self.timeout))
+            time.sleep(self.interval)
+
+
+_netstatus = _reachability()
 
 
 def _lrwrap(l, r, width):
@@ -184,6 +255,12 @@ class printer:
     def canvastype(self):
         return self._driver.canvastype
 
+    @property
+    def driver(self):
+        """The driver used to render canvases for this printer
+        """
+        return self._driver
+
     def get_canvas(self):
         return self._driver.get_canvas()
 
@@ -427,11 +504,28 @@ class autodetect_printer:
 
 class netprinter(printer):
     """Print to a network socket.  connection is a (hostname, port) tuple.
+
+    timeout is the number of seconds to wait for the printer to accept
+    a connection or data before giving up.
+
+    If persistent is True, the connection to the printer is kept open
+    between jobs with TCP keepalive enabled, so that jobs sent in quick
+    succession (for example by a spoolprinter that has a queue to
+    drain) go straight down the existing connection.  The connection
+    is checked before each job and by offline(), and is re-established
+    automatically if the printer has dropped it.  Use this for printers
+    that accept only one connection at a time with care: while the
+    connection is open, no other till will be able to print to it.
     """
     def __init__(self, connection, driver, description=None,
-                 family=socket.AF_INET):
+                 family=socket.AF_INET, timeout=10, persistent=False):
         self._connection = connection
         self._family = family
+        self._timeout = timeout
+        self._persistent = persistent
+        # (socket, file) while a persistent connection is open
+        self._conn = None
+        self._conn_lock = threading.Lock()
         super().__init__(driver, description=description)
 
     def __str__(self):
@@ -442,39 +536,128 @@ class netprinter(printer):
 
         If the printer is unavailable for any reason, return a description
         of that reason; otherwise return None.
+
+        This reports the status cached by a background poller, or the
+        state of the persistent connection if there is one, so it
+        never waits for the network.  Until the printer has been
+        polled for the first time it is assumed to be available.
         """
-        host = self._connection[0]
-        if not test_ping(host):
-            return f"Printer {host} did not respond to ping"
+        problem = _netstatus.get(self._connection, self._family)
+        if problem:
+            return problem
+        if self._persistent:
+            if not self._conn_lock.acquire(blocking=False):
+                # A job is being sent right now
+                return
+            try:
+                if self._conn:
+                    return self._check_connection()
+            finally:
+                self._conn_lock.release()
+        _netstatus.watch(self._connection, self._family)
+        return _netstatus.get(self._connection, self._family)
 
     def _connect(self):
         s = socket.socket(self._family)
-        s.connect(self._connection)
+        s.settimeout(self._timeout)
+        if self._persistent:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        try:
+            s.connect(self._connection)
+        except OSError as e:
+            s.close()
+            problem = f"Could not connect to {self._connection[0]} " \
+                f"port {self._connection[1]}: {e.strerror or e}"
+            _netstatus.set(self._connection, self._family, problem)
+            raise PrinterError(self, problem)
+        _netstatus.set(self._connection, self._family, None)
         f = s.makefile('wb')
         return s, f
 
-    # XXX there's too much copy-and-paste here for my liking
-    def print_canvas(self, canvas):
-        offline = self.offline()
-        if offline:
-            raise PrinterError(self, offline)
-        s, f = self._connect()
+    def _disconnect(self):
+        s, f = self._conn
+        self._conn = None
         try:
-            self._driver.process_canvas(canvas, f)
-        finally:
             f.close()
-            s.close()
+        except OSError:
+            pass
+        s.close()
+        # Go back to polling now we are no longer connected
+        _netstatus.watch(self._connection, self._family)
 
-    def kickout(self):
-        offline = self.offline()
-        if offline:
-            raise PrinterError(self, offline)
-        s, f = self._connect()
+    def _check_connection(self):
+        """Check the persistent connection without blocking.
+
+        Discards anything the printer has sent us.  If the connection
+        has failed, closes it and returns a description of the
+        problem; otherwise returns None.  Must be called with
+        _conn_lock held.
+        """
+        s = self._conn[0]
         try:
+            while select.select([s], [], [], 0)[0]:
+                if not s.recv(4096):
+                    problem = "Printer closed the connection"
+                    break
+            else:
+                return
+        except OSError as e:
+            problem = str(e)
+        log.info("%s: persistent connection failed: %s", self, problem)
+        self._disconnect()
+        return problem
+
+    @contextlib.contextmanager
+    def _connection_file(self):
+        """Open a connection to the printer and yield a file to write to
+        """
+        if not self._persistent:
+            s, f = self._connect()
+            try:
+                yield f
+            finally:
+                f.close()
+                s.close()
+            return
+        with self._conn_lock:
+            if self._conn:
+                self._check_connection()
+            if not self._conn:
+                self._conn = self._connect()
+                # The connection itself tells us whether the printer
+                # is there; a poller connection might be refused
+                _netstatus.unwatch(self._connection, self._family)
+            try:
+                yield self._conn[1]
+                self._conn[1].flush()
+            except OSError as e:
+                self._disconnect()
+                raise PrinterError(self, str(e))
+
+    def _check_reachable(self):
+        # A persistent connection that the printer has dropped is
+        # re-established by _connection_file(), so only the cached
+        # reachability of the printer stops a job here
+        if self._persistent:
+            problem = _netstatus.get(self._connection, self._family)
+        else:
+            problem = self.offline()
+        if problem:
+            raise PrinterError(self, problem)
+
+    def print_canvas(self, canvas):
+        self._check_reachable()
+        with self._connection_file() as f:
+            self._driver.process_canvas(canvas, f)
+
+    def kickout(self):
+        self._check_reachable()
+        with self._connection_file() as f:
             self._driver.kickout(f)
-        finally:
-            f.close()
-            s.close()
 
 
 class tmpfileprinter(printer):
@@ -572,6 +755,181 @@ class cupsprinter(printer):
         f.close()
 
 
+class spoolprinter(printer):
+    """Spool output for another printer to disk and print it in the background.
+
+    Canvases are serialised to files in spooldir and returned to the
+    caller immediately; a background thread sends them to the
+    underlying printer in order, retrying with exponential backoff if
+    the printer reports an error.  Jobs left in the spool directory
+    when the till exits are printed next time it starts.
+
+    Only printers that offer receipt canvases can be spooled.  Note
+    that once a job has been spooled, errors are reported through
+    offline() rather than by raising PrinterError.
+    """
+    jobsuffix = ".job"
+    min_backoff = 1
+    max_backoff = 60
+
+    def __init__(self, spooldir, printer, description=None):
+        if printer.canvastype != "receipt":
+            raise PrinterConfigurationError(
+                "spoolprinter can only be used with printers that offer "
+                "receipt canvases")
+        self._spooldir = spooldir
+        self._printer = printer
+        self.description = description
+        self._canvas = None
+        self._lock = threading.Condition()
+        self._worker = None
+        self._pending = 0
+        self._problem = None
+        self._sequence = 0
+
+    def __str__(self):
+        return self.description or f"Spool to {self._spooldir} for " \
+            f"{self._printer}"
+
+    @property
+    def canvastype(self):
+        return self._printer.canvastype
+
+    def get_canvas(self):
+        return self._printer.get_canvas()
+
+    def _ensure_worker(self):
+        if self._worker:
+            return
+        os.makedirs(self._spooldir, exist_ok=True)
+        self._pending = len(self._jobs())
+        self._worker = threading.Thread(
+            target=self._run, name=f"spool {self._spooldir}", daemon=True)
+        self._worker.start()
+
+    def _jobs(self):
+        return sorted(f for f in os.listdir(self._spooldir)
+                      if f.endswith(self.jobsuffix))
+
+    def _spool(self, job):
+        self._ensure_worker()
+        with self._lock:
+            self._sequence += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-" \
+                f"{self._sequence:06d}"
+            tmpname = os.path.join(self._spooldir, name + ".tmp")
+            with open(tmpname, 'w') as f:
+                json.dump(job, f)
+            os.rename(tmpname, os.path.join(
+                self._spooldir, name + self.jobsuffix))
+            self._pending += 1
+            self._lock.notify()
+
+    def offline(self):
+        """Is the printer available?
+
+        Reports a problem only when spooled jobs are waiting because
+        the underlying printer failed; this does not contact the printer.
+        """
+        self._ensure_worker()
+        with self._lock:
+            if self._problem and self._pending:
+                return f"{self._pending} spooled job(s) waiting: " \
+                    f"{self._problem}"
+
+    def print_canvas(self, canvas):
+        self._spool({'job': 'canvas',
+                     'story': _story_to_json(canvas.get_story())})
+
+    def kickout(self):
+        self._spool({'job': 'kickout'})
+
+    def _process(self, path):
+        with open(path) as f:
+            job = json.load(f)
+        if job['job'] == 'kickout':
+            self._printer.kickout()
+        else:
+            canvas = self._printer.get_canvas()
+            canvas.set_story(_story_from_json(job['story']))
+            self._printer.print_canvas(canvas)
+
+    def _run(self):
+        backoff = self.min_backoff
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+            jobs = self._jobs()
+            if not jobs:
+                with self._lock:
+                    self._pending = 0
+                continue
+            path = os.path.join(self._spooldir, jobs[0])
+            try:
+                self._process(path)
+            except (PrinterError, OSError) as e:
+                problem = e.desc if isinstance(e, PrinterError) else str(e)
+                log.info("%s: job %s failed, retrying in %ss: %s",
+                         self, jobs[0], backoff, problem)
+                with self._lock:
+                    self._problem = problem
+                    self._lock.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            except Exception:
+                # The job is unprintable: keep it for inspection but
+                # don't let it block the queue
+                log.exception("%s: discarding job %s", self, jobs[0])
+                os.rename(path, path + ".bad")
+            else:
+                os.unlink(path)
+            backoff = self.min_backoff
+            with self._lock:
+                self._problem = None
+                self._pending = max(self._pending - 1, 0)
+
+
+def _story_to_json(story):
+    """Convert a receipt canvas story to a JSON-compatible list
+    """
+    r = []
+    for i in story:
+        if isinstance(i, TextElement):
+            r.append({'type': 'text', **vars(i)})
+        elif isinstance(i, QRCodeElement):
+            r.append({'type': 'qrcode', 'data': i.qrcode_data})
+        elif isinstance(i, ImageElement):
+            r.append({'type': 'image', 'data': base64.b64encode(
+                i.image_data.getvalue()).decode('ascii')})
+        else:
+            r.append({'type': 'blank'})
+    return r
+
+
+def _story_from_json(story):
+    """Convert the output of _story_to_json() back to a story
+    """
+    r = []
+    for i in story:
+        i = dict(i)
+        t = i.pop('type')
+        if t == 'text':
+            r.append(TextElement(**i))
+        elif t == 'qrcode':
+            r.append(QRCodeElement(i['data']))
+        elif t == 'image':
+            r.append(ImageElement(base64.b64decode(i['data'])))
+        else:
+            r.append(ReceiptElement())
+    return r
+
+
+# Maps (upper module << 1 | lower module) to the pins to fire when
+# printing emulated QR codes
+_qrcode_pin_table = bytes([0x00, 0x1c, 0xe0, 0xfc]) + bytes(252)
+
+
 class escpos:
     """The ESC/POS protocol for controlling receipt printers.
     """
@@ -708,7 +1066,28 @@ class escpos:
                 f.write(escpos.ep_fullcut)
             f.flush()
 
+    # Rendered images, keyed by (dots per line, image hash); values
+    # are the ESC/POS commands to print the image
+    _image_cache = {}
+    _image_cache_size = 16
+
+    @classmethod
+    def clear_image_cache(cls):
+        cls._image_cache.clear()
+
     def _image(self, image, f):
+        key = (self.dpl, hashlib.sha256(image.getvalue()).digest())
+        rendered = self._image_cache.get(key)
+        if rendered is None:
+            out = io.BytesIO()
+            self._render_image(image, out)
+            rendered = out.getvalue()
+            if len(self._image_cache) >= self._image_cache_size:
+                self._image_cache.clear()
+            self._image_cache[key] = rendered
+        f.write(rendered)
+
+    def _render_image(self, image, f):
         try:
             image = Image.open(image)
         except Exception:
@@ -745,28 +1124,22 @@ class escpos:
         # Update width and height from padded image
         width, height = primg.size
 
-        # data is an iterator yielding pixel values, 0 for white and
-        # 255 for black
-        data = iter(primg.getdata())
-
         # Set up printer for image output
         f.write(escpos.ep_line_spacing_none)
         f.write(escpos.ep_unidirectional_on)
         width_info = width.to_bytes(length=2, byteorder="little")
 
-        # Process image as rows of 24 lines each
-        def _readline():
-            return [bool(next(data)) for _ in range(width)]
-        try:
-            while True:
-                lines = [_readline() for _ in range(24)]
-                row = b''.join(
-                    int(''.join("1" if bit else "0" for bit in column),
-                        base=2).to_bytes(length=3, byteorder="big")
-                    for column in zip(*lines))
-                f.write(escpos.ep_bitimage_dd_v24 + width_info + row + b'\n')
-        except StopIteration:
-            pass
+        # Process image as bands of 24 lines each.  Each column of a
+        # band is sent as three bytes, top dot in the most significant
+        # bit.  Transposing the band turns its columns into rows of
+        # exactly 24 pixels, and a mode "1" image packs each row into
+        # bytes in that order (set bits are black after the invert
+        # above) so tobytes() gives us the band's data directly.
+        for top in range(0, height, 24):
+            row = primg.crop((0, top, width, top + 24))\
+                       .transpose(Image.TRANSPOSE)\
+                       .tobytes()
+            f.write(escpos.ep_bitimage_dd_v24 + width_info + row + b'\n')
 
         # Restore regular output settings and make a small gap
         f.write(escpos.ep_unidirectional_off)
@@ -847,7 +1220,9 @@ class escpos:
         q = qrcode.QRCode(border=2,
                           error_correction=qrcode.constants.ERROR_CORRECT_H)
         q.add_data(data)
-        code = q.get_matrix()
+        self._qrcode_matrix(q.get_matrix(), f)
+
+    def _qrcode_matrix(self, code, f):
         f.write(escpos.ep_unidirectional_on)
         # To get a good print, we print two rows at a time - but only
         # feed the paper through by one row.  This means that each
@@ -855,28 +1230,33 @@ class escpos:
         # printing each pair of rows twice, advancing the paper by
         # half a dot inbetween.  We only use 6 of the 8 pins of the
         # printer to keep this code simple.
-        lt = {
-            (False, False): bytes([0x00]),
-            (False, True): bytes([0x1c]),
-            (True, False): bytes([0xe0]),
-            (True, True): bytes([0xfc]),
-        }
-        while len(code) > 0:
-            if len(code) > 1:
-                row = zip(code[0], code[1])
-            else:
-                row = zip(code[0], [False] * len(code[0]))
-            code = code[1:]
-            row = b''.join(lt[x] * 3 for x in row)
-            width = len(row)
-            if width > self.dpl:
-                # Code too wide for paper
-                break
-            padding = (self.dpl - width) // 2
-            width = width + padding
-            padchars = bytes([0]) * padding
-            header = escpos.ep_bitimage_sd \
-                + bytes([width & 0xff, (width >> 8) & 0xff])
+        # Each pair of modules (upper, lower) becomes a byte with the
+        # top three pins set for the upper module and the next three
+        # for the lower one.  Modules are three dots wide.
+        rows = len(code)
+        modules = len(code[0]) if rows else 0
+        width = modules * 3
+        if width > self.dpl:
+            # Code too wide for paper
+            f.write(escpos.ep_unidirectional_off)
+            return
+        # One byte per dot, 0 or 1, for every row of the code plus a
+        # blank row to pair with the last one
+        dots = Image.frombytes(
+            "L", (modules, rows + 1),
+            bytes(itertools.chain.from_iterable(code))
+            + bytes(modules)).resize((width, rows + 1), Image.NEAREST)\
+            .tobytes()
+        lines = [int.from_bytes(dots[i:i + width], "big")
+                 for i in range(0, len(dots), width)]
+        padding = (self.dpl - width) // 2
+        header = escpos.ep_bitimage_sd \
+            + (width + padding).to_bytes(length=2, byteorder="little")
+        padchars = bytes(padding)
+        for upper, lower in zip(lines, lines[1:]):
+            # No carries are possible: every byte is 0-3 at most
+            row = ((upper << 1) | lower).to_bytes(width, "big")\
+                                        .translate(_qrcode_pin_table)
             f.write(header + padchars + row + b'\r')
             f.write(escpos.ep_half_dot_feed)
             f.write(header + padchars + row + b'\r')
@@ -1111,6 +1491,17 @@ class Canvas(canvas.Canvas):
         self._doc.SaveToFile(filename, self)
 
 
+class RenderedDocument:
+    """A document that has already been rendered by a PDF driver
+
+    May be passed to the print_canvas() method of a printer using a
+    driver that offers a PDF canvas in place of a canvas; the data is
+    sent to the printer unchanged.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
 class pdf_page:
     """PDF driver that offers a PDF canvas
 
@@ -1130,6 +1521,9 @@ class pdf_page:
         return canvas
 
     def process_canvas(self, canvas, f):
+        if isinstance(canvas, RenderedDocument):
+            f.write(canvas.data)
+            return
         canvas.save(filename=f)
 
 
@@ -1224,5 +1618,12 @@ class pdf_labelpage:
         canvas.setAuthor("quicktill")
         return canvas
 
+    @property
+    def labels_per_page(self):
+        return len(self.ll)
+
     def process_canvas(self, canvas, f):
+        if isinstance(canvas, RenderedDocument):
+            f.write(canvas.data)
+            return
         canvas._end(f)
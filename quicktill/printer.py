@@ -1,11 +1,14 @@
 import base64
+import io
+import concurrent.futures
 
 from . import td, ui, tillconfig, payment
 from decimal import Decimal
-from .models import Delivery, VatBand, Business, Transaction, PayType
+from .models import Delivery, VatCache, Transaction, PayType
 from .models import penny, Session
 from . import pdrivers
 from . import config
+from reportlab.pdfbase.pdfmetrics import stringWidth
 
 import datetime
 now = datetime.datetime.now
@@ -15,6 +18,28 @@ checkdigit_print = config.BooleanConfigItem(
     'core:checkdigit_print', False, display_name="Print check digits?",
     description="Should check digits be printed on stock labels?")
 
+# The decoded logo image, cached until core:sitelogo changes
+_logo = None
+
+
+def _publogo_changed():
+    global _logo
+    _logo = None
+    pdrivers.escpos.clear_image_cache()
+
+
+tillconfig.publogo.notify_on_change(_publogo_changed)
+
+
+def _publogo():
+    """Return the site logo image, or None if there isn't one
+    """
+    global _logo
+    if _logo is None:
+        logo = tillconfig.publogo()
+        _logo = base64.b64decode(logo) if logo else b''
+    return _logo or None
+
 
 # All of these functions assume there's a database session in td.s
 # This should be the case if called during a keypress!  If being used
@@ -27,9 +52,9 @@ def print_receipt(printer, transid):
     if not trans.lines:
         return
     with printer as d:
-        if tillconfig.publogo():
-            image = base64.b64decode(tillconfig.publogo())
-            d.printimage(image)
+        logo = _publogo()
+        if logo:
+            d.printimage(logo)
         d.printline(f"\t{tillconfig.pubname}", emph=1)
         for i in tillconfig.pubaddr().splitlines():
             d.printline(f"\t{i}", colour=1)
@@ -68,13 +93,12 @@ def print_receipt(printer, transid):
             # amount, VAT and total.
 
             # Keys are business IDs, values are (band,rate) tuples
+            vatcache = VatCache.get(td.s)
             businesses = {}
             for i in list(bandtotals.keys()):
-                vr = td.s.query(VatBand).get(i).at(trans.session.date)
-                businesses.setdefault(vr.business.id, []).append((i, vr.rate))
-            for i in list(businesses.keys()):
-                business = td.s.query(Business).get(i)
-                bands = businesses[i]
+                vr = vatcache.at(i, trans.session.date)
+                businesses.setdefault(vr.business, []).append((i, vr.rate))
+            for business, bands in businesses.items():
                 # Print the business info
                 d.printline(f"\t{business.name}")
                 # The business address may be stored in the database
@@ -260,43 +284,120 @@ def print_delivery_checklist(printer, dn):
         p.printline()
 
 
-def stock_label(f, d):
-    """Draw a stock label (d) on a PDF canvas (f). d is a Stock instance
+_label_fontname = "Times-Roman"
+_label_fontsize = 12
+_label_margin = 12
+
+# Use a process pool (if configured in tillconfig.label_processes) to
+# render batches of at least this many stock labels
+label_pool_threshold = 100
+
+
+def _stock_label_data(d, width, print_checkdigits, titles):
+    """Collect the text to be printed on a stock label
+
+    Returns a tuple of plain values so that the label can be drawn
+    without access to the database, possibly in another process.
+    titles is a dict used to remember the stock type description that
+    fits the label for each stock type.
+    """
+    title = titles.get(d.stocktype.id)
+    if title is None:
+        title = d.stocktype.format()
+        while len(title) > 10:
+            sw = stringWidth(title, _label_fontname, _label_fontsize)
+            if sw < (width - (2 * _label_margin)):
+                break
+            title = d.stocktype.format(len(title) - 1)
+        titles[d.stocktype.id] = title
+    return (title, d.delivery.supplier.name, ui.formatdate(d.delivery.date),
+            d.description,
+            f"Check digits: {d.checkdigits}" if print_checkdigits else None,
+            str(d.id))
+
+
+def _draw_stock_label(f, label):
+    """Draw a stock label on a PDF canvas from _stock_label_data()
     """
     width, height = f.getPageSize()
-    fontsize = 12
-    margin = 12
-    pitch = fontsize + 2
-    fontname = "Times-Roman"
-    f.setFont(fontname, fontsize)
-
-    def fits(s):
-        sw = f.stringWidth(s, fontname, fontsize)
-        return sw < (width - (2 * margin))
-
-    s = d.stocktype.format()
-    while len(s) > 10:
-        sw = f.stringWidth(s, fontname, fontsize)
-        if sw < (width - (2 * margin)):
-            break
-        s = d.stocktype.format(len(s) - 1)
-
-    y = height - margin - fontsize
-    f.drawCentredString(width / 2, y, s)
-    y = y - pitch
-    f.drawCentredString(width / 2, y, d.delivery.supplier.name)
-    y = y - pitch
-    f.drawCentredString(width / 2, y, ui.formatdate(d.delivery.date))
-    y = y - pitch
-    f.drawCentredString(width / 2, y, d.description)
-    if checkdigit_print():
-        y = y - pitch
-        f.drawCentredString(width / 2, y, f"Check digits: {d.checkdigits}")
-    f.setFont(fontname, y - margin)
-    f.drawCentredString(width / 2, margin, str(d.id))
+    pitch = _label_fontsize + 2
+    f.setFont(_label_fontname, _label_fontsize)
+    y = height - _label_margin - _label_fontsize
+    for line in label[:-1]:
+        if line is not None:
+            f.drawCentredString(width / 2, y, line)
+            y = y - pitch
+    y = y + pitch
+    f.setFont(_label_fontname, y - _label_margin)
+    f.drawCentredString(width / 2, _label_margin, label[-1])
     f.showPage()
 
 
+def stock_label(f, d):
+    """Draw a stock label (d) on a PDF canvas (f). d is a Stock instance
+    """
+    width = f.getPageSize()[0]
+    _draw_stock_label(f, _stock_label_data(d, width, checkdigit_print(), {}))
+
+
+def stock_labels(f, items):
+    """Draw stock labels for a list of Stock instances on a PDF canvas
+    """
+    width = f.getPageSize()[0]
+    print_checkdigits = checkdigit_print()
+    titles = {}
+    for d in items:
+        _draw_stock_label(
+            f, _stock_label_data(d, width, print_checkdigits, titles))
+
+
+def _render_stock_labels(driver, labels):
+    """Render a list of labels to a document using a printer driver
+
+    Called in worker processes by print_stock_labels()
+    """
+    f = driver.get_canvas()
+    for label in labels:
+        _draw_stock_label(f, label)
+    out = io.BytesIO()
+    driver.process_canvas(f, out)
+    return out.getvalue()
+
+
+def print_stock_labels(label_printer, items):
+    """Print stock labels for a list of Stock instances
+
+    Items should be loaded with their stock types; the delivery and
+    supplier of each item are also used.  The labels are output as a
+    single document.  If tillconfig.label_processes is set and there
+    are many labels, they are rendered by a pool of processes in
+    chunks of whole pages, and each chunk is sent to the printer as a
+    separate job in order.  Printers that don't have a single driver,
+    such as autodetect_printer, always use a single document.
+    """
+    processes = tillconfig.label_processes
+    driver = getattr(label_printer, 'driver', None)
+    if not processes or not driver or len(items) < label_pool_threshold:
+        with label_printer as f:
+            stock_labels(f, items)
+        return
+    width = driver.get_canvas().getPageSize()[0]
+    print_checkdigits = checkdigit_print()
+    titles = {}
+    labels = [_stock_label_data(d, width, print_checkdigits, titles)
+              for d in items]
+    per_page = getattr(driver, 'labels_per_page', 1)
+    pages = -(-len(labels) // per_page)
+    chunksize = -(-pages // processes) * per_page
+    chunks = [labels[i:i + chunksize]
+              for i in range(0, len(labels), chunksize)]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes) as executor:
+        for document in executor.map(
+                _render_stock_labels, [driver] * len(chunks), chunks):
+            label_printer.print_canvas(pdrivers.RenderedDocument(document))
+
+
 def print_restock_list(printer, rl):
     """
     Print a list of (stockline,stockmovement) tuples.
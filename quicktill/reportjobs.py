@@ -0,0 +1,187 @@
+"""Generate spreadsheet reports for the web interface in the background
+
+The web interface adds a ReportJob to the database and shows a page
+that waits for it to finish.  One or more "report-worker" processes,
+on any host that can reach the database, claim pending jobs and store
+the finished spreadsheet in the job.
+"""
+
+from .cmdline import command
+from . import td
+from . import event
+from . import listen
+from .models import ReportJob
+from sqlalchemy.sql import and_, or_, func
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import socket
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def enqueue(session, report, params, start=None, end=None):
+    """Find or add a job for a report covering sessions start to end
+
+    A pending or running job with the same report and parameters is
+    returned instead of adding a new one, as is a finished job as long
+    as the sessions it covers haven't changed, and no stock usage or
+    log entries have been recorded, since it was added.
+    """
+    key = ReportJob.make_key(report, params)
+    version = ReportJob.fingerprint_sessions(session, start, end)
+    q = session.query(ReportJob)\
+               .filter(ReportJob.key == key)\
+               .order_by(ReportJob.id.desc())
+    if version:
+        q = q.filter(or_(
+            ReportJob.state.in_(["pending", "running"]),
+            and_(ReportJob.state == "done",
+                 ReportJob.sessions_version == version)))
+    else:
+        q = q.filter(ReportJob.state == "pending")
+    job = q.first()
+    if job:
+        return job
+    job = ReportJob(report=report, params=json.dumps(params), key=key,
+                    sessions_version=version)
+    session.add(job)
+    session.flush()
+    return job
+
+
+class _worker:
+    def __init__(self, name, timeout, keep):
+        self.name = name
+        self.timeout = timeout
+        self.keep = keep
+
+    def claim(self):
+        """Claim the oldest pending job
+
+        Jobs left running for longer than the timeout are assumed to
+        belong to a worker that has died, and are claimed again.
+        """
+        with td.orm_session():
+            job = td.s.query(ReportJob)\
+                      .filter(or_(
+                          ReportJob.state == "pending",
+                          and_(ReportJob.state == "running",
+                               ReportJob.started < func.now() - self.timeout)))\
+                      .order_by(ReportJob.id)\
+                      .with_for_update(skip_locked=True)\
+                      .first()
+            if not job:
+                return
+            job.state = "running"
+            job.started = func.now()
+            job.worker = self.name
+            return job.id
+
+    def run_job(self, jobid):
+        # The spreadsheets module needs django and odfpy, and uses
+        # the web interface's session
+        from .tillweb import spreadsheets
+        from .tillweb.db import td as tillweb_td
+        log.info("%s: starting job %d", self.name, jobid)
+        try:
+            with td.orm_session():
+                tillweb_td.s = td.s
+                job = td.s.query(ReportJob).get(jobid)
+                doc = spreadsheets.report_document(
+                    job.report, json.loads(job.params))
+                f = io.BytesIO()
+                doc.write(f)
+                job.result = f.getvalue()
+                job.filename = doc.filename
+                job.mimetype = doc.mimetype
+                job.state = "done"
+                job.finished = func.now()
+            log.info("%s: finished job %d", self.name, jobid)
+        except Exception as e:
+            log.exception("%s: job %d failed", self.name, jobid)
+            with td.orm_session():
+                job = td.s.query(ReportJob).get(jobid)
+                job.state = "failed"
+                job.error = str(e)
+                job.finished = func.now()
+        finally:
+            tillweb_td.s = None
+
+    def expire(self):
+        """Delete jobs that finished more than the keep time ago"""
+        with td.orm_session():
+            td.s.query(ReportJob)\
+                .filter(ReportJob.finished < func.now() - self.keep)\
+                .delete(synchronize_session=False)
+
+    def run(self):
+        mainloop = event.SelectorsMainLoop()
+        listener = listen.db_listener(mainloop, td.engine)
+        listener.listen_for("report_job", lambda payload: None)
+
+        def check_timeouts():
+            self.expire()
+            mainloop.add_timeout(60, check_timeouts, "report job expiry")
+        check_timeouts()
+
+        while True:
+            jobid = self.claim()
+            while jobid:
+                self.run_job(jobid)
+                jobid = self.claim()
+            # Wait for a notification that a job has been added or
+            # for the next check of timed-out jobs
+            mainloop.iterate()
+
+
+def _run_worker(name, timeout, keep):
+    # Each process needs its own database connections
+    td.engine.dispose()
+    _worker(name, timeout, keep).run()
+
+
+class report_worker(command):
+    """Generate spreadsheet reports queued by the web interface.
+
+    Requires django and odfpy.  Several workers may be run at once,
+    either as separate commands on the same or other hosts or using
+    the --processes option.
+    """
+    command = "report-worker"
+    help = "generate reports queued by the web interface"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "-p", "--processes", type=int, default=1,
+            help="number of worker processes to run (default 1)")
+        parser.add_argument(
+            "--timeout", type=int, default=3600,
+            help="seconds after which a running job is assumed to have "
+            "been abandoned, and is started again (default 3600)")
+        parser.add_argument(
+            "--keep", type=int, default=7,
+            help="days to keep finished jobs (default 7)")
+
+    @staticmethod
+    def run(args):
+        # Check that reports can be generated before starting workers
+        from .tillweb import spreadsheets  # noqa: F401
+        timeout = datetime.timedelta(seconds=args.timeout)
+        keep = datetime.timedelta(days=args.keep)
+        basename = f"{socket.gethostname()}:{os.getpid()}"
+        if args.processes <= 1:
+            _worker(basename, timeout, keep).run()
+            return
+        processes = [
+            multiprocessing.Process(
+                target=_run_worker, args=(f"{basename}/{n}", timeout, keep))
+            for n in range(args.processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
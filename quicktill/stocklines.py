@@ -3,8 +3,8 @@ from . import keyboard, ui, td, printer, user, linekeys, modifiers
 from . import stocktype
 from . import tillconfig
 from .models import Department, StockLine, KeyboardBinding
-from .models import StockType, StockLineTypeLog
-from sqlalchemy.sql import select
+from .models import StockType, StockLineTypeLog, StockItem
+from sqlalchemy.sql import select, case
 from sqlalchemy.exc import IntegrityError
 from decimal import Decimal
 log = logging.getLogger(__name__)
@@ -14,12 +14,9 @@ def restock_list(stockline_list):
     # Print out list of things to fetch and put on display
     # Display prompt: have you fetched them all?
     # If yes, update records.  If no, don't.
-    sl = []
     for i in stockline_list:
         td.s.add(i)
-        r = i.calculate_restock()
-        if len(r) > 0:
-            sl.append((i, r))
+    sl = StockLine.plan_restock(td.s, stockline_list)
     if sl == []:
         ui.infopopup(["There is no stock to be put on display."],
                      title="Stock movement")
@@ -50,13 +47,25 @@ def abandon_restock(sl):
 
 
 def finish_restock(rsl):
+    items = []
+    displayqty = {}
     for stockline, stockmovement in rsl:
         td.s.add(stockline)
         for sos, move, newdisplayqty, instock_after_move in stockmovement:
             td.s.add(sos)
-            sos.displayqty = newdisplayqty
-    user.log("Finished restock")
+            items.append(sos)
+            displayqty[sos.id] = newdisplayqty
     td.s.flush()
+    if displayqty:
+        # Record all the movements with a single statement
+        stock = StockItem.__table__
+        td.s.execute(
+            stock.update()
+            .where(stock.c.stockid.in_(list(displayqty)))
+            .values(displayqty=case(displayqty, value=stock.c.stockid)))
+        for sos in items:
+            td.s.expire(sos, ['displayqty'])
+    user.log("Finished restock")
     ui.infopopup(["The till has recorded all the stock movements "
                   "in the list."], title="Stock movement confirmed",
                  colour=ui.colour_info, dismiss=keyboard.K_CASH)
@@ -3,9 +3,7 @@
 import logging
 from . import ui, td, keyboard, usestock, stocklines, user, tillconfig
 from .user import load_user
-from .models import StockLine, StockAnnotation, StockItem
-from sqlalchemy.sql.expression import tuple_, func, null
-from sqlalchemy.sql import select
+from .models import StockLine, StockAnnotation
 from sqlalchemy.orm import joinedload, undefer_group
 log = logging.getLogger(__name__)
 
@@ -72,21 +70,11 @@ class page(ui.basicpage):
                 break
 
     def drawstillage(self, h):
-        sl = td.s.query(StockAnnotation)\
-                 .join(StockItem)\
-                 .outerjoin(StockLine)\
-                 .filter(
-                     tuple_(StockAnnotation.text, StockAnnotation.time).in_(
-                         select([StockAnnotation.text,
-                                 func.max(StockAnnotation.time)],
-                                StockAnnotation.atype == 'location')
-                         .group_by(StockAnnotation.text)))\
-                 .filter(StockItem.finished == None)\
-                 .order_by(StockLine.name != null(), StockAnnotation.time)\
-                 .options(joinedload('stockitem'))\
-                 .options(joinedload('stockitem.stocktype'))\
-                 .options(joinedload('stockitem.stockline'))\
-                 .all()
+        sl = StockAnnotation.stillage(td.s)\
+            .options(joinedload('stockitem'))\
+            .options(joinedload('stockitem.stocktype'))\
+            .options(joinedload('stockitem.stockline'))\
+            .all()
         if not sl:
             return self.drawlines(h)
         f = ui.tableformatter('pl l c L c lp')
@@ -1,4 +1,6 @@
 from . import models
+from . import reportjobs
+from . import td
 import unittest
 import datetime
 from decimal import Decimal
@@ -45,6 +47,11 @@ class ModelTest(unittest.TestCase):
         # self.trans.rollback()
         self.connection.close()
 
+    def test_create_tables_again(self):
+        # The tables were created in setUpClass; syncdb must be safe
+        # to run again on an existing database
+        td.create_tables()
+
     def test_add_business(self):
         self.s.add(models.Business(
             id=1, name='Test', abbrev='TEST', address='An address'))
@@ -129,6 +136,56 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         return stockline, plu
 
+    def test_vat_cache(self):
+        self.template_setup()
+        business = models.Business(
+            id=2, name='Other', abbrev='OTHER', address='Another address')
+        self.s.add_all([business, models.VatRate(
+            band='A', active=datetime.date(2020, 1, 1), business=business,
+            rate=5)])
+        self.s.commit()
+        cache = models.VatCache.get(self.s)
+        self.assertIs(models.VatCache.get(self.s), cache)
+        old = cache.at('A', datetime.date(2019, 12, 31))
+        self.assertIsInstance(old, models.VatBand)
+        self.assertEqual(old.business.abbrev, 'TEST')
+        new = cache.at('A', datetime.datetime.now())
+        self.assertEqual(new.rate, Decimal(5))
+        self.assertEqual(new.business.abbrev, 'OTHER')
+        # Changing a rate through the ORM invalidates the cache
+        self.s.query(models.VatRate).one().rate = 10
+        self.s.commit()
+        cache = models.VatCache.get(self.s)
+        self.assertEqual(cache.at('A', datetime.date.today()).rate,
+                         Decimal(10))
+
+    def test_vat_cache_miss_reloads(self):
+        self.template_setup()
+        cache = models.VatCache.get(self.s)
+        # Another process adds a business and VAT band.  This isn't
+        # done through the ORM, so the cache isn't invalidated.
+        with self._engine.begin() as other:
+            other.execute(models.Business.__table__.insert().values(
+                business=3, name='Elsewhere', abbrev='ELSE',
+                address='Another address'))
+            other.execute(models.VatBand.__table__.insert().values(
+                band='B', business=3, rate=5))
+        try:
+            self.assertIs(models.VatCache.get(self.s), cache)
+            self.assertEqual(cache.band('B').rate, Decimal(5))
+            self.assertEqual(cache.at('B', datetime.date.today()).rate,
+                             Decimal(5))
+            self.assertEqual(cache.business(3).abbrev, 'ELSE')
+            self.assertEqual(cache.band('A').business.abbrev, 'TEST')
+            with self.assertRaises(KeyError):
+                cache.band('Z')
+        finally:
+            with self._engine.begin() as other:
+                other.execute(models.VatBand.__table__.delete().where(
+                    models.VatBand.band == 'B'))
+                other.execute(models.Business.__table__.delete().where(
+                    models.Business.id == 3))
+
     def test_stockline_linetype_constraint(self):
         self.template_setup()
         self.s.add(models.StockLine(
@@ -362,6 +419,263 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         self.assertEqual(beer.remaining, Decimal("143.0"))
 
+    def test_stocktype_calculate_sale(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        for used in (72, 70, 80, 0, 36):
+            item = models.StockItem(
+                delivery=delivery, stocktype=beer, description="Firkin",
+                size=72)
+            if used:
+                self.s.add(models.StockOut(
+                    stockitem=item, removecode_id='test', qty=used))
+            self.s.add(item)
+        self.s.commit()
+        for qty in (Decimal("-1.0"), Decimal("0.0"), Decimal("1.0"),
+                    Decimal("2.5"), Decimal("80.0"), Decimal("200.0")):
+            self.assertEqual(beer.calculate_sale(qty),
+                             beer._calculate_sale_by_item(qty))
+
+    def test_stockout_daily(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test")
+        item = models.StockItem(
+            delivery=delivery,
+            stocktype=beer,
+            description="Firkin",
+            size=72)
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        out = [models.StockOut(stockitem=item, removecode_id='test', qty=1),
+               models.StockOut(stockitem=item, removecode_id='test', qty=2),
+               models.StockOut(stockitem=item, removecode_id='test', qty=4,
+                               time=yesterday)]
+        self.s.add_all(out)
+        self.s.commit()
+
+        def totals():
+            return {(d.date, d.stocktype_id): d.qty
+                    for d in self.s.query(models.StockOutDaily)}
+        today = datetime.date.today()
+        expected = {(today, beer.id): Decimal("3.0"),
+                    (yesterday.date(), beer.id): Decimal("4.0")}
+        self.assertEqual(totals(), expected)
+        self.s.delete(out[0])
+        out[2].qty = 5
+        self.s.commit()
+        expected = {(today, beer.id): Decimal("2.0"),
+                    (yesterday.date(), beer.id): Decimal("5.0")}
+        self.assertEqual(totals(), expected)
+        models.StockOutDaily.rebuild(self.s)
+        self.s.commit()
+        self.assertEqual(totals(), expected)
+
+    def test_stocktake_commit(self):
+        self.template_setup()
+        beer = self.template_stocktype_setup()
+        user = self.template_user_setup()
+        self.s.add_all([
+            models.RemoveCode(id='missing', reason='Missing'),
+            models.FinishCode(id='empty', description='Empty'),
+        ])
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        items = [models.StockItem(delivery=delivery, stocktype=beer,
+                                  description="Firkin", size=72)
+                 for i in range(3)]
+        stocktake = models.StockTake(description="Test", create_user=user)
+        stocktake.scope.append(beer)
+        self.s.add_all(items + [stocktake])
+        self.s.commit()
+        stocktake.take_snapshot()
+        self.s.commit()
+        snapshots = {ss.stock_id: ss for ss in stocktake.snapshots}
+        self.assertEqual(len(snapshots), 3)
+        snapshots[items[0].id].finishcode_id = 'empty'
+        self.s.add(models.StockTakeAdjustment(
+            snapshot=snapshots[items[1].id], removecode_id='missing',
+            qty=2))
+        # The test runs in a single transaction, where
+        # current_timestamp doesn't change; commit_time must be later
+        # than start_time
+        stocktake.start_time = datetime.datetime.now() \
+            - datetime.timedelta(hours=1)
+        stocktake.commit_snapshot(user)
+        self.s.commit()
+        self.assertEqual(stocktake.state, "complete")
+        self.assertEqual(items[0].finishcode_id, 'empty')
+        self.assertIsNotNone(items[0].finished)
+        self.assertIsNone(items[1].finished)
+        self.assertEqual(items[1].remaining, Decimal("70.0"))
+        self.assertEqual(items[1].out[0].stocktake, stocktake)
+        self.assertEqual(items[2].remaining, Decimal("72.0"))
+        self.assertIsNone(beer.stocktake)
+
+    def test_plan_restock(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        short = models.StockLine(name="Short", location="Test",
+                                 linetype="display", capacity=20,
+                                 stocktype=beer)
+        full = models.StockLine(name="Full", location="Test",
+                                linetype="display", capacity=4,
+                                stocktype=beer)
+        for line, displayqty, used in [
+                (short, None, 0), (short, 6, 4), (short, 12, 12),
+                (short, 0, 0), (full, 12, 2), (full, 3, 1)]:
+            item = models.StockItem(
+                delivery=delivery, stocktype=beer, description="Case",
+                size=12, stockline=line, displayqty=displayqty)
+            if used:
+                self.s.add(models.StockOut(
+                    stockitem=item, removecode_id='test', qty=used))
+            self.s.add(item)
+        self.s.commit()
+        self.s.expire_all()
+        for target in (None, 0):
+            plan = models.StockLine.plan_restock(
+                self.s, [short, full], target=target)
+            self.assertEqual(
+                plan, [(sl, sl.calculate_restock(target=target))
+                       for sl in (short, full)])
+
+    def test_purge_finished(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        self.s.add_all([
+            models.FinishCode(id='empty', description='Empty'),
+            models.AnnotationType(id='stop', description='Stop'),
+        ])
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        display = models.StockLine(name="Display", location="Test",
+                                   linetype="display", capacity=10,
+                                   stocktype=beer)
+        continuous = models.StockLine(name="Continuous", location="Test",
+                                      linetype="continuous", stocktype=beer)
+        items = []
+        for line, used in [(display, 12), (display, 6), (None, 13),
+                           (None, 12), (None, 6)]:
+            item = models.StockItem(
+                delivery=delivery, stocktype=beer, description="Case",
+                size=12, stockline=line,
+                displayqty=used if line else None)
+            self.s.add(models.StockOut(
+                stockitem=item, removecode_id='test', qty=used))
+            items.append(item)
+        self.s.add_all(items + [continuous])
+        self.s.commit()
+        purged = models.StockItem.purge_finished(self.s, "test")
+        self.s.commit()
+        self.assertEqual(purged, [items[0], items[2], items[3]])
+        for item in purged:
+            self.assertIsNotNone(item.finished)
+            self.assertEqual(item.finishcode_id, 'empty')
+            self.assertIsNone(item.stockline)
+            self.assertIsNone(item.displayqty)
+        self.assertEqual(
+            [(a.atype, a.text) for a in items[0].annotations],
+            [("stop", "Display (display stockline, test)")])
+        self.assertEqual(
+            [(a.atype, a.text) for a in items[2].annotations],
+            [("stop", "Continuous (continuous stockline, test)")])
+        self.assertEqual(
+            [(a.atype, a.text) for a in items[3].annotations],
+            [("stop", "Continuous (continuous stockline, test)")])
+        self.assertIsNone(items[1].finished)
+        self.assertEqual(items[1].stockline, display)
+        self.assertEqual(items[1].annotations, [])
+        self.assertIsNone(items[4].finished)
+        self.assertEqual(items[4].annotations, [])
+        # Nothing is left to purge
+        self.assertEqual(models.StockItem.purge_finished(self.s, "test"), [])
+
+    def test_allocate_display_stock(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        cider = models.StockType(
+            manufacturer="A Cidery", name="A Cider",
+            abv=5, unit=beer.unit, dept_id=1)
+        self.s.add(models.AnnotationType(id='start', description='Start'))
+        supplier = models.Supplier(name="Test supplier")
+        delivery = models.Delivery(
+            date=datetime.date.today(), supplier=supplier,
+            docnumber="test", checked=True)
+        other = models.Delivery(
+            date=datetime.date.today(), supplier=supplier,
+            docnumber="other", checked=True)
+        beer_line = models.StockLine(name="Beer", location="Test",
+                                     linetype="display", capacity=10,
+                                     stocktype=beer)
+        cider_lines = [models.StockLine(name=name, location="Test",
+                                        linetype="display", capacity=10,
+                                        stocktype=cider)
+                       for name in ("Cider B", "Cider A")]
+        # Several items of a stock type that has never been on its
+        # line, which must only be logged once
+        beers = [models.StockItem(delivery=delivery, stocktype=beer,
+                                  description="Case", size=12)
+                 for i in range(3)]
+        self.s.add(models.StockOut(
+            stockitem=beers[1], removecode_id='test', qty=2))
+        ciders = [models.StockItem(delivery=delivery, stocktype=cider,
+                                   description="Case", size=12)]
+        other_beer = models.StockItem(delivery=other, stocktype=beer,
+                                      description="Case", size=12)
+        self.s.add_all(beers + ciders + cider_lines
+                       + [beer_line, other_beer])
+        self.s.commit()
+
+        done, manual = models.StockItem.allocate_display_stock(
+            self.s, deliveryid=delivery.id)
+        self.s.commit()
+        self.assertEqual(done, beers)
+        for item in done:
+            self.assertEqual(item.stockline, beer_line)
+            self.assertIsNotNone(item.onsale)
+            self.assertEqual(
+                [(a.atype, a.text) for a in item.annotations],
+                [("start", "Beer (auto-allocate)")])
+        self.assertEqual([item.displayqty for item in done],
+                         [Decimal(0), Decimal(2), Decimal(0)])
+        self.assertEqual(
+            self.s.query(models.StockLineTypeLog.stocklineid,
+                         models.StockLineTypeLog.stocktype_id).all(),
+            [(beer_line.id, beer.id)])
+        self.assertEqual(
+            manual, [(ciders[0], list(reversed(cider_lines)))])
+        self.assertIsNone(ciders[0].stockline)
+        # Items from other deliveries are left alone
+        self.assertIsNone(other_beer.stockline)
+
+        # The stock type is already logged for the line this time
+        done, manual = models.StockItem.allocate_display_stock(self.s)
+        self.s.commit()
+        self.assertEqual(done, [other_beer])
+        self.assertEqual(other_beer.stockline, beer_line)
+        self.assertEqual(self.s.query(models.StockLineTypeLog).count(), 1)
+        self.assertEqual(len(manual), 1)
+
     def test_annotation_delete_cascade(self):
         self.template_setup()
         beer = self.template_stocktype_setup()
@@ -570,6 +884,48 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         self.assertIsNotNone(st.meta['foo'].document_hash)
 
+    def test_report_job_reuse(self):
+        """A finished report is reused until its data changes"""
+        today = datetime.date.today()
+        session = models.Session(today)
+        session.endtime = datetime.datetime.now()
+        cash = models.PayType(paytype='CASH', description='Cash')
+        total = models.SessionTotal(session=session, paytype=cash,
+                                    amount=Decimal(2))
+        self.s.add_all([session, cash, total])
+        self.s.commit()
+        params = {'start': today.isoformat(), 'end': today.isoformat()}
+        job = reportjobs.enqueue(self.s, 'sessionrange', params, today, today)
+        self.assertIsNotNone(job.sessions_version)
+        self.assertEqual(job, reportjobs.enqueue(
+            self.s, 'sessionrange', params, today, today))
+        job.state = 'done'
+        job.result = b'report'
+        self.s.commit()
+        self.assertEqual(job, reportjobs.enqueue(
+            self.s, 'sessionrange', params, today, today))
+        total.amount = Decimal(3)
+        self.s.commit()
+        job2 = reportjobs.enqueue(self.s, 'sessionrange', params, today, today)
+        self.assertNotEqual(job, job2)
+        job2.state = 'done'
+        job2.result = b'report'
+        self.s.commit()
+        # Waste recorded after the session has closed
+        self.template_setup()
+        self.template_removecode_setup()
+        item = models.StockItem(
+            delivery=models.Delivery(
+                date=today, supplier=models.Supplier(name="Test supplier"),
+                docnumber="test", checked=True),
+            stocktype=self.template_stocktype_setup(),
+            description="Case", size=12)
+        self.s.add(models.StockOut(
+            stockitem=item, removecode_id='test', qty=1))
+        self.s.commit()
+        self.assertNotEqual(job2, reportjobs.enqueue(
+            self.s, 'sessionrange', params, today, today))
+
 
 if __name__ == '__main__':
     unittest.main()
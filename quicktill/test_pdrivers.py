@@ -0,0 +1,401 @@
+from . import pdrivers
+import unittest
+import io
+import time
+import socket
+import os
+import json
+import tempfile
+import threading
+import unittest.mock
+from PIL import Image, ImageDraw, ImageOps
+
+
+def _reference_image_bands(primg):
+    """Pack a padded mode "1" image the way escpos._image used to
+
+    Returns the data for each 24-dot band.  Kept as a reference for
+    the bulk implementation.
+    """
+    width, height = primg.size
+    data = iter(primg.getdata())
+    bands = []
+
+    def _readline():
+        return [bool(next(data)) for _ in range(width)]
+    try:
+        while True:
+            lines = [_readline() for _ in range(24)]
+            bands.append(b''.join(
+                int(''.join("1" if bit else "0" for bit in column),
+                    base=2).to_bytes(length=3, byteorder="big")
+                for column in zip(*lines)))
+    except StopIteration:
+        pass
+    return bands
+
+
+def _reference_qrcode_rows(code, dpl):
+    """Pack a QR code matrix the way escpos._qrcode_emulated used to
+    """
+    lt = {
+        (False, False): bytes([0x00]),
+        (False, True): bytes([0x1c]),
+        (True, False): bytes([0xe0]),
+        (True, True): bytes([0xfc]),
+    }
+    rows = []
+    while len(code) > 0:
+        if len(code) > 1:
+            row = zip(code[0], code[1])
+        else:
+            row = zip(code[0], [False] * len(code[0]))
+        code = code[1:]
+        row = b''.join(lt[x] * 3 for x in row)
+        if len(row) > dpl:
+            break
+        rows.append(row)
+    return rows
+
+
+def _test_logo(width=576, height=240):
+    image = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, 7):
+        draw.line([(i, 0), (width - i, height)], fill=(i % 256, 0, 0, 255))
+    draw.ellipse([(20, 20), (width - 20, height - 20)],
+                 outline=(0, 0, 0, 255), width=9)
+    f = io.BytesIO()
+    image.save(f, "PNG")
+    return f.getvalue()
+
+
+def _test_qrcode_data():
+    return "https://example.com/receipt/" + "0123456789abcdef" * 12
+
+
+def _split_image_output(output, dpl):
+    """Return the band data from escpos._render_image() output
+    """
+    header = pdrivers.escpos.ep_bitimage_dd_v24 \
+        + dpl.to_bytes(length=2, byteorder="little")
+    return [band[:dpl * 3] for band in output.split(header)[1:]]
+
+
+class ESCPOSPackingTest(unittest.TestCase):
+    def setUp(self):
+        self.driver = pdrivers.Epson_TM_T20_driver(80)
+
+    def test_image_matches_reference(self):
+        logo = _test_logo(width=500, height=100)
+        out = io.BytesIO()
+        self.driver._render_image(io.BytesIO(logo), out)
+        # Recreate the padded image that _render_image() worked on
+        image = Image.open(io.BytesIO(logo)).convert("RGBA")
+        primg = Image.new("RGB", (538, 120), (255, 255, 255))
+        primg.paste(image, box=(38, 10), mask=image.getchannel("A"))
+        primg = ImageOps.invert(primg.convert("L")).convert("1")
+        self.assertEqual(_split_image_output(out.getvalue(), 538),
+                         _reference_image_bands(primg))
+
+    @unittest.skipUnless(pdrivers._qrcode_supported, "qrcode not installed")
+    def test_qrcode_matches_reference(self):
+        driver = pdrivers.Epson_TM_U220_driver(76)
+        for data in ("a", "hello world", "x" * 40):
+            q = pdrivers.qrcode.QRCode(
+                border=2,
+                error_correction=pdrivers.qrcode.constants.ERROR_CORRECT_H)
+            q.add_data(data)
+            code = q.get_matrix()
+            out = io.BytesIO()
+            driver._qrcode_emulated(data, out)
+            rows = _reference_qrcode_rows(code, driver.dpl)
+            expected = io.BytesIO()
+            expected.write(pdrivers.escpos.ep_unidirectional_on)
+            for row in rows:
+                padding = (driver.dpl - len(row)) // 2
+                width = len(row) + padding
+                header = pdrivers.escpos.ep_bitimage_sd \
+                    + bytes([width & 0xff, (width >> 8) & 0xff])
+                for feed in (pdrivers.escpos.ep_half_dot_feed,
+                             pdrivers.escpos.ep_short_feed):
+                    expected.write(header + bytes(padding) + row + b'\r')
+                    expected.write(feed)
+            expected.write(pdrivers.escpos.ep_unidirectional_off)
+            self.assertEqual(out.getvalue(), expected.getvalue())
+
+
+def _fill_canvas(canvas):
+    """Use every receipt canvas operation"""
+    canvas.printline("Left\tCentre\tRight")
+    canvas.printline("Coloured", colour=1)
+    canvas.printline("\tBig", font=1, emph=True, underline=2)
+    canvas.printline()
+    canvas.printqrcode(_test_qrcode_data())
+    canvas.printimage(_test_logo(width=200, height=50))
+    canvas.add_story([pdrivers.ReceiptElement()])
+    canvas.printline("End")
+
+
+class SpoolPrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        # This driver draws QR codes itself rather than sending the
+        # data to the printer
+        self.driver = pdrivers.Epson_TM_U220_driver(76)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _render(self, story):
+        canvas = self.driver.get_canvas()
+        canvas.set_story(story)
+        out = io.BytesIO()
+        self.driver.process_canvas(canvas, out)
+        return out.getvalue()
+
+    def _expected(self):
+        canvas = self.driver.get_canvas()
+        _fill_canvas(canvas)
+        return self._render(canvas.get_story())
+
+    def _wait_printed(self, spooldir, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not any(f.endswith(pdrivers.spoolprinter.jobsuffix)
+                       for f in os.listdir(spooldir)):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_story_json_round_trip(self):
+        canvas = self.driver.get_canvas()
+        _fill_canvas(canvas)
+        story = canvas.get_story()
+        data = json.loads(json.dumps(pdrivers._story_to_json(story)))
+        copy = pdrivers._story_from_json(data)
+        self.assertEqual([type(i) for i in copy], [type(i) for i in story])
+        self.assertEqual([str(i) for i in copy], [str(i) for i in story])
+        self.assertEqual(pdrivers._story_to_json(copy), data)
+        self.assertEqual(self._render(copy), self._expected())
+
+    def test_spool_and_print(self):
+        spooldir = os.path.join(self.dir.name, "spool")
+        output = os.path.join(self.dir.name, "output")
+        printer = pdrivers.spoolprinter(
+            spooldir, pdrivers.fileprinter(output, self.driver))
+        with printer as c:
+            _fill_canvas(c)
+        self.assertTrue(self._wait_printed(spooldir))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), self._expected())
+        self.assertIsNone(printer.offline())
+
+    def test_replay_after_failure(self):
+        spooldir = os.path.join(self.dir.name, "spool")
+        output = os.path.join(self.dir.name, "output")
+        # The first printer can't be written to, so the job stays in
+        # the spool directory
+        broken = pdrivers.spoolprinter(spooldir, pdrivers.fileprinter(
+            os.path.join(self.dir.name, "missing", "output"), self.driver))
+        with broken as c:
+            _fill_canvas(c)
+        deadline = time.monotonic() + 10
+        while not broken.offline() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(broken.offline().startswith(
+            "1 spooled job(s) waiting: "))
+        self.assertFalse(os.path.exists(output))
+        # A spooler started later on the same directory prints it
+        printer = pdrivers.spoolprinter(
+            spooldir, pdrivers.fileprinter(output, self.driver))
+        printer.offline()
+        self.assertTrue(self._wait_printed(spooldir))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), self._expected())
+
+
+class _PrinterServer:
+    """A local socket that accepts connections like a network printer
+    """
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.listener.settimeout(5)
+        self.address = self.listener.getsockname()
+
+    def _receive(self, conn):
+        # Read everything sent on a connection until it goes quiet
+        conn.settimeout(0.2)
+        data = b''
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return data
+
+    def accept_job(self):
+        """Return (connection, data) for the next connection with data
+
+        Connections that send nothing, such as the status poller
+        checking that the printer is reachable, are closed and skipped.
+        """
+        while True:
+            conn = self.listener.accept()[0]
+            data = self._receive(conn)
+            if data:
+                return conn, data
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def _closed_address():
+    """An address on which nothing is listening"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()
+
+
+class ReachabilityTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _PrinterServer()
+        self.status = pdrivers._reachability()
+        self.status.interval = 0.01
+
+    def tearDown(self):
+        for connection, family in list(self.status._targets):
+            self.status.unwatch(connection, family)
+        self.server.close()
+
+    def _wait_for(self, connection, expected, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            problem = self.status.get(connection, socket.AF_INET)
+            if expected(problem):
+                return problem
+            time.sleep(0.01)
+        self.fail(f"status of {connection} is still {problem!r}")
+
+    def test_connect(self):
+        self.assertIsNone(pdrivers.test_connect(self.server.address))
+        host, port = _closed_address()
+        self.assertTrue(pdrivers.test_connect((host, port)).startswith(
+            f"Could not connect to {host} port {port}: "))
+
+    def test_assumed_available_until_polled(self):
+        closed = _closed_address()
+        polled = threading.Event()
+
+        def slow_test_connect(connection, family, timeout):
+            polled.wait(5)
+            return "unreachable"
+        with unittest.mock.patch.object(
+                pdrivers, "test_connect", slow_test_connect):
+            self.status.watch(closed, socket.AF_INET)
+            self.assertIsNone(self.status.get(closed, socket.AF_INET))
+            polled.set()
+            self.assertEqual(
+                self._wait_for(closed, lambda p: p is not None),
+                "unreachable")
+
+    def test_failure_reported(self):
+        closed = _closed_address()
+        self.status.watch(closed, socket.AF_INET)
+        self.assertIn("Could not connect",
+                      self._wait_for(closed, lambda p: p is not None))
+        # A reachable printer is reported available
+        self.status.watch(self.server.address, socket.AF_INET)
+        self.status.set(self.server.address, socket.AF_INET, "stale")
+        self._wait_for(self.server.address, lambda p: p is None)
+
+    def test_ttl(self):
+        # Nothing is watching, so results are never refreshed
+        self.status.ttl = 0.1
+        self.status.set(self.server.address, socket.AF_INET, "problem")
+        self.assertEqual(
+            self.status.get(self.server.address, socket.AF_INET), "problem")
+        time.sleep(0.2)
+        self.assertIsNone(
+            self.status.get(self.server.address, socket.AF_INET))
+
+
+class NetPrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _PrinterServer()
+
+    def tearDown(self):
+        pdrivers._netstatus.unwatch(self.server.address, socket.AF_INET)
+        self.server.close()
+
+    def _wait_offline(self, printer, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            problem = printer.offline()
+            if problem:
+                return problem
+            time.sleep(0.01)
+
+    def test_persistent_connection_lost(self):
+        printer = pdrivers.netprinter(
+            self.server.address, pdrivers.Epson_TM_T20_driver(80),
+            persistent=True)
+        with printer as c:
+            c.printline("first")
+        conn, data = self.server.accept_job()
+        self.assertIn(b"first", data)
+        self.assertIsNone(printer.offline())
+        # The printer drops the connection
+        conn.close()
+        self.assertEqual(self._wait_offline(printer),
+                         "Printer closed the connection")
+        # The next job reconnects
+        with printer as c:
+            c.printline("second")
+        conn, data = self.server.accept_job()
+        self.assertIn(b"second", data)
+        conn.close()
+
+
+def _time(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def benchmark():
+    """Compare the bulk bit packing with the old per-pixel code
+    """
+    driver = pdrivers.Epson_TM_T20_driver(80)
+    logo = _test_logo()
+    primg = ImageOps.invert(
+        Image.open(io.BytesIO(logo)).convert("L")).convert("1")
+    reference = _time(lambda: _reference_image_bands(primg))
+    bulk = _time(lambda: driver._render_image(io.BytesIO(logo), io.BytesIO()))
+    print(f"576-dot logo: reference {reference:.4f}s, escpos {bulk:.4f}s "
+          "(including image conversion)")
+    if pdrivers._qrcode_supported:
+        data = _test_qrcode_data()
+        q = pdrivers.qrcode.QRCode(
+            border=2,
+            error_correction=pdrivers.qrcode.constants.ERROR_CORRECT_H)
+        q.add_data(data)
+        code = q.get_matrix()
+        reference = _time(lambda: _reference_qrcode_rows(code, driver.dpl))
+        bulk = _time(lambda: driver._qrcode_matrix(code, io.BytesIO()))
+        print(f"{len(code)}x{len(code)} QR code: reference {reference:.4f}s, "
+              f"escpos {bulk:.4f}s")
+
+
+if __name__ == '__main__':
+    benchmark()
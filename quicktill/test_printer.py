@@ -0,0 +1,96 @@
+from . import printer
+from . import pdrivers
+from . import models
+from . import tillconfig
+import unittest
+import unittest.mock
+import base64
+import datetime
+import os
+import re
+import tempfile
+import zlib
+
+
+def _page_contents(data):
+    """Decode the page content streams of one or more PDF documents
+
+    The documents are made with standard fonts only, so every stream
+    is the content of a page.
+    """
+    streams = re.findall(rb"stream\r?\n(.*?)endstream", data, re.DOTALL)
+    return [zlib.decompress(base64.a85decode(stream.rstrip(b"~>")))
+            for stream in streams]
+
+
+class StockLabelTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.driver = pdrivers.pdf_labelpage(
+            4, 10, "48.5mm", "25.4mm", "0mm", "0mm")
+        unit = models.Unit(
+            name='pint', description='Pint',
+            sale_unit_name='pint', sale_unit_name_plural='pints',
+            stock_unit_name='pint', stock_unit_name_plural='pints')
+        delivery = models.Delivery(
+            date=datetime.date(2024, 1, 1),
+            supplier=models.Supplier(name="Test supplier"))
+        stocktypes = [
+            models.StockType(manufacturer="A Brewery", name="A Beer",
+                             abv=5, unit=unit),
+            models.StockType(
+                manufacturer="A Brewery With A Very Long Name",
+                name="A Beer With A Very Long Name Too", abv=4, unit=unit),
+        ]
+        for i, stocktype in enumerate(stocktypes):
+            stocktype.id = i + 1
+        # Enough labels for several pages, ending part way through one
+        self.items = [
+            models.StockItem(id=i, description="Firkin", delivery=delivery,
+                             stocktype=stocktypes[i % len(stocktypes)])
+            for i in range(1, 96)]
+        patches = [
+            unittest.mock.patch.object(printer, "checkdigit_print",
+                                       lambda: True),
+            unittest.mock.patch.object(printer, "label_pool_threshold", 10),
+            unittest.mock.patch.object(tillconfig, "label_processes", 3),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _print(self, label_printer, filename):
+        printer.print_stock_labels(label_printer, self.items)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def _serial(self):
+        filename = os.path.join(self.dir.name, "serial.pdf")
+        with unittest.mock.patch.object(tillconfig, "label_processes", None):
+            return self._print(
+                pdrivers.fileprinter(filename, self.driver), filename)
+
+    def test_batched_matches_serial(self):
+        serial = self._serial()
+        filename = os.path.join(self.dir.name, "batched.pdf")
+        batched = self._print(
+            pdrivers.fileprinter(filename, self.driver), filename)
+        self.assertEqual(serial.count(b"%PDF-"), 1)
+        # 95 labels on 3 pages, one page for each process
+        self.assertEqual(batched.count(b"%PDF-"), 3)
+        self.assertEqual(len(_page_contents(serial)), 3)
+        self.assertEqual(_page_contents(batched), _page_contents(serial))
+
+    def test_printer_without_driver(self):
+        serial = self._serial()
+        filename = os.path.join(self.dir.name, "autodetect.pdf")
+        open(filename, 'wb').close()
+        label_printer = pdrivers.autodetect_printer(
+            [(filename, self.driver, False)])
+        self.assertFalse(hasattr(label_printer, "driver"))
+        output = self._print(label_printer, filename)
+        self.assertEqual(output.count(b"%PDF-"), 1)
+        self.assertEqual(_page_contents(output), _page_contents(serial))
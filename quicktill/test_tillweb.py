@@ -0,0 +1,69 @@
+from .tillweb.db import EngineRegistry
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+import unittest
+import tempfile
+import os
+import time
+
+
+class EngineRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.engines = EngineRegistry(
+            "sqlite:///" + os.path.join(self.dir.name, "{database}.db"),
+            max_engines=4, max_connections=2, pool_timeout=0.1,
+            poolclass=QueuePool)
+
+    def tearDown(self):
+        for database, entry in self.engines._engines.items():
+            entry.engine.dispose()
+        self.dir.cleanup()
+
+    def _session(self, database):
+        s = self.engines.session(database)
+        s.execute(text("SELECT 1"))
+        return s
+
+    def test_busy_database_uses_all_connections(self):
+        # The connection limit is shared, not split between databases
+        sessions = [self._session("one") for _ in range(2)]
+        self.assertEqual(self.engines.in_use, 2)
+        for s in sessions:
+            s.close()
+        self.assertEqual(self.engines.in_use, 0)
+
+    def test_limit_is_global(self):
+        a = self._session("one")
+        b = self._session("two")
+        start = time.perf_counter()
+        with self.assertRaises(EngineRegistry.Busy):
+            self.engines.session("three")
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+        # Busy is reported the same way as pool exhaustion
+        with self.assertRaises(TimeoutError):
+            self.engines.session("one")
+        self.assertEqual(self.engines.in_use, 2)
+        # Closing a session frees its slot for any database
+        a.close()
+        c = self._session("three")
+        self.assertEqual(self.engines.in_use, 2)
+        # Closing a session twice doesn't free a second slot
+        a.close()
+        self.assertEqual(self.engines.in_use, 2)
+        b.close()
+        c.close()
+        self.assertEqual(self.engines.in_use, 0)
+
+    def test_connections_within_limit(self):
+        sessions = [self._session(db) for db in ("one", "two")]
+        for s in sessions:
+            s.close()
+        sessions = [self._session("three") for _ in range(2)]
+        self.assertLessEqual(
+            sum(p['checkedout'] for p in self.engines.stats()), 2)
+        for s in sessions:
+            s.close()
+        self.assertEqual(
+            sum(p['checkedout'] for p in self.engines.stats()), 0)
@@ -33,7 +33,7 @@ from . import config
 from . import listen
 from . import barcode
 from .version import version
-from .models import Session, PayType, Business, Register, zero
+from .models import Session, PayType, Business, Register, VatCache, zero
 import subprocess
 from sqlalchemy.orm import joinedload
 
@@ -44,6 +44,7 @@ from . import dbutils  # noqa: F401
 from . import foodcheck  # noqa: F401
 from . import secretstore  # noqa: F401
 from . import monitor  # noqa: F401
+from . import reportjobs  # noqa: F401
 # End of subcommand imports
 
 log = logging.getLogger(__name__)
@@ -271,6 +272,7 @@ class runtill(cmdline.command):
         # initialise config change listener, and generate a new register ID
         with td.orm_session():
             config.ConfigItem.listen_for_changes(listen.listener)
+            VatCache.listen_for_changes(listen.listener)
             config.ConfigItem.preload()
             reg = Register(version=version,
                            config_name=tillconfig.configname,
@@ -594,6 +596,8 @@ def main():
                 tillconfig.cash_drawer = val
         elif opt == 'labelprinters':
             tillconfig.label_printers = val
+        elif opt == 'label_processes':
+            tillconfig.label_processes = val
         elif opt == 'database':
             tillconfig.database = val
         elif opt == 'keyboard_driver':
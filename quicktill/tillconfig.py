@@ -29,6 +29,10 @@ receipt_printer = None
 label_printers = []
 cash_drawer = None
 
+# Number of processes to use when rendering large batches of stock
+# labels, or None to render them in the till process
+label_processes = None
+
 publogo = config.ConfigItem(
     'core:sitelogo', None, display_name="Site logo",
     description=(
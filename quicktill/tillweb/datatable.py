@@ -1,8 +1,15 @@
 from .views import tillweb_view, colours
 from decimal import Decimal
 from itertools import cycle
+import datetime
+import hashlib
+import json
+import threading
+import time
 from django.http import JsonResponse
-from sqlalchemy.sql.expression import func, or_, nullslast
+from sqlalchemy import inspect
+from sqlalchemy.sql.expression import func, or_, and_, false, select
+from sqlalchemy.sql.expression import nullsfirst, nullslast
 from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import undefer
@@ -25,33 +32,270 @@ from quicktill.models import (
     StockAnnotation,
     AnnotationType,
     zero,
+    trigram_indexes,
 )
 
 
 # Utilities to help write views for datatables
-def _datatables_order(query, columns, params):
+def _datatables_sort(columns, params):
+    """Read the requested sort order from datatables parameters
+
+    Returns a list of (expression, descending, nulls_last) tuples.
+    """
+    sort = []
     for onum in range(1000):
         order_col = params.get(f"order[{onum}][column]")
         order_dir = params.get(f"order[{onum}][dir]")
         if not order_col or not order_dir:
             break
-        expr = columns[int(order_col)]
-        if order_dir == "desc":
+        descending = order_dir == "desc"
+        # PostgreSQL sorts nulls last in ascending order and first in
+        # descending order unless told otherwise
+        nulls_last = not descending or bool(
+            params.get(f"columns[{order_col}][nullslast]", False))
+        sort.append((columns[int(order_col)], descending, nulls_last))
+    return sort
+
+
+def _datatables_order(query, sort):
+    for expr, descending, nulls_last in sort:
+        if descending:
             expr = expr.desc()
-        if params.get(f"columns[{order_col}][nullslast]", False):
+        if nulls_last and descending:
             expr = nullslast(expr)
+        elif not nulls_last and not descending:
+            expr = nullsfirst(expr)
         query = query.order_by(expr)
-
     return query
 
 
-def _datatables_paginate(query, params):
+# Keyset pagination
+#
+# Using OFFSET to fetch a page means the database has to generate and
+# throw away every row before the start of the page, which gets slow
+# towards the end of large tables like translines and payments.  When
+# datatables asks for the page immediately after or before the one it
+# has just been sent, we can instead continue from the sort key of
+# the last (or first) row on that page.  The primary key is added to
+# the sort order so that the key identifies a unique position.
+#
+# The key values are sent to the client in an opaque "keyset" string
+# with each response; the client sends it back with its next request.
+# It is only used if the rest of the request is unchanged: any change
+# to the ordering, search or filter parameters, or a jump to an
+# arbitrary page, falls back to OFFSET.
+
+def _keyset_signature(params):
+    items = sorted((k, v) for k, vs in params.lists() for v in vs
+                   if k not in ("draw", "start", "keyset", "_"))
+    return hashlib.sha1(json.dumps(items).encode("utf-8")).hexdigest()
+
+
+def _keyset_encode(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _keyset_decode(expr, value):
+    if value is None:
+        return None
+    try:
+        pytype = expr.type.python_type
+    except NotImplementedError:
+        return value
+    if pytype is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if pytype is datetime.date:
+        return datetime.date.fromisoformat(value)
+    if pytype is Decimal:
+        return Decimal(value)
+    if pytype in (int, str):
+        return pytype(value)
+    return value
+
+
+def _keyset_after(sort, values):
+    """Condition selecting rows that sort after the given key values
+    """
+    clauses = []
+    equal = []
+    for (expr, descending, nulls_last), value in zip(sort, values):
+        if value is None:
+            after = None if nulls_last else expr != None
+            same = expr == None
+        else:
+            after = expr < value if descending else expr > value
+            if nulls_last:
+                after = or_(after, expr == None)
+            same = expr == value
+        if after is not None:
+            clauses.append(and_(*equal, after))
+        equal.append(same)
+    if not clauses:
+        return false()
+    return or_(*clauses)
+
+
+def _datatables_paginate(query, sort, params):
+    """Fetch the requested page of rows from a query
+
+    The query must have the key expressions from sort added as
+    columns after the entity.  Returns a list of (entity, key) tuples
+    in display order.
+    """
     start = int(params.get("start", "0"))
     length = int(params.get("length", "100"))
-    query = query.offset(start)
-    if length >= 0:
-        query = query.limit(length)
-    return query
+
+    keyset = None
+    if length > 0 and params.get("keyset"):
+        try:
+            keyset = json.loads(params["keyset"])
+            if keyset["sig"] != _keyset_signature(params):
+                keyset = None
+            elif not len(keyset["first"]) == len(keyset["last"]) \
+                    == len(sort):
+                keyset = None
+            elif start == keyset["start"] + length:
+                keyset = _keyset_after(sort, [
+                    _keyset_decode(expr, value) for (expr, _, _), value
+                    in zip(sort, keyset["last"])])
+                reverse = False
+            elif start == keyset["start"] - length:
+                sort = [(expr, not descending, not nulls_last)
+                        for expr, descending, nulls_last in sort]
+                keyset = _keyset_after(sort, [
+                    _keyset_decode(expr, value) for (expr, _, _), value
+                    in zip(sort, keyset["first"])])
+                reverse = True
+            else:
+                keyset = None
+        except (ValueError, TypeError, KeyError, ArithmeticError):
+            keyset = None
+
+    query = _datatables_order(query, sort)
+    if keyset is not None:
+        rows = query.filter(keyset).limit(length).all()
+        if reverse:
+            rows.reverse()
+    else:
+        query = query.offset(start)
+        if length >= 0:
+            query = query.limit(length)
+        rows = query.all()
+    return [(row[0], row[1:]) for row in rows]
+
+
+# Row counts
+#
+# Counting the rows in large tables like translines and log can take
+# much longer than fetching a page of them.  When the planner expects
+# the unfiltered query to return more than _exact_count_threshold
+# rows we use its estimate instead of counting them; for an
+# unfiltered table this comes from the table statistics in
+# pg_class.reltuples.  The planner's estimates for search conditions
+# can be out by orders of magnitude, so the filtered query is always
+# counted exactly unless it is the same as the unfiltered one.  Counts
+# are cached for _count_cache_ttl seconds, keyed by database, view and
+# query, so that paging through a table doesn't count it again for
+# every page.
+
+_exact_count_threshold = 20000
+_count_cache_ttl = 30
+_count_cache_size = 1000
+
+# key is (database, path, sql, params, estimate allowed); value is
+# (expiry time, count, estimated)
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+
+def _estimate_count(query):
+    """Ask the planner how many rows a query will return
+    """
+    compiled = query.statement.compile(bind=td.s.get_bind())
+    plan = td.s.connection().execute(
+        "EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _datatables_count(request, query, estimate=True):
+    """Count the rows returned by a query
+
+    Returns (count, estimated).  The count is exact unless estimated
+    is True, which is only possible if estimate is set.
+    """
+    compiled = query.statement.compile(bind=td.s.get_bind())
+    key = (str(td.s.get_bind().url), request.path, str(compiled),
+           repr(sorted(compiled.params.items())), estimate)
+    now = time.monotonic()
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1:]
+
+    rows = _estimate_count(query) if estimate else None
+    if rows is not None and rows > _exact_count_threshold:
+        result = (rows, True)
+    else:
+        result = (query.count(), False)
+
+    with _count_cache_lock:
+        for k in [k for k, v in _count_cache.items() if v[0] <= now]:
+            del _count_cache[k]
+        while len(_count_cache) >= _count_cache_size:
+            del _count_cache[next(iter(_count_cache))]
+        _count_cache[key] = (now + _count_cache_ttl, *result)
+    return result
+
+
+# Free-text search
+#
+# Searches use ILIKE '%term%', which can only use an index when the
+# trigram indexes from quicktill.models are present.  A search that
+# ORs together conditions on several columns can only use them if
+# every condition can use an index, and PostgreSQL won't combine
+# indexes across a join, so in that case we find the keys matching
+# each condition separately and combine them.  If any condition can't
+# use an index, or the term is too short to contain a trigram, or the
+# indexes are missing, a plain OR is quicker: it's a single sequential
+# scan rather than several.
+
+_trigram_index_check_ttl = 300
+
+# key is database, value is (expiry time, available)
+_trigram_indexes = {}
+
+
+def _trigram_indexes_available():
+    key = str(td.s.get_bind().url)
+    now = time.monotonic()
+    cached = _trigram_indexes.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    available = td.s.query(
+        func.to_regclass(trigram_indexes[0][0]) != None).scalar()
+    _trigram_indexes[key] = (now + _trigram_index_check_ttl, available)
+    return available
+
+
+def _datatables_search(query, key, search_value, conditions):
+    """Filter a query to rows matching any of a list of conditions
+
+    conditions is a list of (condition, indexed) tuples.  indexed
+    should be True if the condition refers only to the table that key
+    is in, and can be satisfied using an index on that table when the
+    trigram indexes are present.
+    """
+    if len(search_value) >= 3 \
+       and all(indexed for _, indexed in conditions) \
+       and _trigram_indexes_available():
+        matches = [td.s.query(key).filter(condition)
+                   for condition, _ in conditions]
+        return query.filter(key.in_(matches[0].union(*matches[1:])))
+    return query.filter(or_(*(condition for condition, _ in conditions)))
 
 
 def _datatables_json(request, query, filtered_query, columns, rowfunc):
@@ -74,14 +318,36 @@ def _datatables_json(request, query, filtered_query, columns, rowfunc):
     if error:
         return JsonResponse({'error': error})
 
-    q = _datatables_order(filtered_query, order_columns, request.GET)
-    q = _datatables_paginate(q, request.GET)
+    # Add the primary key of the entity being displayed to the
+    # requested sort order, so that it is stable and every row has a
+    # unique key
+    sort = _datatables_sort(order_columns, request.GET)
+    entity = filtered_query.column_descriptions[0]['entity']
+    sort.extend((col, False, True) for col in inspect(entity).primary_key)
+
+    q = filtered_query.add_columns(*(expr for expr, _, _ in sort))
+    rows = _datatables_paginate(q, sort, request.GET)
+    total, total_estimated = _datatables_count(request, query)
+    if filtered_query is query:
+        filtered, filtered_estimated = total, total_estimated
+    else:
+        filtered, filtered_estimated = _datatables_count(
+            request, filtered_query, estimate=False)
     r = {
         'draw': int(request.GET.get("draw", "1")),
-        'recordsTotal': query.count(),
-        'recordsFiltered': filtered_query.count(),
-        'data': [rowfunc(x) for x in q.all()],
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
+        'recordsEstimated': total_estimated,
+        'recordsFilteredEstimated': filtered_estimated,
+        'data': [rowfunc(x) for x, _ in rows],
     }
+    if rows:
+        r['keyset'] = json.dumps({
+            'sig': _keyset_signature(request.GET),
+            'start': int(request.GET.get("start", "0")),
+            'first': [_keyset_encode(v) for v in rows[0][1]],
+            'last': [_keyset_encode(v) for v in rows[-1][1]],
+        })
     if error:
         r['error'] = error
     return JsonResponse(r)
@@ -186,15 +452,15 @@ def transactions(request, info):
         except Exception:
             decsearch = None
         qs = [
-            columns['notes'].ilike(f'%{search_value}%'),
+            (columns['notes'].ilike(f'%{search_value}%'), True),
         ]
         if intsearch:
-            qs.append(columns['id'] == intsearch)
-            qs.append(columns['sessionid'] == intsearch)
+            qs.append((columns['id'] == intsearch, True))
+            qs.append((columns['sessionid'] == intsearch, True))
         if enable_amount_search and decsearch is not None:
-            qs.append(columns['total'] == decsearch)
-            qs.append(columns['discount_total'] == decsearch)
-        fq = fq.filter(or_(*qs))
+            qs.append((columns['total'] == decsearch, False))
+            qs.append((columns['discount_total'] == decsearch, False))
+        fq = _datatables_search(fq, Transaction.id, search_value, qs)
 
     return _datatables_json(
         request, q, fq, columns, lambda t: {
@@ -275,19 +541,21 @@ def translines(request, info):
         except Exception:
             decsearch = None
         qs = [
-            columns['text'].ilike(f'%{search_value}%'),
-            columns['source'].ilike(f'{search_value}%'),
-            columns['user'].ilike(f'%{search_value}%'),
-            columns['discount_name'].ilike(f'%{search_value}%'),
+            (columns['text'].ilike(f'%{search_value}%'), True),
+            (columns['source'].ilike(f'{search_value}%'), True),
+            (Transline.user_id.in_(
+                select([User.id]).where(
+                    User.fullname.ilike(f'%{search_value}%'))), True),
+            (columns['discount_name'].ilike(f'%{search_value}%'), True),
         ]
         if intsearch:
-            qs.append(columns['id'] == intsearch)
-            qs.append(columns['transid'] == intsearch)
-            qs.append(columns['items'] == intsearch)
+            qs.append((columns['id'] == intsearch, True))
+            qs.append((columns['transid'] == intsearch, True))
+            qs.append((columns['items'] == intsearch, False))
         if decsearch is not None:
-            qs.append(columns['amount'] == decsearch)
-            qs.append(columns['discount'] == decsearch)
-        fq = fq.filter(or_(*qs))
+            qs.append((columns['amount'] == decsearch, False))
+            qs.append((columns['discount'] == decsearch, False))
+        fq = _datatables_search(fq, Transline.id, search_value, qs)
 
     return _datatables_json(
         request, q, fq, columns, lambda tl: {
@@ -609,13 +877,15 @@ def logs(request, info):
         except ValueError:
             logid = None
         qs = [
-            columns['source'].ilike(f"%{search_value}%"),
-            columns['user'].ilike(f"%{search_value}%"),
-            columns['description'].ilike(f"%{search_value}%"),
+            (columns['source'].ilike(f"%{search_value}%"), True),
+            (LogEntry.user_id.in_(
+                select([User.id]).where(
+                    User.fullname.ilike(f"%{search_value}%"))), True),
+            (columns['description'].ilike(f"%{search_value}%"), True),
         ]
         if logid:
-            qs.append(columns['id'] == logid)
-        fq = fq.filter(or_(*qs))
+            qs.append((columns['id'] == logid, True))
+        fq = _datatables_search(fq, LogEntry.id, search_value, qs)
 
     return _datatables_json(
         request, q, fq, columns, lambda l: {
@@ -1,6 +1,11 @@
 # Access to the till database
 
+import collections
+import datetime
 import threading
+from sqlalchemy import create_engine
+from sqlalchemy import exc
+from sqlalchemy.orm import sessionmaker, Session
 
 # We use thread-local storage for the current sqlalchemy session.  The
 # session lifetime is managed explicitly in views.tillweb_view, and
@@ -8,3 +13,132 @@ import threading
 # accessed in the main till code, although the underlying mechanism is
 # different.  NB do not import the "quicktill.td" module!
 td = threading.local()
+
+
+class _LimitedSession(Session):
+    """A session that holds one of an EngineRegistry's connection slots
+
+    The slot is released when the session is closed.
+    """
+    _registry = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            registry, self._registry = self._registry, None
+            if registry:
+                registry._release()
+
+
+class EngineRegistry:
+    """Engines and session factories for many till databases
+
+    When one web interface serves many tills, creating an engine per
+    till database up front means every till holds its own pool of
+    connections whether it is being used or not.  Instead, engines are
+    created when a database is first used and kept in least recently
+    used order; when more than max_engines are in use, the least
+    recently used engine is disposed of, closing its idle connections.
+
+    No more than max_connections sessions are open at once across all
+    the databases, and a session uses at most one connection, so that
+    is also the limit on connections in use.  A busy database may use
+    all of them.  Each engine keeps up to pool_size idle connections
+    for reuse, an equal share of max_connections.  A request for a
+    session that can't get a connection within pool_timeout seconds
+    fails with EngineRegistry.Busy, which is a
+    sqlalchemy.exc.TimeoutError.
+
+    url is either a format string with a {database} field, or a
+    function that returns the URL for a database name.
+    """
+    class Busy(exc.TimeoutError):
+        pass
+
+    class _entry:
+        def __init__(self, engine):
+            self.engine = engine
+            self.sessionmaker = sessionmaker(
+                bind=engine, class_=_LimitedSession)
+            self.created = datetime.datetime.now()
+            self.last_used = None
+            self.requests = 0
+
+    def __init__(self, url, max_engines=20, max_connections=40,
+                 pool_timeout=10, **engine_options):
+        self._url = url
+        self.max_engines = max_engines
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self._engine_options = engine_options
+        self._engines = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.in_use = 0
+        self.evictions = 0
+
+    @property
+    def pool_size(self):
+        return max(1, self.max_connections // self.max_engines)
+
+    def _database_url(self, database):
+        if callable(self._url):
+            return self._url(database)
+        return self._url.format(database=database)
+
+    def session(self, database):
+        """Return a new ORM session for a database
+
+        The session must be closed when it is no longer needed.
+        """
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            raise self.Busy(
+                f"All {self.max_connections} database connections are "
+                f"in use")
+        try:
+            with self._lock:
+                self.in_use += 1
+                entry = self._engines.get(database)
+                if entry:
+                    self._engines.move_to_end(database)
+                else:
+                    entry = self._entry(create_engine(
+                        self._database_url(database),
+                        pool_size=self.pool_size,
+                        max_overflow=self.max_connections - self.pool_size,
+                        pool_timeout=self.pool_timeout,
+                        **self._engine_options))
+                    self._engines[database] = entry
+                    while len(self._engines) > self.max_engines:
+                        _, old = self._engines.popitem(last=False)
+                        old.engine.dispose()
+                        self.evictions += 1
+                entry.requests += 1
+                entry.last_used = datetime.datetime.now()
+            session = entry.sessionmaker()
+        except Exception:
+            self._release()
+            raise
+        session._registry = self
+        return session
+
+    def _release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        """Return pool statistics for each database, most recently used last
+        """
+        with self._lock:
+            entries = list(self._engines.items())
+        return [{
+            'database': database,
+            'created': entry.created,
+            'last_used': entry.last_used,
+            'requests': entry.requests,
+            'size': entry.engine.pool.size(),
+            'checkedin': entry.engine.pool.checkedin(),
+            'checkedout': entry.engine.pool.checkedout(),
+        } for database, entry in entries]
@@ -0,0 +1,193 @@
+"""Database query statistics for tillweb views
+
+For each request handled by tillweb_view we record the number of
+database queries, the time spent waiting for the database, the time
+spent in the view function and rendering its template, and the
+slowest statement.  The most recent requests are kept in a ring
+buffer, and running totals are kept for each view so that they can be
+exported to Prometheus.
+
+Statistics are kept in memory and are per-process.  The overhead is
+a pair of timestamps per query.
+"""
+
+from django.conf import settings
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import collections
+import threading
+import time
+
+# The request being recorded by the current thread, if any
+_current = threading.local()
+
+_lock = threading.Lock()
+_recent = collections.deque(
+    maxlen=getattr(settings, 'TILLWEB_QUERY_STATS_SIZE', 1000))
+_totals = {}
+
+
+class RequestStats:
+    """Statistics for a single request"""
+    def __init__(self, view, path):
+        self.view = view
+        self.path = path
+        self.time = time.time()
+        self.queries = 0
+        self.queries_before_render = 0
+        self.db_time = 0.0
+        self.view_time = 0.0
+        self.render_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def query(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest = statement
+            self.slowest_time = elapsed
+
+    @property
+    def total_time(self):
+        return self.view_time + self.render_time
+
+
+class ViewTotals:
+    """Running totals for a view since the process started"""
+    def __init__(self, view):
+        self.view = view
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.view_time = 0.0
+        self.render_time = 0.0
+
+    def add(self, stats):
+        self.requests += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.db_time += stats.db_time
+        self.view_time += stats.view_time
+        self.render_time += stats.render_time
+
+    @property
+    def mean_queries(self):
+        return self.queries / self.requests
+
+    @property
+    def mean_db_time(self):
+        return self.db_time / self.requests
+
+    @property
+    def mean_view_time(self):
+        return self.view_time / self.requests
+
+    @property
+    def mean_render_time(self):
+        return self.render_time / self.requests
+
+
+# The start time is kept on the statement's execution context rather
+# than the connection, so a statement that raises an exception (and so
+# never reaches after_cursor_execute) can't upset the timings of later
+# statements on the same pooled connection.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and getattr(_current, "stats", None) is not None:
+        context._querystats_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = getattr(_current, "stats", None)
+    start = getattr(context, "_querystats_start", None)
+    if stats is None or start is None:
+        return
+    stats.query(statement, time.perf_counter() - start)
+
+
+def start(view, path):
+    """Start recording statistics for a request in this thread"""
+    stats = RequestStats(view, path)
+    _current.stats = stats
+    return stats
+
+
+def finish(stats, record=True):
+    """Stop recording statistics for a request
+
+    If record is set, the statistics are added to the ring buffer and
+    the totals for the view.
+    """
+    _current.stats = None
+    if not record:
+        return
+    with _lock:
+        _recent.append(stats)
+        totals = _totals.get(stats.view)
+        if not totals:
+            totals = _totals[stats.view] = ViewTotals(stats.view)
+        totals.add(stats)
+
+
+def snapshot():
+    """Return a list of recent requests and a list of view totals
+    """
+    with _lock:
+        return list(_recent), [
+            _copy_totals(t) for t in _totals.values()]
+
+
+def _copy_totals(t):
+    c = ViewTotals(t.view)
+    c.__dict__.update(t.__dict__)
+    return c
+
+
+def prometheus(pools=None):
+    """Return the view totals in Prometheus text exposition format
+
+    pools is an optional list of pool statistics from
+    EngineRegistry.stats().
+    """
+    _, totals = snapshot()
+    metrics = [
+        ("tillweb_view_requests_total", "counter",
+         "Requests handled by the view", "requests"),
+        ("tillweb_view_queries_total", "counter",
+         "Database queries made by the view", "queries"),
+        ("tillweb_view_max_queries", "gauge",
+         "Most database queries made by a single request", "max_queries"),
+        ("tillweb_view_db_seconds_total", "counter",
+         "Time spent waiting for the database", "db_time"),
+        ("tillweb_view_view_seconds_total", "counter",
+         "Time spent in the view function, including database time",
+         "view_time"),
+        ("tillweb_view_render_seconds_total", "counter",
+         "Time spent rendering templates, including database time",
+         "render_time"),
+    ]
+    lines = []
+    for name, kind, description, attr in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for t in sorted(totals, key=lambda t: t.view):
+            lines.append(f'{name}{{view="{t.view}"}} {getattr(t, attr)}')
+    if pools is not None:
+        pool_metrics = [
+            ("tillweb_pool_size", "Connection pool size", "size"),
+            ("tillweb_pool_checkedin", "Idle connections in the pool",
+             "checkedin"),
+            ("tillweb_pool_checkedout", "Connections in use", "checkedout"),
+        ]
+        for name, description, key in pool_metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for p in pools:
+                lines.append(
+                    f'{name}{{database="{p["database"]}"}} {p[key]}')
+    return "\n".join(lines) + "\n"
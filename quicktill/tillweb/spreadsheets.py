@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from quicktill.models import (
     Department,
     Transline,
@@ -7,6 +7,7 @@ from quicktill.models import (
     SessionTotal,
     RemoveCode,
     StockOut,
+    StockOutDaily,
     StockType,
     StockItem,
     Unit,
@@ -14,8 +15,9 @@ from quicktill.models import (
     zero,
 )
 import datetime
-from sqlalchemy.orm import undefer
-from sqlalchemy.orm import contains_eager
+import io
+import itertools
+import zipfile
 from sqlalchemy.sql import select, func, and_
 from sqlalchemy.sql.expression import literal
 from odf.opendocument import OpenDocumentSpreadsheet
@@ -26,6 +28,11 @@ from odf.table import Table, TableColumn, TableRow, TableCell
 import odf.number as number
 from .db import td
 
+# Reports that can cover many sessions fetch their results using a
+# server-side cursor, this many rows at a time, so that memory use
+# doesn't depend on the date range
+_yield_per = 1000
+
 
 class Sheet:
     """A table in a spreadsheet"""
@@ -88,6 +95,87 @@ class Sheet:
         return t
 
 
+class StreamingSheet(Sheet):
+    """A table in a spreadsheet that is written out as it is filled in
+
+    Rows must be filled in order: once a cell has been set in a row,
+    all earlier rows may already have been written out.  The table
+    columns are worked out from the column styles and headers present
+    when the document starts to be written, so these must be set
+    before the table is added to the document.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        # Indexed by row, then col
+        self._rows = {}
+        # Rows before this one have been written
+        self._next_row = 0
+        self._maxrow = -1
+        self._maxcol = 0
+
+    def cell(self, col, row, contents):
+        if row < self._next_row:
+            raise ValueError(
+                "Row {} of {} has already been written".format(
+                    row, self.name))
+        self._rows.setdefault(row, {})[col] = contents
+        self._maxrow = max(self._maxrow, row)
+        return contents
+
+    def columns(self):
+        """List of odf.table.TableColumn objects for the table"""
+        self._maxcol = max(
+            [col for cells in self._rows.values() for col in cells]
+            + list(self._columnstyles.keys()))
+        columns = []
+        for c in range(0, self._maxcol + 1):
+            s = self._columnstyles.get(c, None)
+            if s:
+                columns.append(TableColumn(stylename=s))
+            else:
+                columns.append(TableColumn())
+        return columns
+
+    def _write_rows(self, f, end):
+        for row in range(self._next_row, end):
+            cells = self._rows.pop(row, {})
+            tr = TableRow()
+            for col in range(0, max([self._maxcol] + list(cells)) + 1):
+                cell = cells.get(col, None)
+                if cell:
+                    tr.addElement(cell)
+                else:
+                    tr.addElement(TableCell())
+            tr.toXml(1, f)
+        self._next_row = max(self._next_row, end)
+
+    def write_completed_rows(self, f):
+        """Write rows that can no longer change to a text file"""
+        self._write_rows(f, self._maxrow)
+
+    def write_remaining_rows(self, f):
+        """Write all rows not yet written to a text file"""
+        self._write_rows(f, self._maxrow + 1)
+
+
+class _StreamBuffer:
+    """An unseekable file that collects data until it is taken"""
+    def __init__(self):
+        self._data = []
+
+    def write(self, data):
+        self._data.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._data)
+        self._data = []
+        return data
+
+
 class Document:
     """An OpenDocumentSpreadsheet under construction"""
 
@@ -118,6 +206,9 @@ class Document:
 
         self._widthstyles = {}
 
+        # List of (StreamingSheet, fill) tuples
+        self._streaming_tables = []
+
     def intcell(self, val):
         return TableCell(valuetype="float", value=val)
 
@@ -238,17 +329,105 @@ class Document:
     def add_table(self, table):
         self.doc.spreadsheet.addElement(table.as_table())
 
+    def add_streaming_table(self, table, fill):
+        """Add a table that is filled in while the document is written
+
+        fill is an iterator that adds rows to the table, yielding
+        whenever it has added some.  Streaming tables follow any
+        tables added using add_table().
+        """
+        self._streaming_tables.append((table, fill))
+
     def as_response(self):
-        r = HttpResponse(content_type=self.mimetype)
+        """Return the document as a django response
+
+        Documents with streaming tables are returned as a
+        StreamingHttpResponse.
+        """
+        if self._streaming_tables:
+            r = StreamingHttpResponse(self._stream(),
+                                      content_type=self.mimetype)
+        else:
+            r = HttpResponse(content_type=self.mimetype)
+            self.doc.write(r)
         if self.filename:
             r['Content-Disposition'] = 'attachment; filename={}'.format(
                 self.filename)
-        self.doc.write(r)
         return r
 
+    def write(self, f):
+        """Write the document to a binary file"""
+        if self._streaming_tables:
+            for data in self._stream():
+                f.write(data)
+        else:
+            self.doc.write(f)
+
+    @staticmethod
+    def _marker(num):
+        tr = TableRow()
+        tr.addElement(TableCell(valuetype="string",
+                                stringvalue=f"quicktill-stream-{num}"))
+        f = io.StringIO()
+        tr.toXml(1, f)
+        return tr, f.getvalue()
+
+    def _stream(self):
+        """Generate the document, a few rows at a time
+
+        odfpy writes the document with a marker row in place of the
+        rows of each streaming table.  All the files in that are
+        copied to the output unchanged except for content.xml, where
+        each marker is replaced by the rows of its table as they are
+        filled in.
+        """
+        markers = []
+        for num, (table, fill) in enumerate(self._streaming_tables):
+            t = Table(name=table.name)
+            for column in table.columns():
+                t.addElement(column)
+            marker, markerxml = self._marker(num)
+            t.addElement(marker)
+            self.doc.spreadsheet.addElement(t)
+            markers.append(markerxml)
+        template = io.BytesIO()
+        self.doc.write(template)
+        template = zipfile.ZipFile(template)
+
+        output = _StreamBuffer()
+        with zipfile.ZipFile(output, "w") as z:
+            for info in template.infolist():
+                if info.filename != "content.xml":
+                    z.writestr(info, template.read(info))
+                    yield output.take()
+                    continue
+                content = template.read(info).decode("utf-8")
+                cinfo = zipfile.ZipInfo(info.filename, info.date_time)
+                cinfo.compress_type = zipfile.ZIP_DEFLATED
+                with z.open(cinfo, "w") as c:
+                    for (table, fill), markerxml in zip(
+                            self._streaming_tables, markers):
+                        before, content = content.split(markerxml, 1)
+                        c.write(before.encode("utf-8"))
+                        for _ in fill:
+                            f = io.StringIO()
+                            table.write_completed_rows(f)
+                            c.write(f.getvalue().encode("utf-8"))
+                            data = output.take()
+                            if data:
+                                yield data
+                        f = io.StringIO()
+                        table.write_remaining_rows(f)
+                        c.write(f.getvalue().encode("utf-8"))
+                    c.write(content.encode("utf-8"))
+                yield output.take()
+        yield output.take()
+
 
 def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
     """A spreadsheet summarising sessions between the start and end date.
+
+    Returns a Document.
     """
     depts = td.s.query(Department).order_by(Department.id).all()
     tf = func.sum(Transline.items * Transline.amount).label("depttotal")
@@ -262,9 +441,9 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
 
     if rows == "Sessions":
         depttotals = \
-            td.s.query(Session, Department.id, tf)\
+            td.s.query(Session.id, Session.date, Session.actual_total,
+                       Department.id, tf)\
                 .select_from(Session)\
-                .options(undefer('actual_total'))\
                 .order_by(Session.id, Department.id)\
                 .group_by(Session.id, Department.id)\
                 .filter(
@@ -275,7 +454,8 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
                 .filter(Session.endtime != None)\
                 .filter(Session.date >= start)\
                 .filter(Session.date <= end)\
-                .join(Transaction, Transline, Department)
+                .join(Transaction, Transline, Department)\
+                .yield_per(_yield_per)
     else:
         dateranges = td.s.query(func.min(Session.date).label("start"),
                                 func.max(Session.date).label("end"))\
@@ -304,7 +484,8 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
                          .group_by(dateranges.c.start,
                                    dateranges.c.end,
                                    Transline.dept_id)\
-                         .order_by(dateranges.c.start, Transline.dept_id)
+                         .order_by(dateranges.c.start, Transline.dept_id)\
+                         .yield_per(_yield_per)
 
         acttotals = td.s.query(dateranges.c.start, dateranges.c.end,
                                select([func.sum(SessionTotal.amount)])
@@ -338,7 +519,7 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
 
     doc = Document(filename=filename)
 
-    table = Sheet(tillname)
+    table = StreamingSheet(tillname)
 
     widthshort = doc.colwidth("2.0cm")
     widthtotal = doc.colwidth("2.2cm")
@@ -392,50 +573,52 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
         table.cell(col, 0, doc.headercell(d.description))
         col += 1
 
-    row = 0
-    prev_row = None
-    for x in depttotals:
-        if rows == "Sessions":
-            session, dept, total = x
-            actual_total = session.actual_total
-            rowspec = session.id
-        else:
-            startdate, enddate, dept, total = x
-            rowspec = (startdate, enddate)
-            actual_total = acttotal_dict[rowspec]
-        if rowspec != prev_row:
-            prev_row = rowspec
-            row += 1
+    def fill():
+        row = 0
+        prev_row = None
+        for x in depttotals:
             if rows == "Sessions":
-                table.cell(idcol, row, doc.intcell(session.id))
-                table.cell(datecol, row, doc.datecell(session.date))
-            elif rows == "Days":
-                table.cell(datecol, row, doc.datecell(startdate))
+                sessionid, date, actual_total, dept, total = x
+                rowspec = sessionid
             else:
-                table.cell(startdatecol, row, doc.datecell(startdate))
-                table.cell(enddatecol, row, doc.datecell(enddate))
-
-            table.cell(tilltotalcol, row, doc.moneycell(
-                None, formula="oooc:=SUM([.{}:.{}])".format(
-                    table.ref(deptscol, row),
-                    table.ref(deptscol + len(depts) - 1, row))))
-            table.cell(actualtotalcol, row, doc.moneycell(actual_total))
-            table.cell(errorcol, row, doc.moneycell(
-                None, formula="oooc:=[.{}]-[.{}]".format(
-                    table.ref(actualtotalcol, row),
-                    table.ref(tilltotalcol, row))))
-            di = iter(depts)
-            col = deptscol - 1
-        while True:
-            col += 1
-            if next(di).id == dept:
-                if total:
-                    table.cell(col, row, doc.moneycell(total))
-                break
-
-    doc.add_table(table)
-
-    return doc.as_response()
+                startdate, enddate, dept, total = x
+                rowspec = (startdate, enddate)
+                actual_total = acttotal_dict[rowspec]
+            if rowspec != prev_row:
+                if prev_row is not None:
+                    yield
+                prev_row = rowspec
+                row += 1
+                if rows == "Sessions":
+                    table.cell(idcol, row, doc.intcell(sessionid))
+                    table.cell(datecol, row, doc.datecell(date))
+                elif rows == "Days":
+                    table.cell(datecol, row, doc.datecell(startdate))
+                else:
+                    table.cell(startdatecol, row, doc.datecell(startdate))
+                    table.cell(enddatecol, row, doc.datecell(enddate))
+
+                table.cell(tilltotalcol, row, doc.moneycell(
+                    None, formula="oooc:=SUM([.{}:.{}])".format(
+                        table.ref(deptscol, row),
+                        table.ref(deptscol + len(depts) - 1, row))))
+                table.cell(actualtotalcol, row, doc.moneycell(actual_total))
+                table.cell(errorcol, row, doc.moneycell(
+                    None, formula="oooc:=[.{}]-[.{}]".format(
+                        table.ref(actualtotalcol, row),
+                        table.ref(tilltotalcol, row))))
+                di = iter(depts)
+                col = deptscol - 1
+            while True:
+                col += 1
+                if next(di).id == dept:
+                    if total:
+                        table.cell(col, row, doc.moneycell(total))
+                    break
+
+    doc.add_streaming_table(table, fill())
+
+    return doc
 
 
 def session(s, tillname="Till"):
@@ -608,18 +791,20 @@ def waste(start=None, end=None, cols="depts", tillname="Till"):
     types is not a column.
 
     The first row of each sheet is headers.
+
+    Returns a Document.
     """
     depts = td.s.query(Department).order_by(Department.id).all()
     wastes = td.s.query(RemoveCode).order_by(RemoveCode.id).all()
     wastes = wastes + [RemoveCode(id="unaccounted", reason="Unaccounted")]
 
-    date = func.date(StockOut.time)
+    date = StockOutDaily.date
     data = td.s.query(date,
                       StockType.dept_id,
-                      StockOut.removecode_id,
-                      func.sum(StockOut.qty))\
-               .select_from(StockOut)\
-               .join(StockItem, StockType)
+                      StockOutDaily.removecode_id,
+                      func.sum(StockOutDaily.qty))\
+               .select_from(StockOutDaily)\
+               .join(StockType)
     if start:
         data = data.filter(date >= start)
     else:
@@ -628,7 +813,8 @@ def waste(start=None, end=None, cols="depts", tillname="Till"):
         data = data.filter(date <= end)
     else:
         end = td.s.query(func.max(date)).scalar()
-    data = data.group_by(date, StockType.dept_id, StockOut.removecode_id).all()
+    data = data.group_by(date, StockType.dept_id, StockOutDaily.removecode_id)\
+               .yield_per(_yield_per)
 
     date = func.date(StockItem.finished)
     unaccounted = td.s.query(date,
@@ -641,9 +827,9 @@ def waste(start=None, end=None, cols="depts", tillname="Till"):
                       .filter(StockItem.finished <= end)\
                       .filter(StockItem.finished >= start)\
                       .group_by(date, StockType.dept_id)\
-                      .all()
+                      .yield_per(_yield_per)
 
-    data = data + unaccounted
+    data = itertools.chain(data, unaccounted)
 
     filename = "{}-waste.ods".format(tillname)
     doc = Document(filename)
@@ -704,38 +890,47 @@ def waste(start=None, end=None, cols="depts", tillname="Till"):
         for dept in depts:
             doc.add_table(dept_sheets[dept.id])
 
-    return doc.as_response()
+    return doc
 
 
 def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
-    sold = td.s.query(StockType, func.sum(StockOut.qty))\
-               .options(contains_eager(StockType.department))\
+    """Stock types used, with quantities, between two dates
+
+    Returns a Document.
+    """
+    # Quantities by stock usage date come from the daily totals;
+    # quantities by transaction date need the individual stockout rows
+    # because the session date may not be the date the stock was used
+    qty = StockOut.qty if dates == "transaction" else StockOutDaily.qty
+    sold = td.s.query(StockType.manufacturer, StockType.name, StockType.abv,
+                      Department.description, func.sum(qty),
+                      Unit.name)\
+               .select_from(StockType)\
                .join(Department)\
-               .options(contains_eager(StockType.unit))\
                .join(Unit)\
-               .join(StockItem, StockOut)\
-               .group_by(StockType, Department, Unit)\
+               .group_by(StockType.id, Department.id, Unit.id)\
                .order_by(StockType.dept_id,
-                         func.sum(StockOut.qty).desc())
+                         func.sum(qty).desc())\
+               .yield_per(_yield_per)
 
     if dates == "transaction":
-        sold = sold.join(Transline, Transaction, Session)
+        sold = sold.join(StockItem, StockOut, Transline, Transaction, Session)
         if start:
             sold = sold.filter(Session.date >= start)
         if end:
             sold = sold.filter(Session.date <= end)
     else:
-        sold = sold.filter(StockOut.removecode_id == 'sold')
+        sold = sold.join(StockOutDaily)\
+                   .filter(StockOutDaily.removecode_id == 'sold')
         if start:
-            sold = sold.filter(StockOut.time >= start)
+            sold = sold.filter(StockOutDaily.date >= start)
         if end:
-            sold = sold.filter(
-                StockOut.time < (end + datetime.timedelta(days=1)))
+            sold = sold.filter(StockOutDaily.date <= end)
 
     filename = "{}-stock-sold.ods".format(tillname)
     doc = Document(filename)
 
-    sheet = Sheet("Stock sold")
+    sheet = StreamingSheet("Stock sold")
     # Columns are:
     # Manufacturer  Name  ABV  Dept  qty  Unit
     sheet.cell(0, 0, doc.headercell("Manufacturer"))
@@ -745,23 +940,29 @@ def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
     sheet.cell(4, 0, doc.headercell("Qty"))
     sheet.cell(5, 0, doc.headercell("Unit"))
 
-    row = 1
-    for st, qty in sold.all():
-        sheet.cell(0, row, doc.textcell(st.manufacturer))
-        sheet.cell(1, row, doc.textcell(st.name))
-        if st.abv:
-            sheet.cell(2, row, doc.numbercell(st.abv))
-        sheet.cell(3, row, doc.textcell(st.department.description))
-        sheet.cell(4, row, doc.numbercell(qty))
-        sheet.cell(5, row, doc.textcell(st.unit.name))
-        row += 1
+    def fill():
+        row = 1
+        for manufacturer, name, abv, dept, qty, unit in sold:
+            sheet.cell(0, row, doc.textcell(manufacturer))
+            sheet.cell(1, row, doc.textcell(name))
+            if abv:
+                sheet.cell(2, row, doc.numbercell(abv))
+            sheet.cell(3, row, doc.textcell(dept))
+            sheet.cell(4, row, doc.numbercell(qty))
+            sheet.cell(5, row, doc.textcell(unit))
+            row += 1
+            yield
 
-    doc.add_table(sheet)
-    return doc.as_response()
+    doc.add_streaming_table(sheet, fill())
+    return doc
 
 
 def translinesummary(start=None, end=None, dates="transaction",
                      department=None, simplify=False, tillname="Till"):
+    """Transaction lines grouped by description between two dates
+
+    Returns a Document.
+    """
     what = Transline.text
 
     if simplify:
@@ -771,7 +972,8 @@ def translinesummary(start=None, end=None, dates="transaction",
              .select_from(Transline)\
              .filter(Transline.original_amount != zero)\
              .group_by(what)\
-             .order_by(func.sum(Transline.items).desc())
+             .order_by(func.sum(Transline.items).desc())\
+             .yield_per(_yield_per)
 
     if department:
         tl = tl.filter(Transline.dept_id == department.id)
@@ -792,18 +994,53 @@ def translinesummary(start=None, end=None, dates="transaction",
     filename = "{}-transline-summary.ods".format(tillname)
     doc = Document(filename)
 
-    sheet = Sheet("Transaction line summary")
+    sheet = StreamingSheet("Transaction line summary")
     # Columns are:
     # Text  Count
     # Manufacturer  Name  ABV  Dept  qty  Unit
     sheet.cell(0, 0, doc.headercell("Description"))
     sheet.cell(1, 0, doc.headercell("Count"))
 
-    row = 1
-    for text, count in tl.all():
-        sheet.cell(0, row, doc.textcell(text))
-        sheet.cell(1, row, doc.numbercell(count))
-        row += 1
+    def fill():
+        row = 1
+        for text, count in tl:
+            sheet.cell(0, row, doc.textcell(text))
+            sheet.cell(1, row, doc.numbercell(count))
+            row += 1
+            yield
 
-    doc.add_table(sheet)
-    return doc.as_response()
+    doc.add_streaming_table(sheet, fill())
+    return doc
+
+
+# Reports that take a date range, which can be generated by a report
+# worker instead of while handling a request
+reports = {
+    "sessionrange": sessionrange,
+    "waste": waste,
+    "stocksold": stocksold,
+    "translinesummary": translinesummary,
+}
+
+
+def report_params(start=None, end=None, department=None, **kwargs):
+    """Convert report arguments to JSON-compatible parameters
+    """
+    params = dict(kwargs)
+    params["start"] = start.isoformat() if start else None
+    params["end"] = end.isoformat() if end else None
+    if department:
+        params["department"] = department.id
+    return params
+
+
+def report_document(report, params):
+    """Create the Document for a report given parameters from report_params()
+    """
+    args = dict(params)
+    for k in ("start", "end"):
+        if args.get(k):
+            args[k] = datetime.date.fromisoformat(args[k])
+    if args.get("department") is not None:
+        args["department"] = td.s.query(Department).get(args["department"])
+    return reports[report](**args)
@@ -4,11 +4,15 @@ from django.http import HttpResponseRedirect
 from django.http import HttpResponseForbidden
 from django import forms
 from django.contrib import messages
-from sqlalchemy import inspect
-from sqlalchemy.sql import desc
+from sqlalchemy import inspect, distinct, Text
+from sqlalchemy.sql import desc, select, func, case, cast
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm import undefer
 from quicktill.models import StockTake
+from quicktill.models import StockType
+from quicktill.models import Unit
+from quicktill.models import Department
 from quicktill.models import StockItem
 from quicktill.models import StockTakeSnapshot
 from quicktill.models import StockTakeAdjustment
@@ -95,15 +99,7 @@ def stocktake(request, info, stocktake_id):
     elif stocktake.state == "in progress":
         return stocktake_in_progress(request, info, stocktake)
 
-    snapshots = td.s.query(StockTakeSnapshot)\
-        .filter(StockTakeSnapshot.stocktake == stocktake)\
-        .options(undefer('newqty'))\
-        .options(joinedload('adjustments').joinedload('removecode'))\
-        .options(joinedload('stockitem').joinedload('stocktype'))\
-        .order_by(StockTakeSnapshot.stock_id)\
-        .all()
-
-    stocktypes = _snapshots_to_stocktypes(snapshots)
+    stocktypes = _stocktake_stocktypes(stocktake, all_snapshots=True)
 
     more_details_available = False in (
         st.unit.stocktake_by_items for st in stocktypes)
@@ -156,39 +152,113 @@ def stocktake_pending(request, info, st):
     })
 
 
-def _snapshots_to_stocktypes(snapshots):
+def _stocktake_stocktypes(stocktake, all_snapshots=False):
+    """Stock types in a stock take, with their snapshot totals
+
+    Returns a list of StockType in order of department, manufacturer
+    and name.  The totals for each stock type are calculated in a
+    single query, and added to it as attributes:
+
+    snapshot_qty, snapshot_newqty: total quantities at the start of
+    the stock take and after adjustments
+
+    snapshot_finishcode: the FinishCode of all the snapshots, or None
+    if they do not all have the same one
+
+    snapshot_checked: whether all the snapshots have been checked
+
+    adjustments: dict of RemoveCode to total adjustment, formatted in
+    stock units
+
+    The snapshots themselves are added as the "snapshots" attribute;
+    unless all_snapshots is set, this is only done for stock types
+    that are counted by item and is an empty list for the others.
+    """
+    ss = StockTakeSnapshot
+    adjustments = StockTakeAdjustment.__table__
+    # Total adjustment for each snapshot
+    by_snapshot = select([adjustments.c.stock_id,
+                          func.sum(adjustments.c.qty).label('qty')])\
+        .where(adjustments.c.stocktake_id == stocktake.id)\
+        .group_by(adjustments.c.stock_id)\
+        .alias()
+    # Total adjustment for each stock type and remove code
+    by_removecode = select([StockItem.stocktype_id.label('stocktype'),
+                            adjustments.c.removecode_id,
+                            func.sum(adjustments.c.qty).label('qty')])\
+        .select_from(adjustments.join(
+            StockItem.__table__,
+            StockItem.id == adjustments.c.stock_id))\
+        .where(adjustments.c.stocktake_id == stocktake.id)\
+        .group_by(StockItem.stocktype_id, adjustments.c.removecode_id)\
+        .alias()
+    by_stocktype = select([
+        by_removecode.c.stocktype,
+        func.jsonb_object_agg(
+            by_removecode.c.removecode_id,
+            cast(by_removecode.c.qty, Text)).label('adjustments')])\
+        .group_by(by_removecode.c.stocktype)\
+        .alias()
+    newqty = ss.qty - func.coalesce(by_snapshot.c.qty, 0)
+    finishcode = case(
+        [(func.count(distinct(func.coalesce(ss.finishcode_id, ''))) == 1,
+          func.min(ss.finishcode_id))])
+
+    rows = td.s.query(StockType,
+                      func.sum(ss.qty),
+                      func.sum(newqty),
+                      finishcode,
+                      func.bool_and(ss.checked),
+                      by_stocktype.c.adjustments)\
+        .select_from(ss)\
+        .join(StockItem, StockItem.id == ss.stock_id)\
+        .join(StockType, StockType.id == StockItem.stocktype_id)\
+        .join(Unit, Unit.id == StockType.unit_id)\
+        .join(Department, Department.id == StockType.dept_id)\
+        .outerjoin(by_snapshot, by_snapshot.c.stock_id == ss.stock_id)\
+        .outerjoin(by_stocktype, by_stocktype.c.stocktype == StockType.id)\
+        .filter(ss.stocktake_id == stocktake.id)\
+        .options(contains_eager(StockType.unit),
+                 contains_eager(StockType.department))\
+        .group_by(StockType.id, Unit.id, Department.id,
+                  by_stocktype.c.adjustments)\
+        .order_by(StockType.dept_id, StockType.manufacturer, StockType.name)\
+        .all()
+
+    finishcodes = {fc.id: fc for fc in td.s.query(FinishCode).all()}
+    removecodes = {rc.id: rc for rc in td.s.query(RemoveCode).all()}
     stocktypes = []
-    for s in snapshots:
-        st = s.stockitem.stocktype
-        if not hasattr(s.stockitem.stocktype, 'snapshots'):
-            st.snapshots = [s]
-            st.snapshot_qty = s.qty
-            st.snapshot_newqty = s.newqty
-            st.snapshot_finishcode = s.finishcode
-            st.snapshot_checked = s.checked
-            st.adjustments = {}
-            stocktypes.append(st)
-        else:
-            st.snapshots.append(s)
-            st.snapshot_qty += s.qty
-            st.snapshot_newqty += s.newqty
-            if s.finishcode != st.snapshot_finishcode:
-                st.snapshot_finishcode = None
-            if not s.checked:
-                st.snapshot_checked = False
-        for a in s.adjustments:
-            q = st.adjustments.setdefault(a.removecode, Decimal(0))
-            st.adjustments[a.removecode] = q + a.qty
-    for st in stocktypes:
-        st.adjustments = {rc: st.unit.format_stock_qty(qty)
-                          for rc, qty in st.adjustments.items()}
-        st.snapshot_qty_in_stockunits = \
-            st.unit.format_stock_qty(st.snapshot_qty)
-        st.snapshot_newqty_in_stockunits = \
-            st.unit.format_stock_qty(st.snapshot_newqty)
-
-    # Sort the stocktypes by department, manufacturer and name
-    stocktypes.sort(key=lambda x: (x.dept_id, x.manufacturer, x.name))
+    for st, qty, newqty, finishcode, checked, adjustments in rows:
+        st.snapshots = []
+        st.snapshot_qty = qty
+        st.snapshot_newqty = newqty
+        st.snapshot_finishcode = finishcodes.get(finishcode)
+        st.snapshot_checked = checked
+        st.adjustments = {
+            removecodes[rc]: st.unit.format_stock_qty(Decimal(qty))
+            for rc, qty in sorted((adjustments or {}).items())}
+        st.snapshot_qty_in_stockunits = st.unit.format_stock_qty(qty)
+        st.snapshot_newqty_in_stockunits = st.unit.format_stock_qty(newqty)
+        stocktypes.append(st)
+
+    if all_snapshots:
+        wanted = stocktypes
+    else:
+        wanted = [st for st in stocktypes if st.unit.stocktake_by_items]
+    if wanted:
+        by_id = {st.id: st for st in wanted}
+        snapshots = td.s.query(ss)\
+            .join(StockItem, StockItem.id == ss.stock_id)\
+            .filter(ss.stocktake_id == stocktake.id)\
+            .options(undefer('newqty'),
+                     joinedload('adjustments').joinedload('removecode'),
+                     contains_eager('stockitem').joinedload('stockline'))\
+            .order_by(ss.stock_id)
+        if not all_snapshots:
+            snapshots = snapshots.filter(
+                StockItem.stocktype_id.in_(list(by_id.keys())))
+        for snapshot in snapshots:
+            by_id[snapshot.stockitem.stocktype_id].snapshots.append(snapshot)
 
     return stocktypes
 
@@ -201,13 +271,6 @@ class StockTakeInProgressForm(forms.Form):
 def stocktake_in_progress(request, info, stocktake):
     may_edit = info.user_has_perm('stocktake')
 
-    # We want to end up with a list of stocktypes that have snapshots
-    # in this stocktake.  This could possibly be done as a query for
-    # StockType and StockTakeSnapshot suitably joined and filtered,
-    # but it's going to be simpler and faster to query snapshots (with
-    # a joinedload of their adjustments) and then process to obtain
-    # the list of stocktypes.
-
     finishcodes = td.s.query(FinishCode).all()
     # XXX the "sold" removecode should be read from the
     # register:sold_stock_removecode_id configuration setting
@@ -215,16 +278,6 @@ def stocktake_in_progress(request, info, stocktake):
                       .filter(RemoveCode.id != "sold")\
                       .all()
 
-    snapshots = td.s.query(StockTakeSnapshot)\
-        .filter(StockTakeSnapshot.stocktake == stocktake)\
-        .options(undefer('newqty'),
-                 joinedload('adjustments'),
-                 joinedload('stockitem').joinedload('stocktype')
-                 .joinedload('unit'),
-                 joinedload('stockitem').joinedload('stockline'))\
-        .order_by(StockTakeSnapshot.stock_id)\
-        .all()
-
     # dicts of finishcode and removecode
     finishcode_dict = {x.id: x for x in finishcodes}
     removecode_dict = {x.id: x for x in removecodes}
@@ -236,7 +289,11 @@ def stocktake_in_progress(request, info, stocktake):
         code = request.POST.get(k, "")
         return d.get(code, None)
 
-    stocktypes = _snapshots_to_stocktypes(snapshots)
+    # Updates need every snapshot; the page itself only shows
+    # individual snapshots for stock types counted by item
+    stocktypes = _stocktake_stocktypes(
+        stocktake, all_snapshots=may_edit and request.method == 'POST')
+    snapshots = [ss for st in stocktypes for ss in st.snapshots]
 
     form = StockTakeInProgressForm()
 
@@ -126,6 +126,10 @@ tillurls = [
     path('reports/stockcheck/', views.stockcheck, name="tillweb-stockcheck"),
     path('reports/translines/', views.transline_summary_report,
          name="tillweb-report-transline-summary"),
+    path('reports/job/<int:jobid>/', views.report_job,
+         name="tillweb-report-job"),
+    path('reports/job/<int:jobid>/download/', views.report_job_download,
+         name="tillweb-report-job-download"),
 
     path('datatable/sessions.json', datatable.sessions,
          name="tillweb-datatable-sessions"),
@@ -156,5 +160,9 @@ tillurls = [
 urls = [
     # Index page
     path('', views.publist, name="tillweb-publist"),
+    path('query-stats/', views.querystats_index,
+         name="tillweb-querystats"),
+    path('query-stats/metrics', views.querystats_metrics,
+         name="tillweb-querystats-metrics"),
     re_path(r'^(?P<pubname>[\w\-]+)/', include(tillurls)),
 ]
@@ -1,30 +1,35 @@
 from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.http import HttpResponseForbidden
 from django.http import JsonResponse
+from django.http.response import HttpResponseBase
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.shortcuts import render
 from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.views.decorators.cache import cache_control
 from django.conf import settings
 from django import forms
 from django.core.exceptions import ValidationError
 import django.urls
 from .models import Till, Access
 import sqlalchemy
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, TimeoutError
 from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import lazyload
 from sqlalchemy.orm import defaultload
 from sqlalchemy.orm import undefer, undefer_group
-from sqlalchemy.sql import select, desc
-from sqlalchemy.sql.expression import tuple_, func, null
+from sqlalchemy.sql import desc
+from sqlalchemy.sql.expression import func
 from sqlalchemy import distinct
 from quicktill.models import (
     StockType,
     LogEntry,
     User,
-    Business,
     Transline,
     VatBand,
     Department,
@@ -49,6 +54,9 @@ from quicktill.models import (
     Config,
     Payment,
     PayType,
+    ReportJob,
+    StockOutDaily,
+    VatCache,
     money_max_digits,
     money_decimal_places,
     qty_max_digits,
@@ -61,10 +69,15 @@ from quicktill.models import (
     zero,
 )
 from quicktill.version import version
+from quicktill import reportjobs
 from . import spreadsheets
+from . import querystats
 import datetime
+import hashlib
 import logging
-from .db import td
+import threading
+import time
+from .db import td, EngineRegistry
 from .forms import SQLAModelChoiceField
 from .forms import StringIDMultipleChoiceField
 from .forms import StringIDChoiceField
@@ -153,6 +166,42 @@ def publist(request):
                   {'access': access})
 
 
+@staff_member_required
+def querystats_index(request):
+    """Database query statistics for tillweb views in this process
+    """
+    recent, totals = querystats.snapshot()
+    totals.sort(key=lambda t: t.db_time, reverse=True)
+    slowest = sorted(recent, key=lambda r: r.total_time, reverse=True)[:50]
+    most_queries = sorted(recent, key=lambda r: r.queries, reverse=True)[:50]
+    return render(request, 'tillweb/querystats.html', {
+        'totals': totals,
+        'recent': len(recent),
+        'slowest': slowest,
+        'most_queries': most_queries,
+        'prometheus': bool(getattr(
+            settings, 'TILLWEB_QUERY_STATS_PROMETHEUS', False)),
+        'engines': engines,
+        'pools': engines.stats() if engines else None,
+    })
+
+
+def querystats_metrics(request):
+    """Database query statistics in Prometheus text format
+
+    Available to staff users, and to any client if
+    TILLWEB_QUERY_STATS_PROMETHEUS is set to True or to a list of
+    client addresses that includes this one.
+    """
+    allowed = getattr(settings, 'TILLWEB_QUERY_STATS_PROMETHEUS', False)
+    if not (request.user.is_staff or allowed is True
+            or (allowed and request.META.get('REMOTE_ADDR') in allowed)):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        querystats.prometheus(pools=engines.stats() if engines else None),
+        content_type="text/plain; version=0.0.4")
+
+
 # The remainder of the view functions in this file follow a similar
 # pattern.  They are kept separate rather than implemented as a
 # generic view so that page-specific optimisations (the ".options()"
@@ -220,9 +269,169 @@ class user:
         td.s.add(l)
 
 
+# Views showing a single object that may be immutable (closed
+# sessions and transactions, for example) can be decorated with
+# @immutable_object below the @tillweb_view decorator.  After such a
+# view has run, if the object's tillweb_immutable property is True
+# the response is kept in the django cache for
+# TILLWEB_RENDER_CACHE_TIMEOUT seconds, and sent with an ETag so
+# browsers can revalidate it cheaply.
+#
+# Changes to immutable objects are rare, and are always made with a
+# log entry that refers to the object.  A cache entry records the
+# highest log entry ID when it was stored, and is discarded if any
+# later log entry refers to the object.  Pages also include some
+# reference data (department names, for example) that is not tracked
+# this way; the cache timeout limits how long that can be out of
+# date.
+
+def immutable_object(model, argname):
+    """The view shows the instance of model identified by argname
+    """
+    def decorate(view):
+        view.tillweb_immutable = (model, argname)
+        return view
+    return decorate
+
+
+def _render_cache_key(session, request, access, tilluser):
+    key = (str(session.get_bind().url), request.get_full_path(), access,
+           tilluser.id if tilluser else None, version)
+    return "tillweb-render:" + hashlib.sha1(
+        repr(key).encode("utf-8")).hexdigest()
+
+
+def _logged_since(session, model, objid, logid):
+    """Is there a log entry after logid that refers to the object?
+    """
+    col = getattr(LogEntry, f"{model.__table__.name}_id")
+    return session.query(
+        session.query(LogEntry)
+        .filter(LogEntry.id > logid)
+        .filter(col == objid)
+        .exists()).scalar()
+
+
+def _cached_response(request, entry):
+    response = HttpResponse(entry['content'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    return get_conditional_response(
+        request, etag=entry['etag'], last_modified=entry['last_modified'],
+        response=response)
+
+
+def _render_result(request, result, single_site, tillname, access,
+                   tilluser, pubname, money):
+    t, d = result
+    # till is the name of the till
+    # access is 'R','M','F'
+    defaults = {
+        'single_site': single_site,  # Used for breadcrumbs
+        'till': tillname,
+        'access': access,
+        'tilluser': tilluser,
+        'dtf': dtf,
+        'pubname': pubname,
+        'version': version,
+        'money': money,
+    }
+    defaults.update(d)
+    return render(request, 'tillweb/' + t, defaults)
+
+
+class _streaming_session_content:
+    """Streaming response content that needs the database session
+
+    Spreadsheets are generated while the response is being sent,
+    after the view has returned, so the session and the other
+    per-request state is kept until the response is closed.
+    """
+    def __init__(self, content, session, request, info):
+        self._content = content
+        self._session = session
+        self._request = request
+        self._info = info
+
+    def __iter__(self):
+        td.s = self._session
+        td.request = self._request
+        td.info = self._info
+        yield from self._content
+
+    def close(self):
+        td.s = None
+        td.request = None
+        td.info = None
+        self._session.close()
+
+
+# In multi-site mode, till databases are either found in
+# settings.SQLALCHEMY_SESSIONS, a mapping from Till.database to a
+# session factory, or if TILLWEB_DATABASE_URL is set, connected to
+# using a shared EngineRegistry.
+engines = None
+if getattr(settings, 'TILLWEB_DATABASE_URL', None):
+    engines = EngineRegistry(
+        settings.TILLWEB_DATABASE_URL,
+        max_engines=getattr(settings, 'TILLWEB_MAX_ENGINES', 20),
+        max_connections=getattr(settings, 'TILLWEB_MAX_CONNECTIONS', 40),
+        pool_timeout=getattr(settings, 'TILLWEB_POOL_TIMEOUT', 10))
+
+# When no database connection is free, clients are asked to try again
+# after this many seconds
+_busy_retry_after = getattr(settings, 'TILLWEB_POOL_TIMEOUT', 10)
+
+# Till and Access lookups are cached for a short time, so that each
+# request doesn't need to query the django database
+_lookup_ttl = getattr(settings, 'TILLWEB_LOOKUP_TTL', 30)
+_lookup_cache_size = 1000
+_lookup_cache = {}
+_lookup_lock = threading.Lock()
+
+
+def _cached_lookup(key, lookup):
+    if not _lookup_ttl:
+        return lookup()
+    now = time.monotonic()
+    with _lookup_lock:
+        cached = _lookup_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    value = lookup()
+    with _lookup_lock:
+        if len(_lookup_cache) >= _lookup_cache_size:
+            for k in [k for k, v in _lookup_cache.items() if v[0] <= now]:
+                del _lookup_cache[k]
+            if len(_lookup_cache) >= _lookup_cache_size:
+                _lookup_cache.clear()
+        _lookup_cache[key] = (now + _lookup_ttl, value)
+    return value
+
+
+def _busy_response(request, till, pubname, access, error):
+    """Tell the client to try again when no database connection is free
+    """
+    response = render(request, "tillweb/busy.html",
+                      {'till': till,
+                       'pubname': pubname,
+                       'access': access,
+                       'error': error},
+                      status=503)
+    response['Retry-After'] = str(_busy_retry_after)
+    return response
+
+
 def tillweb_view(view):
     single_site = getattr(settings, 'TILLWEB_SINGLE_SITE', False)
     tillweb_login_required = getattr(settings, 'TILLWEB_LOGIN_REQUIRED', True)
+    render_cache_timeout = getattr(
+        settings, 'TILLWEB_RENDER_CACHE_TIMEOUT', 3600)
+    immutable = getattr(view, 'tillweb_immutable', None)
+    query_stats = getattr(settings, 'TILLWEB_QUERY_STATS', True)
+    viewname = f"{view.__module__.rsplit('.', 1)[-1]}.{view.__name__}"
 
     def new_view(request, pubname="", *args, **kwargs):
         if single_site:
@@ -232,43 +441,46 @@ def tillweb_view(view):
             session = settings.TILLWEB_DATABASE()
             money = settings.TILLWEB_MONEY_SYMBOL
         else:
-            try:
-                till = Till.objects.get(slug=pubname)
-            except Till.DoesNotExist:
+            till = _cached_lookup(
+                ('till', pubname),
+                lambda: Till.objects.filter(slug=pubname).first())
+            if not till:
                 raise Http404
-            try:
-                access = Access.objects.get(user=request.user, till=till)
-            except Access.DoesNotExist:
+            access = _cached_lookup(
+                ('access', request.user.pk, till.pk),
+                lambda: Access.objects.filter(user=request.user, till=till)
+                .values_list('permission', flat=True).first())
+            if not access:
                 # Pretend it doesn't exist!
                 raise Http404
-            try:
-                session = settings.SQLALCHEMY_SESSIONS[till.database]()
-            except ValueError:
-                # The database doesn't exist
-                raise Http404
+            if engines:
+                try:
+                    session = engines.session(till.database)
+                except TimeoutError as te:
+                    return _busy_response(request, till, pubname, access, te)
+            else:
+                try:
+                    session = settings.SQLALCHEMY_SESSIONS[till.database]()
+                except ValueError:
+                    # The database doesn't exist
+                    raise Http404
             tillname = till.name
-            access = access.permission
             money = till.money_symbol
-        # At this point, access will be "R", "M" or "F".
-        # For anything other than "R" access, we need a quicktill.models.User
-        tilluser = None
-        if request.user.is_authenticated:
-            tilluser = session.query(User)\
-                              .options(joinedload('permissions'))\
-                              .filter(User.webuser == request.user.username)\
-                              .one_or_none()
-
+        stats = None
+        if query_stats or settings.DEBUG:
+            stats = querystats.start(viewname, request.path)
+        streaming = False
         try:
-            if settings.DEBUG:
-                queries_before_render = 0
-                queries = []
-
-                def querylog_callback(_conn, _cur, query, params, *_):
-                    queries.append(query)
-
-                sqlalchemy.event.listen(
-                    session.get_bind(), "before_cursor_execute",
-                    querylog_callback)
+            # At this point, access will be "R", "M" or "F".  For
+            # anything other than "R" access, we need a
+            # quicktill.models.User
+            tilluser = None
+            if request.user.is_authenticated:
+                tilluser = session.query(User)\
+                                  .options(joinedload('permissions'))\
+                                  .filter(User.webuser
+                                          == request.user.username)\
+                                  .one_or_none()
 
             info = viewutils(
                 access=access,
@@ -280,26 +492,60 @@ def tillweb_view(view):
             td.request = request
             td.info = info
             td.s = session
+
+            cache_key = None
+            if immutable and render_cache_timeout \
+               and request.method == "GET":
+                model, argname = immutable
+                objid = kwargs[argname]
+                cache_key = _render_cache_key(
+                    session, request, access, tilluser)
+                lastlog = session.query(func.max(LogEntry.id)).scalar() or 0
+                entry = cache.get(cache_key)
+                if entry and (entry['log'] == lastlog or not _logged_since(
+                        session, model, objid, entry['log'])):
+                    return _cached_response(request, entry)
+                # Pages that show messages can't be reused
+                if len(messages.get_messages(request)) > 0:
+                    cache_key = None
+
+            start = time.perf_counter()
             result = view(request, info, *args, **kwargs)
-            if settings.DEBUG:
-                queries_before_render = len(queries)
-            if isinstance(result, HttpResponse):
-                return result
-            t, d = result
-            # till is the name of the till
-            # access is 'R','M','F'
-            defaults = {
-                'single_site': single_site,  # Used for breadcrumbs
-                'till': tillname,
-                'access': access,
-                'tilluser': tilluser,
-                'dtf': dtf,
-                'pubname': pubname,
-                'version': version,
-                'money': money,
-            }
-            defaults.update(d)
-            return render(request, 'tillweb/' + t, defaults)
+            if stats:
+                stats.view_time = time.perf_counter() - start
+                stats.queries_before_render = stats.queries
+            if isinstance(result, HttpResponseBase):
+                response = result
+            else:
+                start = time.perf_counter()
+                response = _render_result(
+                    request, result, single_site, tillname, access,
+                    tilluser, pubname, money)
+                if stats:
+                    stats.render_time = time.perf_counter() - start
+
+            # Pages that include a CSRF token (for example, forms
+            # shown to users with permission to edit) can't be reused
+            if cache_key and response.status_code == 200 \
+               and not response.streaming \
+               and not request.META.get("CSRF_COOKIE_USED") \
+               and not request.META.get("CSRF_COOKIE_NEEDS_UPDATE") \
+               and session.query(model).get(objid).tillweb_immutable:
+                entry = {
+                    'log': lastlog,
+                    'content': response.content,
+                    'headers': list(response.items()),
+                    'etag': quote_etag(
+                        hashlib.sha1(response.content).hexdigest()),
+                    'last_modified': int(time.time()),
+                }
+                cache.set(cache_key, entry, render_cache_timeout)
+                response = _cached_response(request, entry)
+            if response.streaming:
+                response.streaming_content = _streaming_session_content(
+                    response.streaming_content, session, request, info)
+                streaming = True
+            return response
         except OperationalError as oe:
             return render(request, "tillweb/operationalerror.html",
                           {'till': till,
@@ -307,23 +553,28 @@ def tillweb_view(view):
                            'access': access,
                            'error': oe},
                           status=503)
+        except TimeoutError as te:
+            return _busy_response(request, till, pubname, access, te)
         finally:
-            if settings.DEBUG:
-                sqlalchemy.event.remove(
-                    session.get_bind(), "before_cursor_execute",
-                    querylog_callback)
-                if len(queries) > 3:
+            if stats:
+                querystats.finish(stats, record=query_stats)
+                if settings.DEBUG and stats.queries > 3:
                     log.warning(
                         "Excessive queries in view (%d pre render, %d "
                         "during render)",
-                        queries_before_render,
-                        len(queries) - queries_before_render)
-
-            td.s = None
-            td.request = None
-            td.info = None
-            session.close()
-
+                        stats.queries_before_render,
+                        stats.queries - stats.queries_before_render)
+
+            if not streaming:
+                td.s = None
+                td.request = None
+                td.info = None
+                session.close()
+
+    # Responses may vary between users, and must be revalidated
+    # every time in case the object has changed
+    if immutable:
+        new_view = cache_control(private=True, no_cache=True)(new_view)
     if tillweb_login_required or not single_site:
         new_view = login_required(new_view)
     return new_view
@@ -340,22 +591,68 @@ def undefer_qtys(entity):
     return defaultload(entity).undefer_group("qtys")
 
 
-def business_totals(firstday, lastday):
-    # This query is wrong in that it ignores the 'business' field in
-    # VatRate objects.  Fixes that don't involve a database round-trip
-    # per session are welcome!
-    return td.s.query(Business,
-                      func.sum(Transline.items * Transline.amount))\
-               .join(VatBand)\
-               .join(Department)\
-               .join(Transline)\
-               .join(Transaction)\
-               .join(Session)\
-               .filter(Session.date <= lastday)\
-               .filter(Session.date >= firstday)\
-               .order_by(Business.id)\
-               .group_by(Business)\
-               .all()
+def weekly_business_totals(firstday, weeks):
+    """Sales totals per business for consecutive weeks
+
+    Returns a list with an entry for each week, the first starting on
+    firstday.  Each entry is a list of (businessid, total) tuples in
+    order of business ID.  Sales are attributed to the business of the
+    department's VAT band at the date of the session, so VatRate
+    entries that change the business are honoured.
+    """
+    lastday = firstday + datetime.timedelta(days=weeks * 7 - 1)
+    vat = VatCache.get(td.s)
+    totals = [{} for _ in range(weeks)]
+    for date, band, total in td.s.query(
+            Session.date, Department.vatband,
+            func.sum(Transline.items * Transline.amount))\
+            .select_from(Session)\
+            .join(Transaction)\
+            .join(Transline)\
+            .join(Department)\
+            .filter(Session.date >= firstday)\
+            .filter(Session.date <= lastday)\
+            .group_by(Session.date, Department.vatband):
+        week = totals[(date - firstday).days // 7]
+        businessid = vat.at(band, date).businessid
+        week[businessid] = week.get(businessid, zero) + total
+    return [sorted(week.items()) for week in totals]
+
+
+def _closed_transactions(firstday, lastday):
+    """Fingerprint of the closed transactions in a range of sessions
+    """
+    return tuple(td.s.query(func.count(Transaction.id),
+                            func.sum(Transaction.id))
+                 .join(Session)
+                 .filter(Session.date >= firstday)
+                 .filter(Session.date <= lastday)
+                 .filter(Transaction.closed == True)
+                 .one())
+
+
+def cached_weekly_business_totals(firstday, weeks):
+    """weekly_business_totals() using the django cache
+
+    The cached result is used until a transaction in one of the weeks
+    is closed, or for at most TILLWEB_WEEK_TOTALS_CACHE_TIMEOUT
+    seconds.  Lines in transactions that are still open may be left
+    out of the cached totals until then.
+    """
+    timeout = getattr(settings, 'TILLWEB_WEEK_TOTALS_CACHE_TIMEOUT', 600)
+    if not timeout:
+        return weekly_business_totals(firstday, weeks)
+    lastday = firstday + datetime.timedelta(days=weeks * 7 - 1)
+    key = "tillweb-week-totals:" + hashlib.sha1(repr(
+        (str(td.s.get_bind().url), firstday, weeks, version))
+        .encode("utf-8")).hexdigest()
+    closed = _closed_transactions(firstday, lastday)
+    entry = cache.get(key)
+    if entry and entry['closed'] == closed:
+        return entry['totals']
+    totals = weekly_business_totals(firstday, weeks)
+    cache.set(key, {'closed': closed, 'totals': totals}, timeout)
+    return totals
 
 
 class _pager_page:
@@ -381,12 +678,22 @@ class Pager:
     should be passed through in the pagesize_hidden_inputs() method,
     for the pagesize form to include in the query string when the
     pagesize is changed.
+
+    If key is specified it must be a unique attribute of the items
+    that the query is ordered by (descending if key_descending is
+    set).  The links to the next and previous pages will then include
+    the key of the last or first item on the current page, and those
+    pages will be fetched by continuing from that key rather than
+    using OFFSET.  Links to arbitrary pages still use OFFSET.
     """
     def __init__(self, request, query, items_per_page=25,
-                 preserve_query_parameters=[]):
+                 preserve_query_parameters=[], key=None,
+                 key_descending=False):
         self._request = request
         self._query = query
         self._preserve_query_parameters = preserve_query_parameters
+        self._key = key
+        self._key_descending = key_descending
         self.page = 1
         self.default_items_per_page = items_per_page
         if 'page' in request.GET:
@@ -452,29 +759,81 @@ class Pager:
         return self.has_next() or self.has_previous()
 
     def items(self):
+        if hasattr(self, '_items'):
+            return self._items
         q = self._query
-        if self.items_per_page:
-            q = q.offset((self.page - 1) * self.items_per_page)\
+        after = before = None
+        if self.items_per_page and self.page != 1 and self._key:
+            after = self._key_value('after')
+            before = self._key_value('before')
+        if after is not None:
+            q = q.filter(self._key < after if self._key_descending
+                         else self._key > after)\
+                 .limit(self.items_per_page)
+            self._items = q.all()
+        elif before is not None:
+            # Fetch the page in reverse order, then put it back
+            q = q.filter(self._key > before if self._key_descending
+                         else self._key < before)\
+                 .order_by(None)\
+                 .order_by(self._key if self._key_descending
+                           else desc(self._key))\
                  .limit(self.items_per_page)
-        return q.all()
+            self._items = list(reversed(q.all()))
+        else:
+            if self.items_per_page:
+                q = q.offset((self.page - 1) * self.items_per_page)\
+                     .limit(self.items_per_page)
+            self._items = q.all()
+        return self._items
+
+    def _key_value(self, param):
+        """Key from the after or before query parameter
+
+        Returns None if the parameter is missing or malformed, so that
+        the page is fetched using OFFSET instead.
+        """
+        value = self._request.GET.get(param)
+        if not value:
+            return None
+        try:
+            return self._key.type.python_type(value)
+        except (ValueError, TypeError, ArithmeticError,
+                NotImplementedError):
+            return None
 
-    def pagelink(self, page):
+    def pagelink(self, page, **keyset):
         d = self._request.GET.copy()
         d['page'] = str(page)
+        d.pop('after', None)
+        d.pop('before', None)
+        d.update(keyset)
         if self.items_per_page != self.default_items_per_page:
             d['pagesize'] = str(self.items_per_page)
         return "?" + d.urlencode()
 
+    def _keylink(self, page, param, item):
+        if not self._key:
+            return self.pagelink(page)
+        return self.pagelink(page, **{
+            param: str(getattr(item, self._key.key))})
+
     def pagesize_hidden_inputs(self):
         return [(x, self._request.GET[x])
                 for x in self._preserve_query_parameters
                 if x in self._request.GET]
 
     def nextlink(self):
-        return self.pagelink(self.page + 1) if self.has_next() else None
+        if not self.has_next() or not self.items():
+            return None
+        return self._keylink(self.page + 1, 'after', self.items()[-1])
 
     def prevlink(self):
-        return self.pagelink(self.page - 1) if self.has_previous() else None
+        if not self.has_previous():
+            return None
+        if not self.items():
+            return self.pagelink(self.page - 1)
+        return self._keylink(self.page - 1, 'before', self.items()[0])
 
     def firstlink(self):
         return self.pagelink(1) if self.has_previous() else None
@@ -495,18 +854,17 @@ def pubroot(request, info):
     if datetime.datetime.now().hour < 4:
         date = date - datetime.timedelta(1)
     thisweek_start = date - datetime.timedelta(date.weekday())
-    thisweek_end = thisweek_start + datetime.timedelta(6)
-    lastweek_start = thisweek_start - datetime.timedelta(7)
-    lastweek_end = thisweek_end - datetime.timedelta(7)
-    weekbefore_start = lastweek_start - datetime.timedelta(7)
-    weekbefore_end = lastweek_end - datetime.timedelta(7)
-
-    weeks = [("Current week", thisweek_start, thisweek_end,
-              business_totals(thisweek_start, thisweek_end)),
-             ("Last week", lastweek_start, lastweek_end,
-              business_totals(lastweek_start, lastweek_end)),
-             ("The week before last", weekbefore_start, weekbefore_end,
-              business_totals(weekbefore_start, weekbefore_end))]
+    weekbefore_start = thisweek_start - datetime.timedelta(14)
+
+    vat = VatCache.get(td.s)
+    weeks = []
+    for n, (title, totals) in enumerate(zip(
+            ["The week before last", "Last week", "Current week"],
+            cached_weekly_business_totals(weekbefore_start, 3))):
+        start = weekbefore_start + datetime.timedelta(7 * n)
+        weeks.insert(0, (title, start, start + datetime.timedelta(6),
+                         [(vat.business(businessid), total)
+                          for businessid, total in totals]))
 
     # currentsession = Session.current(session)
     currentsession = td.s.query(Session)\
@@ -524,23 +882,13 @@ def pubroot(request, info):
                      .options(undefer_qtys("stockonsale"))\
                      .all()
 
-    stillage = td.s.query(StockAnnotation)\
-                   .join(StockItem)\
-                   .outerjoin(StockLine)\
-                   .filter(
-                       tuple_(StockAnnotation.text, StockAnnotation.time).in_(
-                           select([StockAnnotation.text,
-                                   func.max(StockAnnotation.time)],
-                                  StockAnnotation.atype == 'location')
-                           .group_by(StockAnnotation.text)))\
-                   .filter(StockItem.finished == None)\
-                   .order_by(StockLine.name != null(), StockAnnotation.time)\
-                   .options(joinedload('stockitem')
-                            .joinedload('stocktype')
-                            .joinedload('unit'),
-                            joinedload('stockitem').joinedload('stockline'),
-                            undefer_qtys('stockitem'))\
-                   .all()
+    stillage = StockAnnotation.stillage(td.s)\
+        .options(joinedload('stockitem')
+                 .joinedload('stocktype')
+                 .joinedload('unit'),
+                 joinedload('stockitem').joinedload('stockline'),
+                 undefer_qtys('stockitem'))\
+        .all()
 
     deferred = td.s.query(func.sum(Transline.items * Transline.amount))\
                    .select_from(Transaction)\
@@ -597,7 +945,8 @@ def sessions(request, info):
         rangeform = SessionSheetForm(request.POST)
         if rangeform.is_valid():
             cd = rangeform.cleaned_data
-            return spreadsheets.sessionrange(
+            return _date_range_report(
+                "sessionrange",
                 start=cd['startdate'],
                 end=cd['enddate'],
                 rows=cd['rows'],
@@ -612,6 +961,7 @@ def sessions(request, info):
 
 
 @tillweb_view
+@immutable_object(Session, 'sessionid')
 def session(request, info, sessionid):
     s = td.s.query(Session)\
             .options(undefer('total'),
@@ -643,6 +993,7 @@ def session(request, info, sessionid):
 
 
 @tillweb_view
+@immutable_object(Session, 'sessionid')
 def session_spreadsheet(request, info, sessionid):
     s = td.s.query(Session)\
             .options(undefer('transactions.total'),
@@ -654,6 +1005,7 @@ def session_spreadsheet(request, info, sessionid):
 
 
 @tillweb_view
+@immutable_object(Session, 'sessionid')
 def session_discounts(request, info, sessionid):
     s = td.s.query(Session).get(sessionid)
     if not s:
@@ -697,6 +1049,7 @@ def session_discounts(request, info, sessionid):
 
 
 @tillweb_view
+@immutable_object(Session, 'sessionid')
 def session_stock_sold(request, info, sessionid):
     s = td.s.query(Session).get(sessionid)
     if not s:
@@ -718,6 +1071,7 @@ class TransactionNotesForm(forms.Form):
 
 
 @tillweb_view
+@immutable_object(Transaction, 'transid')
 def transaction(request, info, transid):
     t = td.s.query(Transaction)\
             .options(subqueryload('payments'),
@@ -737,6 +1091,7 @@ def transaction(request, info, transid):
             if form.is_valid():
                 cd = form.cleaned_data
                 t.notes = cd["notes"]
+                user.log(f"Set the note on {t.logref} to '{t.notes}'")
                 td.s.commit()
                 return HttpResponseRedirect(t.get_absolute_url())
         else:
@@ -1079,7 +1434,7 @@ def deliverylist(request, info):
              .order_by(desc(Delivery.id))\
              .options(joinedload('supplier'))
 
-    pager = Pager(request, dl)
+    pager = Pager(request, dl, key=Delivery.id, key_descending=True)
 
     may_create_delivery = info.user_has_perm("deliveries")
 
@@ -1642,7 +1997,7 @@ def stocksearch(request, info):
             q = q.filter(StockItem.finished == None)
 
         pager = Pager(request, q, preserve_query_parameters=[
-            "manufacturer", "name", "include_finished"])
+            "manufacturer", "name", "include_finished"], key=StockItem.id)
 
     return ('stocksearch.html', {
         'nav': [("Stock", info.reverse("tillweb-stocksearch"))],
@@ -2438,7 +2793,7 @@ def barcodelist(request, info):
                             joinedload('plu'))\
                    .order_by(Barcode.id)
 
-    pager = Pager(request, barcodes)
+    pager = Pager(request, barcodes, key=Barcode.id)
 
     return ('barcodes.html', {
         'nav': [
@@ -2629,7 +2984,8 @@ def department(request, info, departmentid, as_spreadsheet=False):
             filename="{}-dept{}-stock.ods".format(
                 info.tillname, departmentid))
 
-    pager = Pager(request, items, preserve_query_parameters=["show_finished"])
+    pager = Pager(request, items, preserve_query_parameters=["show_finished"],
+                  key=StockItem.id, key_descending=True)
 
     return ('department.html', {
         'tillobject': d,
@@ -2668,17 +3024,18 @@ def stockcheck(request, info):
             behind = datetime.timedelta(days=cd['months_behind'] * 30.4)
             min_sale = cd['minimum_sold']
             dept = cd['department']
-            r = td.s.query(StockType, func.sum(StockOut.qty) / behind.days)\
+            since = datetime.date.today() - behind
+            sold = func.sum(StockOutDaily.qty) / behind.days
+            r = td.s.query(StockType, sold)\
                     .select_from(StockType)\
-                    .join(StockItem)\
-                    .join(StockOut)\
+                    .join(StockOutDaily)\
                     .options(lazyload(StockType.department),
                              lazyload(StockType.unit),
                              undefer(StockType.all_instock))\
-                    .filter(StockOut.removecode_id == 'sold')\
-                    .filter((func.now() - StockOut.time) < behind)\
+                    .filter(StockOutDaily.removecode_id == 'sold')\
+                    .filter(StockOutDaily.date > since)\
                     .filter(StockType.department == dept)\
-                    .having(func.sum(StockOut.qty) / behind.days > min_sale)\
+                    .having(sold > min_sale)\
                     .group_by(StockType)\
                     .all()
             buylist = sorted(
@@ -2978,6 +3335,61 @@ def configitem(request, info, key):
     })
 
 
+def _date_range_report(report, **kwargs):
+    """Respond with a spreadsheet report
+
+    If TILLWEB_REPORT_JOBS is set, the report is queued for a report
+    worker and the response is a redirect to a page that waits for
+    it.  Otherwise the report is generated now.
+    """
+    params = spreadsheets.report_params(**kwargs)
+    if getattr(settings, 'TILLWEB_REPORT_JOBS', False):
+        job = reportjobs.enqueue(
+            td.s, report, params, kwargs.get('start'), kwargs.get('end'))
+        td.s.commit()
+        return HttpResponseRedirect(job.get_absolute_url())
+    return spreadsheets.report_document(report, params).as_response()
+
+
+@tillweb_view
+def report_job(request, info, jobid):
+    job = td.s.query(ReportJob).get(jobid)
+    if not job:
+        raise Http404
+    download = info.reverse("tillweb-report-job-download",
+                            kwargs={'jobid': job.id}) \
+        if job.state == "done" else None
+
+    if request.GET.get("format") == "json":
+        return JsonResponse({
+            'state': job.state,
+            'download': download,
+            'error': job.error,
+        })
+
+    return ('report-job.html', {
+        'nav': [
+            ("Reports", info.reverse("tillweb-reports")),
+            (f"Report {job.id}", job.get_absolute_url()),
+        ],
+        'job': job,
+        'download': download,
+    })
+
+
+@tillweb_view
+def report_job_download(request, info, jobid):
+    job = td.s.query(ReportJob)\
+              .options(undefer('result'))\
+              .get(jobid)
+    if not job or job.state != "done":
+        raise Http404
+    r = HttpResponse(job.result, content_type=job.mimetype)
+    if job.filename:
+        r['Content-Disposition'] = f'attachment; filename={job.filename}'
+    return r
+
+
 @tillweb_view
 def reportindex(request, info):
     return ('reports.html', {
@@ -2998,7 +3410,8 @@ def waste_report(request, info):
         wasteform = WasteReportForm(request.POST, prefix="waste")
         if wasteform.is_valid():
             cd = wasteform.cleaned_data
-            return spreadsheets.waste(
+            return _date_range_report(
+                "waste",
                 start=cd['startdate'],
                 end=cd['enddate'],
                 cols=cd['columns'],
@@ -3028,7 +3441,8 @@ def stock_sold_report(request, info):
         stocksoldform = StockSoldReportForm(request.POST, prefix="stocksold")
         if stocksoldform.is_valid():
             cd = stocksoldform.cleaned_data
-            return spreadsheets.stocksold(
+            return _date_range_report(
+                "stocksold",
                 start=cd['startdate'],
                 end=cd['enddate'],
                 dates=cd['dates'],
@@ -3061,7 +3475,8 @@ def transline_summary_report(request, info):
         form = TranslineSummaryReportForm(request.POST)
         if form.is_valid():
             cd = form.cleaned_data
-            return spreadsheets.translinesummary(
+            return _date_range_report(
+                "translinesummary",
                 start=cd['startdate'],
                 end=cd['enddate'],
                 dates=cd['dates'],
@@ -364,44 +364,8 @@ def auto_allocate_internal(deliveryid=None, message_on_no_work=True):
     manually.
     """
     log.debug("Start auto_allocate")
-    # Find candidate stock
-    q = td.s.query(StockItem)\
-            .join(Delivery)\
-            .filter(StockItem.finished == None)\
-            .filter(Delivery.checked == True)\
-            .filter(StockItem.stockline == None)
-    if deliveryid:
-        q = q.filter(Delivery.id == deliveryid)
-    stock = q.all()
-    # Find candidate stock lines
-    stocklines = td.s.query(StockLine)\
-                     .filter(StockLine.linetype == "display")\
-                     .all()
-    # Build dictionary of stocktypes
-    st = {}
-    for sl in stocklines:
-        if sl.stocktype in st:
-            st[sl.stocktype].append(sl)
-        else:
-            st[sl.stocktype] = [sl]
-    done = []
-    manual = []
-    dbu = user.current_dbuser()
-    for item in stock:
-        if item.stocktype in st:
-            if len(st[item.stocktype]) == 1:
-                line = st[item.stocktype][0]
-                item.stockline = line
-                item.displayqty = item.used
-                item.onsale = datetime.datetime.now()
-                td.s.add(StockAnnotation(
-                    stockitem=item, atype="start",
-                    text=f"{line.name} (auto-allocate)",
-                    user=dbu))
-                done.append(item)
-            else:
-                manual.append(item)
-    td.s.flush()
+    done, manual = StockItem.allocate_display_stock(
+        td.s, deliveryid=deliveryid, user=user.current_dbuser())
     msg = []
     if done or manual:
         if done:
@@ -423,8 +387,8 @@ def auto_allocate_internal(deliveryid=None, message_on_no_work=True):
             msg = msg + [
                 "{} {} -> {}".format(
                     item.id, item.stocktype,
-                    " or ".join(line.name for line in st[item.stocktype]))
-                for item in manual]
+                    " or ".join(line.name for line in lines))
+                for item, lines in manual]
         ui.infopopup(msg, title="Auto-allocate confirmation",
                      colour=ui.colour_confirm, dismiss=keyboard.K_CASH)
     else: